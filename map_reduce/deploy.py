@@ -234,8 +234,5 @@ if __name__ == '__main__':
     if args[0] == "code":
         do_deploy(options.verbose, options.branch, options.flatten)
     if args[0] == "geoip":
-        geoIpFiles = ["const.py", "util.py", "timezone.py", "__init__.py"]
-        fullPahtFiles = map(
-            lambda f: "../third_party/pygeoip/pygeoip/" + f, geoIpFiles)
-        copy_files_to_prod(["GeoLiteCity.dat"] +
-            fullPahtFiles, "geo/", options.flatten)
+        # pygeoip itself is deployed with the code, as py/pygeoip.py
+        copy_files_to_prod(["GeoLiteCity.dat"], "geo/", options.flatten)
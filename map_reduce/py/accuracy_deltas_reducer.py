@@ -14,6 +14,7 @@ import os.path
 # Add the directory where table_parser.py is to the Python path.
 sys.path.append(os.path.dirname(__file__))
 
+import hive_io
 import table_parser
 
 
@@ -66,9 +67,16 @@ def emit_accuracy_deltas(attempts, user_topic, user_segment):
         for i in range(prev_card[0], curr_card[0]):
             # TODO(david): Output and group by user segments (eg.
             #     experiments the user was in).
-            print '%s\t%s\t%s\t%s\t%s' % (topic, user_segment, len(attempts),
-                    i, incremental_gain)
+            yield [topic, user_segment, str(len(attempts)), str(i),
+                   str(incremental_gain)]
+
+
+def main():
+    output = hive_io.Output()
+    output.write_rows(row for args in table_parser.iter_user_topic_input()
+                      for row in emit_accuracy_deltas(*args))
+    output.close()
 
 
 if __name__ == '__main__':
-    table_parser.parse_user_topic_input(emit_accuracy_deltas)
+    main()
@@ -5,10 +5,17 @@ Map reduce transforms to compute values of student and teachers
 
 import sys
 import datetime
+import os
 import time
 
+sys.path.append(os.path.dirname(__file__))
+import hive_io
+
 date_format = '%Y-%m-%d'
 
+# The hive_io.Output rows are written to, set by main().
+_output = None
+
 
 def daterange(start_date, end_date):
     """Date range iterator Yields consecutive dates
@@ -21,8 +28,7 @@ def daterange(start_date, end_date):
 def emit_data_row(value, date):
     """Create data row. Friendly wrapper"""
 
-    emit_str = "{0}\t{1}".format("\t".join(value), date)
-    print(emit_str)
+    _output.write_row(value + [date])
 
 
 def fill_value(value, from_dt, to_dt):
@@ -46,8 +52,7 @@ def reduce_coaches(threshold):
     current_coach = ""
     num_students = 0
 
-    for line in sys.stdin:
-        user, coach, joined_on = line.rstrip('\n').split('\t')
+    for user, coach, joined_on in hive_io.iter_rows():
         if coach != current_coach:
             current_coach = coach
             num_students = 0
@@ -62,11 +67,11 @@ def fill_counts(end_date):
         days for each day.
     Fills missing dates with preceeding values"""
 
-    current_count, current_dt = sys.stdin.readline().rstrip('\n').split('\t')
+    rows = hive_io.iter_rows()
+    current_count, current_dt = next(rows)
     current_count = int(current_count)
 
-    for line in sys.stdin:
-        days_count, dt = line.rstrip('\n').split('\t')
+    for days_count, dt in rows:
         fill_value([str(current_count)], current_dt, dt)
         current_dt = dt
         current_count = current_count + int(days_count)
@@ -90,7 +95,8 @@ def active_students(end_date, different_days):
         Allows to see highly engaged users.
     """
 
-    student, current_dt = sys.stdin.readline().rstrip('\n').split('\t')
+    rows = hive_io.iter_rows()
+    student, current_dt = next(rows)
     current_dt_obj = datetime.datetime.strptime(
         current_dt, date_format).date()
     last_28days = [{student: set([current_dt])}]
@@ -112,8 +118,7 @@ def active_students(end_date, different_days):
         emit_data_row([str(len(filtered_students))],
             time.strftime(date_format, dt.timetuple()))
 
-    for line in sys.stdin:
-        student, dt = line.rstrip('\n').split('\t')
+    for student, dt in rows:
         dt_obj = datetime.datetime.strptime(dt, date_format).date()
 
         if dt_obj != current_dt_obj:
@@ -156,8 +161,8 @@ def active_teachers(end_date, threshold, different_days):
         active in order to be counted as active
     """
 
-    for line in sys.stdin:
-        student, current_teacher, current_dt = line.rstrip('\n').split('\t')
+    rows = hive_io.iter_rows()
+    for student, current_teacher, current_dt in rows:
         if current_teacher != "":
             break
 
@@ -186,8 +191,7 @@ def active_teachers(end_date, threshold, different_days):
         emit_data_row([str(active_teachers)],
             time.strftime(date_format, dt.timetuple()))
 
-    for line in sys.stdin:
-        student, teacher, dt = line.rstrip('\n').split('\t')
+    for student, teacher, dt in rows:
         if teacher == "":
             continue
         dt_obj = datetime.datetime.strptime(dt, date_format).date()
@@ -252,6 +256,8 @@ def main():
         print >> sys.stderr, usage_str
         exit(1)
 
+    global _output
+    _output = hive_io.Output()
     if sys.argv[1] == "teacher":
         reduce_coaches(int(sys.argv[2]))
     elif sys.argv[1] == "count":
@@ -264,6 +270,7 @@ def main():
         print >> sys.stderr, "Unkown option"
         print >> sys.stderr, usage_str
         exit(1)
+    _output.close()
 
 
 if __name__ == "__main__":
@@ -5,8 +5,12 @@
 import collections
 import datetime
 import json
+import os
 import sys
 
+sys.path.append(os.path.dirname(__file__))
+import hive_io
+
 # global string var representing the date partition we're working with
 g_dt = None
 
@@ -73,13 +77,12 @@ def compute(sub_mode, plogs):
 
 
 def output(super_mode, sub_mode, ex_stats):
+    """Yields the output rows for the stats."""
+    stat_names = ['users', 'user_exercises', 'problems', 'correct',
+            'profs', 'prof_prob_count', 'first_attempts', 'hint_probs',
+            'time_taken']
     for ex, stats in ex_stats.iteritems():
-        stat_names = ['users', 'user_exercises', 'problems', 'correct',
-                'profs', 'prof_prob_count', 'first_attempts', 'hint_probs',
-                'time_taken']
-        output_str = "\t".join([super_mode, sub_mode, ex]) + "\t"
-        output_str += "\t".join([str(stats[s]) for s in stat_names]) + "\n"
-        sys.stdout.write(output_str)
+        yield [super_mode, sub_mode, ex] + [str(stats[s]) for s in stat_names]
 
 
 def num_topic_plogs(plogs):
@@ -163,7 +166,10 @@ def user_day_matches_mode(plog_stats, user_info, mode):
 
 
 def process_user_day(user_info, plogs):
-    """Compute statistics over plogs for each comination of filter modes."""
+    """Compute statistics over plogs for each comination of filter modes.
+
+    Yields the output rows.
+    """
 
     plog_stats = (len(plogs), num_topic_plogs(plogs))
 
@@ -183,33 +189,30 @@ def process_user_day(user_info, plogs):
                     user_day_matches_mode(plog_stats, user_info, sub_mode)):
                 # Choose the right pre-computed stats for this mode pair
                 if sub_mode in topic_modes:
-                    output(super_mode, sub_mode, ex_stats[sub_mode])
+                    stats = ex_stats[sub_mode]
                 else:
-                    output(super_mode, sub_mode, ex_stats[None])
-
+                    stats = ex_stats[None]
+                for row in output(super_mode, sub_mode, stats):
+                    yield row
 
-def main():
-    if len(sys.argv) <= 1:
-        print >> sys.stderr, "Usage: %s <dt>" % sys.argv[0]
-        exit(1)
-    global g_dt
-    g_dt = sys.argv[1]
 
+def reduce_user_days(rows):
+    """Yields the output rows for (user, type, json) input rows."""
     user_info = None
     prev_user = None
     plogs = []
     value_errors = 0
     join_errors = 0
 
-    for line in sys.stdin:
-        user, type_str, json_str = line.rstrip('\n').split('\t')
+    for user, type_str, json_str in rows:
 
         # If we're about to switch users, process the buffer and empty it
         if user != prev_user:
             if user_info is not None and user_info[0] != prev_user:
                 join_errors += 1
             else:
-                process_user_day(user_info, plogs)
+                for row in process_user_day(user_info, plogs):
+                    yield row
             plogs = []
 
         # If the line type represents user_info, all we need to do is keep
@@ -227,10 +230,23 @@ def main():
         except ValueError:
             value_errors += 1
 
-    process_user_day(user_info, plogs)
+    for row in process_user_day(user_info, plogs):
+        yield row
 
     print >>sys.stderr, "Finished main with %d ValueErrors " % value_errors
     print >>sys.stderr, "and %d join errors." % join_errors
 
+
+def main():
+    if len(sys.argv) <= 1:
+        print >> sys.stderr, "Usage: %s <dt>" % sys.argv[0]
+        exit(1)
+    global g_dt
+    g_dt = sys.argv[1]
+
+    out = hive_io.Output()    # (output() is taken)
+    out.write_rows(reduce_user_days(hive_io.iter_rows()))
+    out.close()
+
 if __name__ == '__main__':
     main()
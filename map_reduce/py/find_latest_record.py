@@ -4,17 +4,28 @@
 This expects two columns: a key and json blob.
 This looks at a 'backup_timestamp' property in each record, and emits the
 record with the latest timestamp for all records that match a given key.
+
+Decoding every record just to read those two properties is most of what
+this would cost, so RecordScanner picks them out of the json text
+instead, and only lines it can't be sure about are decoded (--decode
+decodes them all).  Or Hive can pass them in as columns, with --columns:
+
+    SELECT TRANSFORM(key, get_json_object(json, '$.backup_timestamp'), json)
+    USING 'find_latest_record.py --columns'
+
+(get_json_object makes a null backup_timestamp NULL, the same as a
+missing one, so --columns treats both as missing.)  Either way, only the
+latest record of the current key is kept in memory.
 """
 
-import codecs
 import json
 import optparse
+import os
 import re
 import sys
 
-
-# The following is needed for printing out char var > 128
-sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+sys.path.append(os.path.dirname(__file__))
+import hive_io
 
 # We may have trouble parsing some binary data, for reasons I don't fully
 # understand.  But https://bugs.launchpad.net/meliae/+bug/876810 gives
@@ -26,34 +37,136 @@ def replace_surrogates(sample):
     return surrogate.sub("#S\g<1>", sample)
 
 
-def main(key_prop='key'):
-    key = None
-    timestamp = None
-    json_str = None
+def decode(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        # Try one more time, in case binary data is the problem.
+        print >>sys.stderr, "Warning: Trouble parsing json '%s'." % line
+        return json.loads(replace_surrogates(line))
+
+
+def decoded_key_and_timestamp(line, key_prop='key'):
+    """Return (key, backup_timestamp or -1, line), by decoding line."""
+    json_object = decode(line)
+    return (json_object[key_prop], json_object.get('backup_timestamp', -1),
+            line)
+
+
+# The value of a property, after its name: a json string that's the same
+# decoded (short of being unicode), or a number.
+_VALUE_MATCHER = re.compile(
+    r'\s*:\s*(?:"([ !#-\[\]-~]*)"|'
+    r'(-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?)\s*[,}])')
+_INT_MATCHER = re.compile(r'-?[0-9]+$')
+
+
+def _scan_property(line, name):
+    """Return the _VALUE_MATCHER match of a property of a json object.
+
+    name is the property's name in quotes.  Raises KeyError if it's not
+    in the line at all.  Returns None if we can't be sure it's the value
+    of the object's own property: if the name is in the line more than
+    once, or there's another object (or a "{" in a string) before it, or
+    the value isn't a plain string or number.
+    """
+    pos = line.find(name)
+    if pos == -1:
+        raise KeyError(name)
+    if (line.find(name, pos + 1) != -1 or line.find('{', 1, pos) != -1 or
+            line[pos - 1:pos] == '\\'):
+        return None
+    return _VALUE_MATCHER.match(line, pos + len(name))
+
 
-    for line in sys.stdin:
+class RecordScanner(object):
+    """Reads the key and backup_timestamp of records without decoding them.
 
+    It only trusts properties that can't be anything but the record's own
+    (see _scan_property), with plain ascii string or number values.
+    Otherwise it decodes the line.
+    """
+
+    def __init__(self, key_prop='key'):
+        self.key_prop = key_prop
+        self._key_name = '"%s"' % key_prop
+
+    def key_and_timestamp(self, line):
+        """Return (key, backup_timestamp or -1, line)."""
+        key = self._scan_key(line)
+        if key is not None:
+            try:
+                match = _scan_property(line, '"backup_timestamp"')
+            except KeyError:
+                return key, -1, line
+            if match and match.group(2):
+                return key, float(match.group(2)), line
+        return decoded_key_and_timestamp(line, self.key_prop)
+
+    def _scan_key(self, line):
+        """Return the key, or None if the line has to be decoded for it."""
+        key = None
         try:
-            json_object = json.loads(line)
-        except ValueError:
-            # Try one more time, in case binary data is the problem.
-            print >>sys.stderr, "Warning: Trouble parsing json '%s'." % line
-            json_object = json.loads(replace_surrogates(line))
+            match = _scan_property(line, self._key_name)
+        except KeyError:
+            return None     # decoding will raise the KeyError
+        if match:
+            key, number = match.groups()
+            if key is None and _INT_MATCHER.match(number):
+                # (Floats don't print like they're written.)
+                key = int(number)
+        return key
+
 
-        current_key = json_object[key_prop]
+def column_key_and_timestamp(line):
+    """Return (key, backup_timestamp or -1, json) for a key<tab>timestamp
+    <tab>json line, as Hive would pass them with get_json_object.
+    """
+    key, timestamp, json_str = line.split('\t', 2)
+    if timestamp == hive_io.NULL:
+        return key, -1, json_str
+    try:
+        return key, float(timestamp), json_str
+    except ValueError:  # Not a number; compare it like decoding would.
+        return key, decode(json_str).get('backup_timestamp', -1), json_str
+
+
+def latest_records(lines, key_and_timestamp):
+    """Yields [key, json] for the latest of each run of lines with a key.
+
+    key_and_timestamp(line) returns the (key, backup_timestamp, json) of
+    a line.
+    """
+    key = None
+    timestamp = None
+    json_str = None
+
+    for line in lines:
+        current_key, current_timestamp, record = key_and_timestamp(line)
         if current_key != key:
             if json_str:
-                print "%s\t%s" % (key, json_str)
+                yield [key, json_str]
             key = current_key
             timestamp = None
             json_str = None
-        current_timestamp = -1
-        if 'backup_timestamp' in json_object:
-            current_timestamp = json_object['backup_timestamp']
         if timestamp is None or current_timestamp > timestamp:
             timestamp = current_timestamp
-            json_str = line.rstrip()
-    print "%s\t%s" % (key, json_str)
+            json_str = record.rstrip()
+    if json_str:
+        yield [key, json_str]
+
+
+def main(key_prop='key', mode='scan'):
+    if mode == 'columns':
+        key_and_timestamp = column_key_and_timestamp
+    elif mode == 'decode':
+        key_and_timestamp = lambda line: decoded_key_and_timestamp(line,
+                                                                   key_prop)
+    else:
+        key_and_timestamp = RecordScanner(key_prop).key_and_timestamp
+    output = hive_io.Output()
+    output.write_rows(latest_records(hive_io.iter_lines(), key_and_timestamp))
+    output.close()
 
 
 if __name__ == '__main__':
@@ -61,5 +174,13 @@ if __name__ == '__main__':
     parser.add_option(
             '--k', '--key', dest='key', default='key',
             help="The property name in the JSON to use as the key")
+    parser.add_option(
+            '--columns', dest='mode', action='store_const', const='columns',
+            default='scan',
+            help="Input is key<tab>backup_timestamp<tab>json lines")
+    parser.add_option(
+            '--decode', dest='mode', action='store_const', const='decode',
+            help="Decode every record, rather than scanning for the key "
+                 "and timestamp")
     options, _ = parser.parse_args()
-    main(options.key)
+    main(options.key, options.mode)
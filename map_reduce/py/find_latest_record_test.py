@@ -0,0 +1,70 @@
+import json
+import unittest
+
+import find_latest_record
+
+
+class RecordScannerTest(unittest.TestCase):
+
+    def assertScansLikeDecoding(self, record, key_prop='key'):
+        line = json.dumps(record)
+        key, timestamp, scanned_line = find_latest_record.RecordScanner(
+            key_prop).key_and_timestamp(line)
+        self.assertEqual(line, scanned_line)
+        self.assertEqual(record[key_prop], key)
+        self.assertEqual(type(record[key_prop]) is int, type(key) is int)
+        self.assertEqual(record.get('backup_timestamp', -1), timestamp)
+
+    def test_plain_records(self):
+        self.assertScansLikeDecoding({'key': 'abc', 'backup_timestamp': 12.5})
+        self.assertScansLikeDecoding({'key': 'abc', 'backup_timestamp': 12})
+        self.assertScansLikeDecoding({'key': 'abc', 'x': [1, {'y': 2}]})
+        self.assertScansLikeDecoding({'key': '', 'backup_timestamp': 1e9})
+        self.assertScansLikeDecoding({'identity': 7, 'key': 'x'}, 'identity')
+
+    def test_ambiguous_records(self):
+        self.assertScansLikeDecoding({'key': 'a', 'nested': {'key': 'b'}})
+        self.assertScansLikeDecoding(
+            {'key': 'a', 'x': {'backup_timestamp': 3}, 'backup_timestamp': 2})
+        self.assertScansLikeDecoding({'key': 'a"b', 'backup_timestamp': 1})
+        self.assertScansLikeDecoding({'key': u'caf\xe9'})
+        self.assertScansLikeDecoding({'key': 1.5})
+        self.assertScansLikeDecoding({'key': 'a', 'backup_timestamp': None})
+        self.assertScansLikeDecoding({'key': 'a', 'backup_timestamp': 'x'})
+        self.assertScansLikeDecoding({'key': 'a', 'note': 'say "key": "b"'})
+        self.assertScansLikeDecoding({'key': 'a', 'x"key': 'b'})
+        self.assertScansLikeDecoding({'key': 'a', 'x': {'key': 'b'}})
+        self.assertScansLikeDecoding(
+            {'key': 'a', 'x': {'backup_timestamp': 1}})
+
+    def test_no_key(self):
+        self.assertRaises(KeyError, self.assertScansLikeDecoding, {'x': 1})
+
+
+class LatestRecordsTest(unittest.TestCase):
+
+    def test_latest_records(self):
+        lines = [
+            '{"key": "a", "backup_timestamp": 2, "v": 1}',
+            '{"key": "a", "backup_timestamp": 3, "v": 2}  ',
+            '{"key": "a", "backup_timestamp": 1, "v": 3}',
+            '{"key": "b", "v": 4}',
+            '{"key": "b", "v": 5}',
+            '{"key": "c", "backup_timestamp": 1, "v": 6}',
+        ]
+        scanner = find_latest_record.RecordScanner()
+        self.assertEqual(
+            [['a', lines[1].rstrip()], ['b', lines[3]], ['c', lines[5]]],
+            list(find_latest_record.latest_records(
+                lines, scanner.key_and_timestamp)))
+
+        columns = ['a\t2\t' + lines[0], 'a\t3\t' + lines[1],
+                   'b\t\\N\t' + lines[3], 'b\t\\N\t' + lines[4]]
+        self.assertEqual(
+            [['a', lines[1].rstrip()], ['b', lines[3]]],
+            list(find_latest_record.latest_records(
+                columns, find_latest_record.column_key_and_timestamp)))
+
+
+if __name__ == '__main__':
+    unittest.main()
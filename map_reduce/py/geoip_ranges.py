@@ -0,0 +1,141 @@
+"""Fast lookups of batches of IPv4 addresses in a GeoIP City database.
+
+pygeoip's record_by_addr walks the database's binary tree one bit at a
+time in python, taking a lock for every record it reads, for every
+address it looks up.  GeoIPRanges walks the whole tree just once, with
+numpy, into a sorted array of the ranges of addresses each record is
+for, and then looks up a whole batch of addresses with one
+searchsorted():
+
+    geo_ip = pygeoip.GeoIP("GeoLiteCity.dat", pygeoip.MEMORY_CACHE)
+    ranges = geoip_ranges.GeoIPRanges(geo_ip)
+    for record in ranges.records_by_addrs(['8.8.8.8', '1.2.3.4']):
+        print record.get('country_code')
+
+Records are still decoded by pygeoip, but only once each: an LRU cache
+keeps the most recently used ones, since the same addresses (and
+addresses in the same block) tend to come up again and again.
+
+Like pygeoip.py, ADD FILE this next to the script that imports it.
+"""
+
+import collections
+import socket
+import struct
+
+import numpy as np
+
+import pygeoip
+
+
+BATCH_SIZE = 10000  # addresses per searchsorted() for callers to use
+DEFAULT_CACHE_SIZE = 100000  # records
+
+_IPV4_STRUCT = struct.Struct('!I')
+
+
+def ip_to_ipnum(addr):
+    """Return a dotted IPv4 address as an int, or -1 if it isn't one."""
+    try:
+        return _IPV4_STRUCT.unpack(socket.inet_aton(addr))[0]
+    except (socket.error, TypeError):
+        return -1
+
+
+def _tree_ranges(buf, segments, record_length):
+    """Return (starts, pointers) arrays of the leaves of a database's tree.
+
+    The tree is the first segments nodes of buf, each two record_length
+    byte little-endian pointers: to the node for a 0 (then a 1) in the
+    next bit of the address, or to a record if it's >= segments.  The
+    leaves are returned sorted by the first address they're for, so the
+    leaf for an address is the last one that starts at or before it.
+    """
+    tree = np.frombuffer(buf, dtype=np.uint8,
+                         count=2 * record_length * segments)
+    tree = tree.reshape(segments, 2, record_length).astype(np.int64)
+    children = np.zeros((segments, 2), dtype=np.int64)
+    for i in xrange(record_length):
+        children |= tree[:, :, i] << (8 * i)
+
+    # Go down the tree a level (a bit of the address) at a time.
+    nodes = np.zeros(1, dtype=np.int64)
+    node_starts = np.zeros(1, dtype=np.int64)
+    leaf_starts = []
+    leaf_pointers = []
+    for depth in xrange(31, -1, -1):
+        pointers = children[nodes].ravel()  # each node's 0 then 1 child
+        starts = np.repeat(node_starts, 2)
+        starts[1::2] += 1 << depth
+        is_leaf = pointers >= segments
+        leaf_starts.append(starts[is_leaf])
+        leaf_pointers.append(pointers[is_leaf])
+        nodes = pointers[~is_leaf]
+        node_starts = starts[~is_leaf]
+    if len(nodes):
+        raise pygeoip.GeoIPError('Corrupt database')
+
+    starts = np.concatenate(leaf_starts)
+    order = np.argsort(starts)
+    return starts[order], np.concatenate(leaf_pointers)[order]
+
+
+class GeoIPRanges(object):
+    """Looks up the pygeoip records of batches of IPv4 addresses."""
+
+    def __init__(self, geo_ip, cache_size=DEFAULT_CACHE_SIZE):
+        """geo_ip is a pygeoip.GeoIP of an IPv4 City database.
+
+        It has to have been opened with pygeoip.MEMORY_CACHE.
+        """
+        if geo_ip._databaseType not in (pygeoip.CITY_EDITION_REV0,
+                                        pygeoip.CITY_EDITION_REV1):
+            raise pygeoip.GeoIPError('Invalid database type, expected '
+                                     'IPv4 City')
+        if not geo_ip._flags & pygeoip.MEMORY_CACHE:
+            raise ValueError('geo_ip must be opened with MEMORY_CACHE')
+        self._geo_ip = geo_ip
+        self._no_record = geo_ip._databaseSegments
+        self._starts, self._pointers = _tree_ranges(
+            geo_ip._memoryBuffer, geo_ip._databaseSegments,
+            geo_ip._recordLength)
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    def record_pointers(self, ipnums):
+        """Return an array of the database's record pointer for each ipnum.
+
+        Negative ipnums (see ip_to_ipnum()) get the database's pointer
+        for no record, like addresses that aren't in it.
+        """
+        ipnums = np.asarray(ipnums, dtype=np.int64)
+        # The first range starts at 0, so every ipnum >= 0 is in one.
+        pointers = self._pointers[
+            np.searchsorted(self._starts, ipnums, side='right') - 1]
+        pointers[ipnums < 0] = self._no_record
+        return pointers
+
+    def records_by_addrs(self, addrs):
+        """Return the record of each address, like record_by_addr() does.
+
+        Addresses that aren't in the database, or aren't IPv4 addresses,
+        get an empty record (instead of an exception).  Records are
+        shared between addresses and calls, so don't change them.
+        """
+        ipnums = [ip_to_ipnum(addr) for addr in addrs]
+        pointers, inverse = np.unique(self.record_pointers(ipnums),
+                                      return_inverse=True)
+        records = [self._record(pointer) for pointer in pointers.tolist()]
+        return [records[i] for i in inverse.tolist()]
+
+    def _record(self, pointer):
+        if pointer == self._no_record:
+            return {}
+        try:
+            record = self._cache.pop(pointer)
+        except KeyError:
+            record = self._geo_ip._get_record_at(pointer)
+            if len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+        self._cache[pointer] = record
+        return record
@@ -0,0 +1,104 @@
+import os
+import random
+import socket
+import struct
+import tempfile
+import unittest
+
+import geoip_ranges
+import pygeoip
+
+
+def _pointer_bytes(pointer):
+    return struct.pack('<I', pointer)[:3]
+
+
+def write_city_database(filename, networks):
+    """Write a GeoLiteCity.dat style database of networks.
+
+    networks is a list of (dotted address, prefix length, record index),
+    with the smaller networks after the bigger ones they're part of.
+    Record i is in country number i % 250 + 1, in a made up city.
+    """
+    nodes = [[None, None]]  # node index, ('record', index) or None
+    for addr, prefix_length, index in networks:
+        ipnum = geoip_ranges.ip_to_ipnum(addr)
+        node = nodes[0]
+        for depth in xrange(31, 32 - prefix_length, -1):
+            bit = (ipnum >> depth) & 1
+            if not isinstance(node[bit], int):
+                nodes.append([node[bit], node[bit]])
+                node[bit] = len(nodes) - 1
+            node = nodes[node[bit]]
+        node[(ipnum >> (32 - prefix_length)) & 1] = ('record', index)
+
+    segments = len(nodes)
+    records = ['\0']    # a pointer of segments is for no record
+    records_size = 1
+    record_pointers = {}
+    for _, _, index in networks:
+        if index not in record_pointers:
+            record_pointers[index] = segments + records_size
+            records.append(
+                chr(index % 250 + 1) +
+                'Region %d\0Caf\xe9 %d\0\0' % (index, index) +
+                _pointer_bytes(1800000 + index % 1000 * 1000) +
+                _pointer_bytes(1800000 - index % 1000 * 1000))
+            records_size += len(records[-1])
+
+    def pointer(child):
+        if child is None:
+            return segments
+        if isinstance(child, int):
+            return child
+        return record_pointers[child[1]]
+
+    with open(filename, 'wb') as f:
+        for node in nodes:
+            f.write(_pointer_bytes(pointer(node[0])) +
+                    _pointer_bytes(pointer(node[1])))
+        f.write(''.join(records))
+        f.write('\xff\xff\xff' + chr(pygeoip.CITY_EDITION_REV0) +
+                _pointer_bytes(segments))
+
+
+class GeoIPRangesTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.dat')
+        os.close(fd)
+        write_city_database(self.filename, [
+            ('1.0.0.0', 8, 0), ('1.2.0.0', 16, 1), ('1.2.3.0', 24, 2),
+            ('8.8.8.8', 32, 3), ('128.0.0.0', 2, 4), ('200.1.0.0', 16, 1),
+            ('255.255.255.254', 31, 5)])
+        self.geo_ip = pygeoip.GeoIP(self.filename, pygeoip.MEMORY_CACHE)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_records_by_addrs(self):
+        addrs = ['1.0.0.1', '1.2.3.4', '1.2.4.0', '1.255.255.255', '2.0.0.0',
+                 '8.8.8.7', '8.8.8.8', '8.8.8.9', '127.255.255.255',
+                 '128.0.0.0', '191.255.255.255', '192.0.0.0', '200.1.2.3',
+                 '255.255.255.254', '255.255.255.255']
+        r = random.Random(1)
+        addrs.extend(socket.inet_ntoa(struct.pack('!I', r.getrandbits(32)))
+                     for _ in xrange(1000))
+        addrs = [addr for addr in addrs if addr != '0.0.0.0']
+
+        expected = [self.geo_ip.record_by_addr(addr) for addr in addrs]
+        for cache_size in (1, 100):
+            ranges = geoip_ranges.GeoIPRanges(self.geo_ip, cache_size)
+            self.assertEqual(expected, ranges.records_by_addrs(addrs))
+            self.assertEqual(expected, ranges.records_by_addrs(addrs))
+        self.assertEqual('Caf\xe9 2', expected[1]['city'])
+        self.assertEqual({}, expected[4])
+
+    def test_bad_addrs(self):
+        ranges = geoip_ranges.GeoIPRanges(self.geo_ip)
+        self.assertEqual([{}, {}, {}, {}],
+                         ranges.records_by_addrs(['', '\\N', 'x', '::1']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+"""Fast reading and writing of rows for Hive TRANSFORM scripts.
+
+Hive streams rows to a TRANSFORM script as lines of tab-separated fields
+on stdin, with NULL written as \\N, and reads the script's rows back from
+its stdout the same way.  Every reducer in this directory does that, and
+the python overhead of doing it one line at a time (print, or a codecs
+writer around sys.stdout) is a good part of what they cost, so this does
+it with as little per-row work as it can:
+
+    import hive_io
+
+    output = hive_io.Output()
+    output.write_rows([user, str(len(rows))] for (user, rows) in
+                      hive_io.group_by_key(hive_io.iter_rows()))
+    output.close()
+
+Most of what print costs is the small write()s to Hive's pipe that
+stdout's 4KB buffer makes (and a codecs writer more than doubles that),
+so Output writes batches of rows through a BUFFER_SIZE buffer.  The next
+biggest cost is a python function call per row, so write_rows() of a
+generator, which joins and writes rows BATCH_SIZE at a time, is the way
+to write: hive_io_benchmark.py has it at 3.5x as fast as print, and
+calling write_row() for each row at 2.4x.
+
+Hive has to ship this file along with the script that imports it, so
+ADD FILE it next to the script (ka_hive_init.q adds it too), and add the
+script's directory to sys.path before importing it:
+
+    sys.path.append(os.path.dirname(__file__))
+    import hive_io
+"""
+
+import itertools
+import operator
+import os
+import sys
+
+
+NULL = '\\N'
+
+BUFFER_SIZE = 1024 * 1024  # bytes
+BATCH_SIZE = 1000  # rows per write() to the output file
+
+
+def stdout():
+    """Return a binary file for stdout with a BUFFER_SIZE buffer.
+
+    Don't also print to sys.stdout once you've started writing to this.
+    """
+    sys.stdout.flush()
+    return os.fdopen(os.dup(sys.stdout.fileno()), 'wb', BUFFER_SIZE)
+
+
+def iter_lines(input_file=None):
+    """Yields each line of input_file (default stdin), without its newline."""
+    for line in (input_file or sys.stdin):
+        yield line.rstrip('\n')
+
+
+def iter_rows(input_file=None, delimiter='\t'):
+    """Yields each line of input_file (default stdin) as a list of fields.
+
+    Only the newline is stripped, so rows with empty last fields keep
+    them.  NULLs are left as \\N; see from_hive() and nulls_to_none().
+    """
+    for line in (input_file or sys.stdin):
+        yield line.rstrip('\n').split(delimiter)
+
+
+def from_hive(field):
+    """Return the field, or None if it's a Hive NULL."""
+    if field == NULL:
+        return None
+    return field
+
+
+def nulls_to_none(row):
+    """Return a copy of the row with its Hive NULLs replaced by None."""
+    return [None if field == NULL else field for field in row]
+
+
+def to_hive(value):
+    """Return a value as a Hive field: None is NULL, unicode is UTF-8."""
+    if value is None:
+        return NULL
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    return str(value)
+
+
+def group_by_key(rows, *key_indexes):
+    """Yields (key, list of rows) for each run of rows with the same key.
+
+    rows must be clustered by key (as DISTRIBUTE BY/SORT BY leave them).
+    The key is the field at key_indexes (default 0), or a tuple of the
+    fields if there are several key_indexes.
+    """
+    key = operator.itemgetter(*(key_indexes or (0,)))
+    for value, group in itertools.groupby(rows, key):
+        yield value, list(group)
+
+
+class Output(object):
+    """Collects output lines and writes them to a file in batches.
+
+    Unicode is written as UTF-8.  Call flush() or close() when done, or
+    the last batch isn't written.
+    """
+
+    def __init__(self, output_file=None, batch_size=BATCH_SIZE):
+        """output_file defaults to stdout().
+
+        close() only closes the file if it's the default.
+        """
+        self._owns_file = output_file is None
+        self._file = output_file or stdout()
+        self._batch_size = batch_size
+        self._batch = []
+        self._append = self._batch.append
+
+    def write(self, data):
+        """Write a string, normally one or more whole lines."""
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._append(data)
+        if len(self._batch) >= self._batch_size:
+            self._write_batch()
+
+    def write_row(self, fields):
+        """Write a list of fields as a row.
+
+        Fields that aren't str are converted by to_hive(), so None is
+        written as NULL.
+        """
+        try:
+            line = '\t'.join(fields)
+        except (TypeError, UnicodeDecodeError):  # None, int, unicode + UTF-8
+            line = '\t'.join([to_hive(field) for field in fields])
+        else:
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+        self._append(line + '\n')
+        if len(self._batch) >= self._batch_size:
+            self._write_batch()
+
+    def write_rows(self, rows):
+        """Write each list of fields in rows, as write_row() would."""
+        rows = iter(rows)
+        join = '\t'.join
+        while True:
+            batch = list(itertools.islice(rows, self._batch_size))
+            if not batch:
+                return
+            try:
+                data = '\n'.join([join(fields) for fields in batch])
+                if isinstance(data, unicode):
+                    data = data.encode('utf-8')
+            except (TypeError, UnicodeDecodeError):
+                data = '\n'.join([join([to_hive(field) for field in fields])
+                                  for fields in batch])
+            self._append(data + '\n')
+            self._write_batch()
+
+    def _write_batch(self):
+        self._file.write(''.join(self._batch))
+        del self._batch[:]
+
+    def flush(self):
+        self._write_batch()
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        if self._owns_file:
+            self._file.close()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""Benchmark hive_io against the hand-rolled I/O it replaced.
+
+Takes a file of tab-separated rows, or makes up (user, video, timestamp)
+rows, e.g.
+
+    hive_io_benchmark.py user_video_logs.tsv
+    hive_io_benchmark.py -n 1000000
+
+and reports how many rows/s each way of reading and writing them goes:
+the print, codecs writer and per-line write loops the reducers here
+used to have, and hive_io's iter_rows, group_by_key and Output.  Like
+Hive does, it runs each in a process of its own, with the rows on stdin
+and stdout a pipe it reads: much of what per-line writes cost is the
+small write()s to the pipe, which writing to /dev/null would hide.  With
+made-up rows, it then reports how fast video_recommendation_reducer.py
+and ka_udf.py rank run on them.
+"""
+
+import codecs
+import optparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import hive_io
+
+
+def write_rows(filename, num_rows):
+    """Write num_rows (user, video, timestamp) lines, clustered by user."""
+    r = random.Random(42)
+    with open(filename, 'wb') as f:
+        for i in xrange(num_rows):
+            f.write('user%d\tvideo%d\t%d.%d\n' % (
+                i // 7, r.randint(0, 5000), 1357000000 + i, r.randint(0, 99)))
+
+
+# Each of these copies the first and third fields of stdin to stdout, or
+# counts the rows of each user, the way the reducers did or now do.
+
+def _print_loop():
+    for line in sys.stdin:
+        fields = line.rstrip().split('\t')
+        print '%s\t%s' % (fields[0], fields[2])
+
+
+def _codecs_print_loop():
+    sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+    _print_loop()
+
+
+def _write_loop():
+    for line in sys.stdin:
+        fields = line.rstrip('\n').split('\t')
+        sys.stdout.write('%s\t%s\n' % (fields[0], fields[2]))
+
+
+def _hive_io_write_row():
+    output = hive_io.Output()
+    for fields in hive_io.iter_rows():
+        output.write_row([fields[0], fields[2]])
+    output.close()
+
+
+def _hive_io_write_rows():
+    output = hive_io.Output()
+    output.write_rows([fields[0], fields[2]]
+                      for fields in hive_io.iter_rows())
+    output.close()
+
+
+def _group_by_hand():
+    prev_user = None
+    num_rows = 0
+    for line in sys.stdin:
+        user = line.rstrip('\n').split('\t')[0]
+        if user != prev_user:
+            if num_rows:
+                print '%s\t%d' % (prev_user, num_rows)
+            num_rows = 0
+        num_rows += 1
+        prev_user = user
+    if num_rows:
+        print '%s\t%d' % (prev_user, num_rows)
+
+
+def _hive_io_group_by_key():
+    output = hive_io.Output()
+    output.write_rows([user, str(len(rows))] for (user, rows) in
+                      hive_io.group_by_key(hive_io.iter_rows()))
+    output.close()
+
+
+_LOOPS = [
+    ('print', _print_loop),
+    ('codecs writer + print', _codecs_print_loop),
+    ('sys.stdout.write', _write_loop),
+    ('hive_io write_row', _hive_io_write_row),
+    ('hive_io write_rows', _hive_io_write_rows),
+    ('group by hand + print', _group_by_hand),
+    ('hive_io group_by_key', _hive_io_group_by_key),
+]
+
+_REDUCERS = [
+    ('video_recommendation', ['video_recommendation_reducer.py']),
+    ('ka_udf rank', ['ka_udf.py', 'rank', '0', '2', 'DESC']),
+    ('ka_udf rank top 1', ['ka_udf.py', 'rank', '0', '2', 'DESC', '1', '1']),
+]
+
+
+def time_process(args, input_filename):
+    """Return the seconds args take to run with input_filename as stdin.
+
+    Their output is read (and thrown away) from a pipe.
+    """
+    with open(input_filename, 'rb') as stdin:
+        start = time.time()
+        process = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE)
+        while process.stdout.read(hive_io.BUFFER_SIZE):
+            pass
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
+        return time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [TSV_FILE]")
+    parser.add_option("-n", "--num_rows", type="int", default=500000,
+                      help="number of rows to make up if there's no file "
+                           "(default %default)")
+    parser.add_option("--loop", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.loop:
+        dict(_LOOPS)[options.loop]()
+        sys.stdout.flush()
+        return
+    if len(args) > 1:
+        parser.error("Specify at most one file")
+
+    if args:
+        filename = args[0]
+    else:
+        fd, filename = tempfile.mkstemp(suffix='.tsv')
+        os.close(fd)
+        write_rows(filename, options.num_rows)
+    try:
+        with open(filename, 'rb') as f:
+            num = sum(1 for _ in f)
+        print "%d rows" % num
+
+        baseline = None
+        for name, _ in _LOOPS:
+            secs = time_process(
+                [sys.executable, os.path.abspath(__file__), '--loop', name],
+                filename)
+            baseline = baseline or secs
+            print "%-24s %9.0f rows/s (%.1fx print)" % (
+                name, num / secs, baseline / secs)
+
+        if args:
+            return  # Not necessarily (user, video, timestamp) rows.
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name, reducer_args in _REDUCERS:
+            secs = time_process(
+                [sys.executable, os.path.join(directory, reducer_args[0])] +
+                reducer_args[1:], filename)
+            print "%-24s %9.0f rows/s" % (name, num / secs)
+    finally:
+        if not args:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import StringIO
+import unittest
+
+import hive_io
+
+
+class HiveIoTest(unittest.TestCase):
+
+    def test_iter_rows(self):
+        input_file = StringIO.StringIO('a\tb\t\\N\nc\t\t\n\nd')
+        self.assertEqual([['a', 'b', '\\N'], ['c', '', ''], [''], ['d']],
+                         list(hive_io.iter_rows(input_file)))
+
+    def test_nulls(self):
+        self.assertEqual(['a', None, ''],
+                         hive_io.nulls_to_none(['a', '\\N', '']))
+        self.assertEqual(None, hive_io.from_hive('\\N'))
+        self.assertEqual('\\N', hive_io.to_hive(None))
+        self.assertEqual('\xc3\xa9', hive_io.to_hive(u'\xe9'))
+        self.assertEqual('12', hive_io.to_hive(12))
+
+    def test_group_by_key(self):
+        rows = [['a', '1', 'x'], ['a', '1', 'y'], ['a', '2', 'z'],
+                ['b', '2', 'w']]
+        self.assertEqual(
+            [('a', rows[:3]), ('b', rows[3:])],
+            list(hive_io.group_by_key(iter(rows))))
+        self.assertEqual(
+            [(('a', '1'), rows[:2]), (('a', '2'), rows[2:3]),
+             (('b', '2'), rows[3:])],
+            list(hive_io.group_by_key(iter(rows), 0, 1)))
+        self.assertEqual([], list(hive_io.group_by_key(iter([]))))
+
+    def test_output(self):
+        output_file = StringIO.StringIO()
+        output = hive_io.Output(output_file, batch_size=2)
+        output.write_row(['a', 'b'])
+        output.write_rows([['c', u'\xe9'], ['d', None, 3], ['e', 'f\xc3\xa9']])
+        output.write_rows([[u'\xe9', 'f\xc3\xa9']])
+        output.write('g\n')
+        self.assertEqual('a\tb\n', output_file.getvalue()[:4])
+        output.close()
+        self.assertEqual('a\tb\n'
+                         'c\t\xc3\xa9\n'
+                         'd\t\\N\t3\n'
+                         'e\tf\xc3\xa9\n'
+                         '\xc3\xa9\tf\xc3\xa9\n'
+                         'g\n', output_file.getvalue())
+        self.assertFalse(output_file.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
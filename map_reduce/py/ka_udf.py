@@ -4,13 +4,18 @@
    ka_udf.py <func_name> <extra args>
    Example:
        python ka_udf.py split topic_string_keys "<tab>" key,title 0
+       python ka_udf.py plan key 'topic_string_keys[<tab>]' '$.author.name'
 """
-import codecs
+import heapq
+import itertools
 import json
+import operator
+import re
 import sys
 import os
-from subprocess import call
-sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+
+sys.path.append(os.path.dirname(__file__))
+import hive_io
 
 
 def split(split_field, delimiter, selected,
@@ -27,30 +32,33 @@ def split(split_field, delimiter, selected,
     if delimiter == '<tab>':
         # Have to do this to get around hive oddness
         delimiter = '\t'
-    for line in sys.stdin:
-        line = line.strip()
-        doc = json.loads(line)
-
-        if split_field not in doc and not split_field_required:
-            continue
-
-        split_f = doc[split_field]
-        exploded = split_f.split(delimiter)
-        selected_fields = []
-        selected_keys = selected.split(",")
-        for key in selected_keys:
-            if key in doc:
-                data = doc[key]
-                selected_fields.append(data)
-            else:
-                selected_fields.append("")
-        if output_json:
-            selected_fields.append(line)
-        f_delim = '\t'
-        selected_str = f_delim.join(selected_fields)
-        for key in exploded:
-            output = "%s\t%s\n" % (key, selected_str)
-            sys.stdout.write(output)
+    selected_keys = selected.split(",")
+
+    def split_rows():
+        for line in hive_io.iter_lines():
+            line = line.strip()
+            doc = json.loads(line)
+
+            if split_field not in doc and not split_field_required:
+                continue
+
+            split_f = doc[split_field]
+            exploded = split_f.split(delimiter)
+            selected_fields = []
+            for key in selected_keys:
+                if key in doc:
+                    data = doc[key]
+                    selected_fields.append(data)
+                else:
+                    selected_fields.append("")
+            if output_json:
+                selected_fields.append(line)
+            for key in exploded:
+                yield [key] + selected_fields
+
+    output = hive_io.Output()
+    output.write_rows(split_rows())
+    output.close()
 
 
 def explode(key_fields, explode_field):
@@ -62,107 +70,297 @@ def explode(key_fields, explode_field):
             def\tghi\t2
             def\tghi\t3
     """
-    for line in sys.stdin:
-        line = line.strip()
-        doc = json.loads(line)
-        exploded = None
-        if explode_field in doc:
-            exploded = doc[explode_field]
-        selected_keys = key_fields.split(",")
-        selected_fields = []
-        for key in selected_keys:
-            if key in doc:
-                data = str(doc[key])
-                selected_fields.append(data)
-            else:
-                selected_fields.append("")
-        f_delim = '\t'
-        selected_str = f_delim.join(selected_fields)
-        if not exploded:
-            continue
-        for value in exploded:
-            output = "%s\t%s\n" % (selected_str, value)
-            sys.stdout.write(output)
-
-
-def rank(key_field_index, rank_field_index, reverse=True, delimiter="\t"):
-    """This reducer takes lines of delimited values that must be already
-    sorted by the values in column <key_field_index>. It ranks within each
-    group by the values in column <rank_field_index>.  The output is the
-    original lines with an additional column for the numerical in-group
-    rank appended as the last column.  Note that the ranks start at 1 for the
-    top value.
+    selected_keys = key_fields.split(",")
+
+    def exploded_rows():
+        for line in hive_io.iter_lines():
+            doc = json.loads(line)
+            exploded = None
+            if explode_field in doc:
+                exploded = doc[explode_field]
+            if not exploded:
+                continue
+            selected_fields = []
+            for key in selected_keys:
+                if key in doc:
+                    data = str(doc[key])
+                    selected_fields.append(data)
+                else:
+                    selected_fields.append("")
+            for value in exploded:
+                yield selected_fields + [value]
+
+    output = hive_io.Output()
+    output.write_rows(exploded_rows())
+    output.close()
+
+
+_PATH_STEP_MATCHER = re.compile(r'\.([^.\[\]]+)|\[([0-9]+)\]')
+
+
+def _parse_path(path):
+    """Return the steps of a "$.a.b[0]" json path, as strings and ints."""
+    steps = []
+    pos = 1
+    while pos < len(path):
+        match = _PATH_STEP_MATCHER.match(path, pos)
+        if not match:
+            raise ValueError("Bad json path %r" % path)
+        name, index = match.groups()
+        steps.append(name if index is None else int(index))
+        pos = match.end()
+    return steps
+
+
+def _get_path(doc, steps):
+    for step in steps:
+        if isinstance(step, int):
+            if not isinstance(doc, list) or step >= len(doc):
+                return None
+        elif not isinstance(doc, dict) or step not in doc:
+            return None
+        doc = doc[step]
+    return doc
+
+
+def _to_field(value):
+    """Return a json value as get_json_object would: strings as they are."""
+    if value is None or isinstance(value, basestring):
+        return value    # hive_io.Output writes None as NULL
+    return json.dumps(value)
+
+
+def _to_fields(values):
+    # json.loads makes all strings unicode, so that's what to check first.
+    return [value if value.__class__ is unicode or value is None
+            else _to_field(value) for value in values]
+
+
+_raw_decode = json.JSONDecoder().raw_decode
+
+
+def _decode(line):
+    """json.loads(line), without the overhead of its wrappers."""
+    try:
+        doc, end = _raw_decode(line)
+    except ValueError:
+        return json.loads(line)     # e.g. leading whitespace; or raises
+    if end != len(line) and line[end:].strip():
+        raise ValueError("Extra data after json: %r" % line)
+    return doc
+
+
+class Plan(object):
+    """A projection of json lines into rows, parsed once for all lines.
+
+    Each column spec says what goes in one column of the output:
+
+        name        the value of the top-level property "name"
+        $.a.b[0]    the value at a json path, like get_json_object takes
+        $           the json line itself
+        spec[]      explodes the list at spec into a row per element
+        spec[DELIM] explodes the string at spec split on DELIM (<tab> for
+                    a tab), like split does
+
+    Strings are output as they are, other values as json, and missing
+    values as NULL.  A line with several exploded columns gets a row per
+    combination of their elements, like several LATERAL VIEWs, and no
+    rows if any of them is missing or empty.
+
+    So one pass can do what used to take a split or explode per field:
+
+        SELECT TRANSFORM(Video.json)
+        USING 'ka_udf.py plan key title "topic_string_keys[<tab>]"'
+        AS vid_key, vid_title, topic_key
     """
-    def process_group(lines):
-        lines.sort(key=lambda l: l[rank_field_index], reverse=reverse)
-        for i, vals in enumerate(lines, start=1):
-            vals.append(str(i))
-            sys.stdout.write("\t".join(vals) + "\n")
 
-    prev_key = None
-    group = []
-    for line in sys.stdin:
-        # Due to hive representing empty values as "\n" line cannot be stripped
-        # However, we assume that the empty value isn't the last one in a row
-        line = line.rstrip().split(delimiter)
-        key = line[key_field_index]
-        if key != prev_key:
-            process_group(group)
-            group = []
+    def __init__(self, column_specs):
+        # A column is the name of a top-level property, or else a function
+        # of the decoded json and the line.
+        self._columns = []
+        self._explodes = []     # (column index, None or split delimiter)
+        for i, spec in enumerate(column_specs):
+            delimiter = None
+            if spec.endswith(']'):
+                start = spec.rfind('[')
+                inside = spec[start + 1:-1]
+                if not inside.isdigit():    # not a path's list index
+                    spec = spec[:start]
+                    if inside:
+                        delimiter = '\t' if inside == '<tab>' else inside
+                    self._explodes.append((i, delimiter))
+            self._columns.append(self._column(spec))
+        if not self._columns:
+            raise ValueError("A plan needs at least one column")
+        self._all_names = all(isinstance(column, basestring)
+                              for column in self._columns)
 
-        group.append(line)
-        prev_key = key
+    @staticmethod
+    def _column(spec):
+        if spec == '$':
+            return lambda doc, line: line
+        if spec.startswith('$.') or spec.startswith('$['):
+            steps = _parse_path(spec)
+            return lambda doc, line: _get_path(doc, steps)
+        if not spec:
+            raise ValueError("Empty column spec")
+        return spec
+
+    def rows(self, line):
+        """Return the rows (lists of fields) the plan makes of a json line."""
+        doc = _decode(line)
+        if self._all_names:
+            values = map(doc.get, self._columns)
+        else:
+            values = [doc.get(column) if isinstance(column, basestring)
+                      else column(doc, line) for column in self._columns]
+        if not self._explodes:
+            return [_to_fields(values)]
+
+        exploded = []
+        for i, delimiter in self._explodes:
+            value = values[i]
+            if delimiter is not None and isinstance(value, basestring):
+                value = value.split(delimiter)
+            elif value is not None and not isinstance(value, list):
+                value = [value]
+            if not value:
+                return []
+            exploded.append(_to_fields(value))
+            values[i] = None
+
+        row = _to_fields(values)
+        if len(exploded) == 1:
+            i = self._explodes[0][0]
+            before, after = row[:i], row[i + 1:]
+            return [before + [value] + after for value in exploded[0]]
+        rows = []
+        indexes = [i for (i, _) in self._explodes]
+        for combination in itertools.product(*exploded):
+            for i, value in itertools.izip(indexes, combination):
+                row[i] = value
+            rows.append(row[:])
+        return rows
+
+
+def plan(compiled_plan):
+    """Output the rows a Plan makes of each json line of stdin."""
+    rows = compiled_plan.rows
+
+    def planned_rows():
+        for line in hive_io.iter_lines():
+            for row in rows(line):
+                yield row
+
+    output = hive_io.Output()
+    output.write_rows(planned_rows())
+    output.close()
 
-    process_group(group)
+
+def _numeric_key(value, reverse=False):
+    """Sort key for numeric values: numbers by value, before other strings.
+
+    Other strings (like \\N) rank after the numbers whichever way they're
+    sorted, so pass the reverse the key is sorted with.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    if number is None or number != number:     # not a number, or NaN
+        return (-1 if reverse else 1, value)
+    return (0, number)
+
+
+def rank_rows(rows, key_field_index, rank_field_index, reverse=True,
+              numeric=False, top_k=None):
+    """Yields the rows of each key group in rank order, with their rank.
+
+    rows must be clustered by the field at key_field_index.  Rows with
+    equal rank fields keep their input order.  If top_k is given, only
+    the first top_k rows of each group are yielded, and only they are
+    ever held in memory (with a heap); otherwise whole groups are sorted.
+    """
+    key = operator.itemgetter(key_field_index)
+    if numeric:
+        sort_key = lambda row: _numeric_key(row[rank_field_index], reverse)
+    else:
+        sort_key = operator.itemgetter(rank_field_index)
+    select_top = heapq.nlargest if reverse else heapq.nsmallest
+
+    for _, group in itertools.groupby(rows, key):
+        if top_k is None:
+            group = sorted(group, key=sort_key, reverse=reverse)
+        else:
+            # The same rows, in the same order, as sorted(...)[:top_k].
+            group = select_top(top_k, group, key=sort_key)
+        for i, row in enumerate(group, start=1):
+            row.append(str(i))
+            yield row
+
+
+def rank(key_field_index, rank_field_index, reverse=True, delimiter="\t",
+         numeric=False, top_k=None):
+    """This reducer takes lines of delimited values that must be already
+    sorted by the values in column <key_field_index>. It ranks within each
+    group by the values in column <rank_field_index>, compared as strings,
+    or as numbers if numeric is True (with values that aren't numbers, like
+    NULL, ranked last).  The output is the original lines
+    with an additional column for the numerical in-group rank appended as
+    the last column.  Note that the ranks start at 1 for the top value.
+    If top_k is given, only lines ranked top_k or better are output,
+    without holding the rest of a group in memory.
+    """
+    output = hive_io.Output()
+    output.write_rows(rank_rows(hive_io.iter_rows(delimiter=delimiter),
+                                key_field_index, rank_field_index, reverse,
+                                numeric, top_k))
+    output.close()
 
 
 def ip_to_country(ip_field_index, delimiter="\t"):
     """This reducer takes lines of delimited values with an ip address string
     in column <ip_field_index>.  It outputs the same lines while appending
-    a new column that contains the country code, or "NULL" if the country
-    can't be determined.
+    new columns for the city, region, country code, country name, latitude
+    and longitude, or "null" if they can't be determined.
 
-    NOTE: the hive caller must ADD FILE for both pygeoip
-        module and the database.
+    NOTE: the hive caller must ADD FILE pygeoip.py, geoip_ranges.py and
+        the GeoLiteCity.dat database.
     """
-    # Move pygeoip files to pygeoip subdirectory in current working direcotry
-    # TODO(robert): ADD ARCHIVE should perform what code below does,
-    #   however, I didn't manage to make it work
-    workDir = os.path.dirname(__file__) + "/"
-    files = ["__init__.py", "timezone.py", "util.py", "const.py"]
-    modDir = workDir + "/pygeoip"
-    fullPathFiles = map(lambda f: workDir + f, files)
-    call(["mkdir", "-p", modDir])
-    call(["mv"] + fullPathFiles + [modDir])
-
-    sys.path.append(workDir)
     import pygeoip
+    import geoip_ranges
 
     geo_ip = pygeoip.GeoIP("GeoLiteCity.dat", pygeoip.MEMORY_CACHE)
+    ranges = geoip_ranges.GeoIPRanges(geo_ip)
 
-    for line in sys.stdin:
-        line = line.rstrip().split(delimiter)
-        ip = line[ip_field_index]
-        record = geo_ip.record_by_addr(ip)
-
+    def location(record):
+        if not record:
+            return ["null"] * 6
         # Python tries reading the strings using ascii encoding
         # Since the names of cities and regions can have characters
         #   beyond ascii we need to tell it to use geo ip encoding set.
-        line.append(record["city"].decode(
-            pygeoip.const.ENCODING) if "city" in record else "null")
-        line.append(
-            record["region_name"].decode(
-                pygeoip.const.ENCODING) if "region_name" in record else "null")
-        line.append(
-            record["country_code"] if "country_code" in record else "null")
-        line.append(
-            record["country_name"] if "country_name" in record else "null")
-        line.append(str(
-            record["latitude"]) if "latitude" in record else "null")
-        line.append(str(
-            record["longitude"]) if "longitude" in record else "null")
-
-        sys.stdout.write("\t".join(line) + "\n")
+        return [record["city"].decode(pygeoip.ENCODING),
+                record["region_name"].decode(pygeoip.ENCODING),
+                record["country_code"],
+                record["country_name"],
+                str(record["latitude"]),
+                str(record["longitude"])]
+
+    def located_rows():
+        rows = hive_io.iter_rows(delimiter=delimiter)
+        while True:
+            batch = list(itertools.islice(rows, geoip_ranges.BATCH_SIZE))
+            if not batch:
+                return
+            records = ranges.records_by_addrs(
+                [line[ip_field_index] for line in batch])
+            for line, record in itertools.izip(batch, records):
+                line.extend(location(record))
+                yield line
+
+    output = hive_io.Output()
+    output.write_rows(located_rows())
+    output.close()
 
 
 def main():
@@ -195,13 +393,33 @@ def main():
         explode(sys.argv[2], sys.argv[3])
         exit(0)
 
+    if sys.argv[1] == "plan":
+        plan_usage_str = ("Usage: ka_udf.py plan <column_spec> ...\n"
+            "  column_spec: name, $.json.path[0], $ (the json), "
+            "or any of these + [] or [<delim>] to explode it")
+        if len(sys.argv) < 3:
+            print >> sys.stderr, plan_usage_str
+            exit(1)
+        try:
+            compiled = Plan(sys.argv[2:])
+        except ValueError as e:
+            print >> sys.stderr, e
+            print >> sys.stderr, plan_usage_str
+            exit(1)
+        plan(compiled)
+        exit(0)
+
     if sys.argv[1] == "rank":
         rank_usage_str = ("Usage: ka_udf.py rank " +
-                "<key_field_index> <rank_field_index> <ASC|DESC>")
-        if len(sys.argv) != 5:
+                "<key_field_index> <rank_field_index> <ASC|DESC>"
+                " [numeric: 0 or 1] [top_k]")
+        if len(sys.argv) < 5 or len(sys.argv) > 7:
             print >> sys.stderr, rank_usage_str
             exit(1)
-        rank(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4] == "DESC")
+        numeric = len(sys.argv) > 5 and bool(int(sys.argv[5]))
+        top_k = int(sys.argv[6]) if len(sys.argv) > 6 else None
+        rank(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4] == "DESC",
+             numeric=numeric, top_k=top_k)
         exit(0)
 
     if sys.argv[1] == "ip_to_country":
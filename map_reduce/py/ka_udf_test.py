@@ -0,0 +1,79 @@
+import json
+import unittest
+
+import ka_udf
+
+
+class PlanTest(unittest.TestCase):
+
+    def assertPlanRows(self, expected_rows, column_specs, doc):
+        self.assertEqual(expected_rows, list(
+            ka_udf.Plan(column_specs).rows(json.dumps(doc))))
+
+    def test_projections(self):
+        doc = {'key': 'k', 'n': 2, 'a': {'b': [{'c': u'\xe9'}, True]}}
+        self.assertPlanRows(
+            [['k', '2', None, u'\xe9', 'true', None,
+              '[{"c": "\\u00e9"}, true]', json.dumps(doc)]],
+            ['key', 'n', 'missing', '$.a.b[0].c', '$.a.b[1]', '$.a.b[2]',
+             '$.a.b', '$'],
+            doc)
+
+    def test_explodes(self):
+        doc = {'key': 'k', 'tags': 'x\ty', 'coaches': ['a', 'b'], 'none': []}
+        self.assertPlanRows([['k', 'x'], ['k', 'y']],
+                            ['key', 'tags[<tab>]'], doc)
+        self.assertPlanRows([['a', 'k', 'x'], ['a', 'k', 'y'],
+                             ['b', 'k', 'x'], ['b', 'k', 'y']],
+                            ['coaches[]', 'key', 'tags[<tab>]'], doc)
+        self.assertPlanRows([], ['key', 'coaches[]', 'none[]'], doc)
+        self.assertPlanRows([], ['key', 'missing[,]'], doc)
+        self.assertPlanRows([['k', 'k']], ['key', 'key[]'], doc)
+
+    def test_bad_specs(self):
+        self.assertRaises(ValueError, ka_udf.Plan, [])
+        self.assertRaises(ValueError, ka_udf.Plan, ['[]'])
+        self.assertRaises(ValueError, ka_udf.Plan, ['$.a..b'])
+
+
+class RankTest(unittest.TestCase):
+
+    def rank(self, rows, **kwargs):
+        return list(ka_udf.rank_rows([row[:] for row in rows], 0, 1, **kwargs))
+
+    def test_rank(self):
+        rows = [['a', '9', 'x'], ['a', '10', 'y'], ['a', '9', 'z'],
+                ['b', 'n', 'w'], ['b', '1', 'v']]
+        self.assertEqual([['a', '9', 'x', '1'], ['a', '9', 'z', '2'],
+                          ['a', '10', 'y', '3'], ['b', 'n', 'w', '1'],
+                          ['b', '1', 'v', '2']],
+                         self.rank(rows))
+        self.assertEqual([['a', '10', 'y', '1'], ['a', '9', 'x', '2'],
+                          ['a', '9', 'z', '3'], ['b', '1', 'v', '1'],
+                          ['b', 'n', 'w', '2']],
+                         self.rank(rows, numeric=True))
+        self.assertEqual([['a', '9', 'x', '1'], ['a', '9', 'z', '2'],
+                          ['b', '1', 'v', '1'], ['b', 'n', 'w', '2']],
+                         self.rank(rows, reverse=False, numeric=True, top_k=2))
+
+    def test_non_numbers_rank_last(self):
+        rows = [['u', '\\N', 'x'], ['u', '5', 'y'], ['u', '', 'z'],
+                ['u', 'nan', 'w'], ['u', '-1', 'v']]
+        for reverse, numbers in ((True, ['5', '-1']), (False, ['-1', '5'])):
+            ranked = self.rank(rows, reverse=reverse, numeric=True)
+            self.assertEqual(numbers, [row[1] for row in ranked[:2]])
+            self.assertEqual(
+                ranked[:1],
+                self.rank(rows, reverse=reverse, numeric=True, top_k=1))
+
+    def test_top_k_is_a_prefix_of_the_full_ranking(self):
+        rows = [[str(i // 10), str(i * 7 % 4)] for i in xrange(100)]
+        for reverse in (True, False):
+            ranked = self.rank(rows, reverse=reverse, numeric=True)
+            self.assertEqual(
+                [row for row in ranked if int(row[-1]) <= 3],
+                self.rank(rows, reverse=reverse, numeric=True, top_k=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,8 +15,11 @@ TODO(yunfang): Consider moving the primary functions here to a library
                as the pb_to_dict process doesn't really happen in hive
 """
 
+import collections
 import datetime
+import itertools
 import json
+import multiprocessing
 import optparse
 import pickle
 import sys
@@ -34,6 +37,12 @@ _serialize_blacklists = {
         "Scratchpad": ['latest_revision_cache'],
         "ScratchpadRevision": ['image_url']}
 
+# Number of entities iter_json_lines converts per unit of work.
+DEFAULT_CHUNK_SIZE = 500
+
+_APPEND_OPCODES = frozenset([pickle.APPEND, pickle.APPENDS])
+_GET_OPCODES = frozenset([pickle.GET, pickle.BINGET, pickle.LONG_BINGET])
+
 
 def get_cmd_line_args():
     parser = optparse.OptionParser(
@@ -44,6 +53,11 @@ def get_cmd_line_args():
                      help="field corresponding to the reducer key")
     parser.add_option("-p", "--parent", default=None,
                      help="including parent key in the json dump")
+    parser.add_option("-j", "--processes", type="int", default=1,
+                     help="number of processes to convert entities with")
+    parser.add_option("-c", "--chunk_size", type="int",
+                     default=DEFAULT_CHUNK_SIZE,
+                     help="number of entities per unit of work and write")
     # TODO(yunfang): Output a warning with unknown args
     options, _ = parser.parse_args()
     return options
@@ -113,14 +127,110 @@ def pre_process_entity_dict(kind, document):
                 del document[prop]
 
 
+def _json_lines_for_chunk(args):
+    """Convert a chunk of protobufs to a string of key<tab>json lines."""
+    pbs, key, parent = args
+    lines = []
+    for pb in pbs:
+        document = pb_to_dict(pb, parent)
+        lines.append("%s\t%s\n" % (document[key], json.dumps(document)))
+    return ''.join(lines)
+
+
+def iter_json_lines(pbs, key, parent=None, processes=1,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the key<tab>json lines for pbs, chunk_size entities at a time.
+
+    Each item yielded is a string holding the lines for one chunk, in the
+    same order as pbs.  If processes is more than 1, chunks are converted
+    on a pool of that many processes, with at most two chunks per process
+    in flight or waiting to be written, so memory use doesn't grow with the
+    number of entities.
+
+    Arguments:
+        pbs: an iterable of protocol buffer strings.
+        key: the document field to output before the tab.
+        parent: whether to include the parent key in the document.
+    """
+    pbs = iter(pbs)
+    chunks = iter(lambda: (list(itertools.islice(pbs, chunk_size)),
+                           key, parent),
+                  ([], key, parent))
+    if processes <= 1:
+        for chunk in chunks:
+            yield _json_lines_for_chunk(chunk)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    in_flight = collections.deque()
+    try:
+        for chunk in chunks:
+            if len(in_flight) >= 2 * processes:
+                yield in_flight.popleft().get()
+            in_flight.append(pool.apply_async(_json_lines_for_chunk,
+                                              (chunk,)))
+        while in_flight:
+            yield in_flight.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class _PickledListUnpickler(pickle.Unpickler):
+    """An Unpickler that yields the items of a pickled list as it goes."""
+
+    def iter_items(self):
+        # This is pickle.Unpickler.load(), except that every time items
+        # are appended to the outermost list they are handed out and
+        # dropped from the list.
+        self.mark = object()
+        self.stack = []
+        self.append = self.stack.append
+        read = self.read
+        dispatch = self.dispatch
+        while True:
+            key = read(1)
+            if key == pickle.STOP:
+                if not isinstance(self.stack[-1], list):
+                    raise pickle.UnpicklingError("Not a pickled list")
+                return
+            try:
+                dispatch[key](self)
+            except KeyError:
+                if key in _GET_OPCODES:
+                    raise pickle.UnpicklingError(
+                        "An item refers to an earlier one")
+                raise
+            if key in _APPEND_OPCODES and len(self.stack) == 1:
+                items = self.stack[0]
+                for item in items:
+                    yield item
+                del items[:]
+                # Don't let the memo keep the items alive either.
+                self.memo = dict((k, v) for k, v in self.memo.iteritems()
+                                 if v is items)
+
+
+def iter_pickled_list(f):
+    """Yields the items of the list pickled to file f one at a time.
+
+    This reads the same files as pickle.load(f), but only holds one batch
+    of items in memory (up to 1000 for pickle.dump(), a page for
+    fetch_entities.PickledListWriter).  Items can't refer to objects in
+    earlier items, which holds for lists of protobuf strings; if one does,
+    pickle.UnpicklingError is raised when it's reached.
+    """
+    return _PickledListUnpickler(f).iter_items()
+
+
 def main():
     """Map step for the protobuf loading. Input is read from stdin."""
     options = get_cmd_line_args()
-    entity_list = pickle.load(sys.stdin)
-    for pb in entity_list:
-        document = pb_to_dict(pb, options.parent)
-        json_str = json.dumps(document)
-        print "%s\t%s" % (document[options.key], json_str)
+    pbs = iter_pickled_list(sys.stdin)
+    for lines in iter_json_lines(pbs, options.key, options.parent,
+                                 options.processes, options.chunk_size):
+        sys.stdout.write(lines)
 
 
 if __name__ == '__main__':
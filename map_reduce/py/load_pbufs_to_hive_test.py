@@ -0,0 +1,43 @@
+import cPickle
+import pickle
+import StringIO
+import unittest
+
+import load_pbufs_to_hive
+
+
+class IterPickledListTest(unittest.TestCase):
+
+    def assertIteratesLikeLoad(self, pickled):
+        self.assertEqual(
+            pickle.loads(pickled),
+            list(load_pbufs_to_hive.iter_pickled_list(
+                StringIO.StringIO(pickled))))
+
+    def test_pickled_lists(self):
+        # More than one APPENDS batch of 1000 items.
+        items = ['pb%d\n\x00\xff' % i for i in xrange(2500)]
+        for protocol in (0, 1, 2):
+            self.assertIteratesLikeLoad(pickle.dumps(items, protocol))
+            self.assertIteratesLikeLoad(cPickle.dumps(items, protocol))
+        self.assertIteratesLikeLoad(pickle.dumps([], 2))
+        self.assertIteratesLikeLoad(pickle.dumps([['a', 'b'], ('c',)], 2))
+
+    def test_items_are_dropped(self):
+        unpickler = load_pbufs_to_hive._PickledListUnpickler(
+            StringIO.StringIO(pickle.dumps(['a%d' % i for i in xrange(10)])))
+        for _ in unpickler.iter_items():
+            self.assertLessEqual(len(unpickler.memo), 2)
+
+    def test_errors(self):
+        self.assertRaises(pickle.UnpicklingError, list,
+            load_pbufs_to_hive.iter_pickled_list(
+                StringIO.StringIO(pickle.dumps({'a': 1}))))
+        # The same object in two APPENDS batches.
+        self.assertRaises(pickle.UnpicklingError, list,
+            load_pbufs_to_hive.iter_pickled_list(
+                StringIO.StringIO(pickle.dumps(['abc' * 3] * 1500, 2))))
+
+
+if __name__ == '__main__':
+    unittest.main()
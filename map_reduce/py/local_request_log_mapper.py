@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Run raw_log_to_request_log_mapper.py locally, on all cores.
+
+For backfills and debugging, this does what the EMR job does to each
+hourly log file, but splits each file into shards and converts them on a
+pool of processes.  Shards are only ever cut just before a request log,
+so app logs stay with the request they follow, and the output is written
+in the same order (and is the same) as running the mapper on each file:
+
+    local_request_log_mapper.py -r route_map_file.json \
+        2013-11-01/*.log.gz > request_logs.tsv
+
+Files ending in .gz are decompressed by a gzip subprocess, so that
+decompression runs on a core of its own.  With no files, stdin is read.
+"""
+
+import collections
+import cStringIO
+import json
+import multiprocessing
+import optparse
+import subprocess
+import sys
+
+import raw_log_to_request_log_mapper as mapper
+
+
+DEFAULT_SHARD_SIZE = 50000  # lines
+
+# The RouteMatcher of each worker process, set by _init_worker.
+_route_matcher = None
+
+
+def _init_worker(route_map_filename):
+    global _route_matcher
+    with open(route_map_filename) as f:
+        route_map = json.load(f)
+    mapper.convert_stats_route_map_strings_to_regexps(route_map)
+    _route_matcher = mapper.RouteMatcher(route_map)
+
+
+def _convert_shard(shard):
+    """Return the mapper's output for a shard (a string of log lines)."""
+    # (Iterating over a cStringIO splits on \n only, like a file does.)
+    return ''.join(line + '\n' for line in mapper.convert_request_logs(
+        cStringIO.StringIO(shard), _route_matcher))
+
+
+def _is_request_log(line):
+    # App logs start with whitespace, and _LOG_MATCHER needs a non-space.
+    return (line and not line[0].isspace() and
+            mapper._LOG_MATCHER.match(line) is not None)
+
+
+def iter_shards(input_file, shard_size=DEFAULT_SHARD_SIZE):
+    """Yields the lines of input_file in strings of about shard_size lines.
+
+    Every shard but the first starts with a request log.
+    """
+    lines = []
+    for line in input_file:
+        if len(lines) >= shard_size and _is_request_log(line):
+            yield ''.join(lines)
+            lines = []
+        lines.append(line)
+    if lines:
+        yield ''.join(lines)
+
+
+def open_log(filename):
+    """Return (file, gzip process or None) for reading a log file."""
+    if filename.endswith('.gz'):
+        process = subprocess.Popen(['gzip', '-dc', filename],
+                                   stdout=subprocess.PIPE, bufsize=-1)
+        return process.stdout, process
+    return open(filename, 'rb'), None
+
+
+def iter_inputs(filenames):
+    """Yields a file object for each file, or stdin if there are none."""
+    if not filenames:
+        yield sys.stdin
+        return
+    for filename in filenames:
+        f, process = open_log(filename)
+        try:
+            yield f
+        finally:
+            f.close()
+            if process and process.wait() != 0:
+                raise IOError('gzip -dc %s failed' % filename)
+
+
+def run(filenames, route_map_filename, output, processes=None,
+        shard_size=DEFAULT_SHARD_SIZE):
+    """Write the mapper's output for the files, in order, to output.
+
+    At most two shards per process are being converted or waiting to be
+    written at a time, so memory use doesn't grow with the input.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (route_map_filename,))
+    in_flight = collections.deque()
+    try:
+        for input_file in iter_inputs(filenames):
+            # Shards of different files are independent: the mapper never
+            # attaches one file's app logs to another file's request.
+            for shard in iter_shards(input_file, shard_size):
+                if len(in_flight) >= 2 * processes:
+                    output.write(in_flight.popleft().get())
+                in_flight.append(pool.apply_async(_convert_shard, (shard,)))
+        while in_flight:
+            output.write(in_flight.popleft().get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [LOG_FILE...]")
+    parser.add_option("-r", "--route_map", default="route_map_file.json",
+                      help="the route map, as fetched from /stats/route_map "
+                           "(default %default)")
+    parser.add_option("-o", "--output",
+                      help="write the output here instead of to stdout")
+    parser.add_option("-j", "--processes", type="int", default=None,
+                      help="number of processes (default: number of CPUs)")
+    parser.add_option("-s", "--shard_size", type="int",
+                      default=DEFAULT_SHARD_SIZE,
+                      help="approximate number of lines per shard "
+                           "(default %default)")
+    options, filenames = parser.parse_args()
+
+    output = open(options.output, 'wb') if options.output else sys.stdout
+    try:
+        run(filenames, options.route_map, output, options.processes,
+            options.shard_size)
+    finally:
+        if options.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import local_request_log_mapper
+import raw_log_to_request_log_mapper as mapper
+import raw_log_to_request_log_mapper_test as mapper_test
+
+
+class LocalRequestLogMapperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.route_map_filename = os.path.join(self.tmpdir, 'route_map.json')
+        with open(self.route_map_filename, 'w') as f:
+            json.dump(mapper_test._ROUTE_MAP, f)
+        self.lines = []
+        for i in xrange(50):
+            self.lines.append('\t0:1 app log before any request\n')
+            self.lines.append(mapper_test._REQUEST_LOGS[i % 5])
+            self.lines.extend(mapper_test._APP_LOGS[:i % 4])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shards_start_with_request_logs(self):
+        shards = list(local_request_log_mapper.iter_shards(self.lines, 7))
+        self.assertEqual(''.join(self.lines), ''.join(shards))
+        self.assertTrue(len(shards) > 1)
+        for shard in shards[1:]:
+            first_line = shard[:shard.index('\n') + 1]
+            self.assertTrue(
+                local_request_log_mapper._is_request_log(first_line))
+
+    def test_same_output_as_mapper(self):
+        filenames = []
+        for i in xrange(2):
+            filenames.append(os.path.join(self.tmpdir, '%d.log' % i))
+            with open(filenames[-1], 'w') as f:
+                f.writelines(self.lines)
+
+        expected = StringIO.StringIO()
+        orig_stdout = sys.stdout
+        sys.stdout = expected
+        try:
+            for filename in filenames:
+                route_map = json.load(open(self.route_map_filename))
+                mapper.convert_stats_route_map_strings_to_regexps(route_map)
+                mapper.main(open(filename), route_map)
+        finally:
+            sys.stdout = orig_stdout
+
+        output = StringIO.StringIO()
+        local_request_log_mapper.run(filenames, self.route_map_filename,
+                                     output, processes=2, shard_size=7)
+        self.assertEqual(expected.getvalue(), output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
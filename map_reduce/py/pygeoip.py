@@ -1459,7 +1459,17 @@ class GeoIP(GeoIPBase):
             dma_code, metro_code, area_code, region_name, time_zone
         @rtype: dict
         """
-        seek_country = self._seek_country(ipnum)
+        return self._get_record_at(self._seek_country(ipnum))
+
+    def _get_record_at(self, seek_country):
+        """
+        Populate location dict for the record _seek_country returned.
+
+        @param seek_country: Offset from _seek_country
+        @type seek_country: int
+        @return: dict, as for _get_record
+        @rtype: dict
+        """
         if seek_country == self._databaseSegments:
             return {}
 
@@ -86,8 +86,12 @@ To test this file locally:
 3. Pipe the uncompressed output of the file into this pything file with:
     cat backends-00\:00\:00Z.log.gz | gzip -d |
     python raw_log_to_request_log_mapper.py | head
+
+To process many log files locally (e.g. for a backfill), use
+local_request_log_mapper.py, which runs this on all cores.
 """
 
+import collections
 import json
 import re
 import sys
@@ -206,6 +210,158 @@ def route_for_url(route_map, url, method):
     return '%s:%s' % (app_yaml_module, regexp)
 
 
+def _url_path(url):
+    """urlparse.urlparse(url).path, without urlparse for the common case."""
+    if not url.startswith('/') or url.startswith('//'):
+        return urlparse.urlparse(url).path
+    for separator in '?#':
+        i = url.find(separator)
+        if i != -1:
+            url = url[:i]
+    # urlparse strips ;params from the last path segment.
+    i = url.find(';', url.rfind('/'))
+    if i != -1:
+        url = url[:i]
+    return url
+
+
+def _literal_prefix(regexp):
+    """Return a string that any url_path regexp.search()es must start with.
+
+    Returns '' if there's no such prefix we can be sure of.
+    """
+    pattern = regexp.pattern
+    if (not pattern.startswith('^') or '|' in pattern or '(?' in pattern or
+            regexp.flags & (re.I | re.M)):
+        return ''
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break   # \d and friends
+            c = pattern[i + 1]
+            i += 2
+        elif c in '.^$*+?{}[]()':
+            break
+        else:
+            i += 1
+        if i < len(pattern) and pattern[i] in '*?{':
+            break   # c is optional
+        prefix.append(c)
+        if i < len(pattern) and pattern[i] == '+':
+            break
+    return ''.join(prefix)
+
+
+class _PrefixIndex(object):
+    """Narrows a list of regexps down to those that could match a path.
+
+    The literal prefixes of the regexps are kept in a trie, so finding the
+    candidates takes one walk down the trie instead of a search() with
+    every regexp.  Candidates are returned in their original order, so
+    the first one that matches is the same one a linear scan would find.
+    """
+
+    def __init__(self, regexps):
+        self._trie = {}
+        self._unprefixed = []
+        for index, regexp in enumerate(regexps):
+            prefix = _literal_prefix(regexp)
+            if not prefix:
+                self._unprefixed.append(index)
+                continue
+            node = self._trie
+            for c in prefix:
+                node = node.setdefault(c, {})
+            node.setdefault(None, []).append(index)
+
+    def candidates(self, path):
+        indexes = list(self._unprefixed)
+        node = self._trie
+        for c in path:
+            node = node.get(c)
+            if node is None:
+                break
+            indexes.extend(node.get(None, ()))
+        indexes.sort()
+        return indexes
+
+
+class _AppYamlRoutes(object):
+    """The wsgi routes of one app.yaml handler, indexed by method."""
+
+    def __init__(self, app_yaml_info):
+        self.module = re.sub(r'\.[^.]+$', '', app_yaml_info[1])
+        self._wsgi_infos = app_yaml_info[2:]
+        self._by_method = {}
+
+    def _routes_for_method(self, method):
+        """Return (_PrefixIndex, [(regexp, route)]) for a method."""
+        if method not in self._by_method:
+            routes = []
+            for wsgi_info in self._wsgi_infos:
+                methods = wsgi_info[2:]
+                if not methods or method in methods:
+                    routes.append((wsgi_info[0], self._route_string(
+                        wsgi_info[0], method)))
+            index = _PrefixIndex([regexp for (regexp, _) in routes])
+            self._by_method[method] = (index, routes)
+        return self._by_method[method]
+
+    def _route_string(self, wsgi_regexp, method):
+        # This must match what route_for_url() returns.
+        regexp = wsgi_regexp.pattern
+        if regexp.startswith('^') and regexp.endswith('$'):
+            regexp = regexp[1:-1]
+        regexp = regexp.replace(r'\/', '/')
+        if method != 'GET':
+            regexp += ' [%s]' % method
+        return '%s:%s' % (self.module, regexp)
+
+    def route(self, url_path, method):
+        index, routes = self._routes_for_method(method)
+        for i in index.candidates(url_path):
+            regexp, route = routes[i]
+            if regexp.search(url_path):
+                return route
+        return url_path
+
+
+class RouteMatcher(object):
+    """A faster route_for_url(), built once from a route map.
+
+    Matching regexps are found through _PrefixIndexes over the app.yaml
+    regexps and over each handler's wsgi regexps for each method, and the
+    routes of the most recently seen (url_path, method)s are cached.
+    """
+
+    def __init__(self, route_map, cache_size=10000):
+        self._app_yaml_regexps = [info[0] for info in route_map]
+        self._app_yaml_index = _PrefixIndex(self._app_yaml_regexps)
+        self._app_yaml_routes = [_AppYamlRoutes(info) for info in route_map]
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    def _route_for_path(self, url_path, method):
+        for i in self._app_yaml_index.candidates(url_path):
+            if self._app_yaml_regexps[i].search(url_path):
+                return self._app_yaml_routes[i].route(url_path, method)
+        return url_path
+
+    def route_for_url(self, url, method):
+        """Same as route_for_url(route_map, url, method)."""
+        key = (_url_path(url), method)
+        route = self._cache.pop(key, None)
+        if route is None:
+            route = self._route_for_path(*key)
+            if len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+        self._cache[key] = route
+        return route
+
+
 def convert_stats_route_map_strings_to_regexps(route_map):
     """Convert re-strings in ka.org/stats/route_map output to re objects."""
     for app_yaml_info in route_map:
@@ -255,8 +411,8 @@ class RequestLogIterator:
                 app_log_lines.append(self.next_line)
 
 
-def main(input_file, route_map):
-    """Print a converted logline for each request logline in input_file.
+def convert_request_logs(input_file, route_matcher):
+    """Yields a converted logline for each request logline in input_file.
 
     Also adds a few derived fields, such as the url_route (the
     wsgi route that this url tickled) and the bingo_id and other key_values
@@ -264,13 +420,8 @@ def main(input_file, route_map):
 
     Arguments:
         input_file: a file containing loglines as taken from appengine.
-        route_map: A list of app-yaml and wsgi-regexps, as returned
-            by route_map.py:generate_route_map(), or by
-            http://www.khanacademy.org/stats/route_map (but with the
-            regexp strings converted to actual regexps).  This is
-            passed as-is to route_for_url().
+        route_matcher: a RouteMatcher, to find the url_route.
     """
-
     for (request_log_line, request_log_match, app_log_lines) in (
          RequestLogIterator(input_file)):
 
@@ -283,28 +434,30 @@ def main(input_file, route_map):
                 'The output to Hive is tab-separated. Field values must not '
                 'contain tabs, but this log does: %s' % request_log_line)
 
-        sorted_fields = [(f, request_log_match.group(f) or '')
-                         for f in _FIELDS_TO_KEEP]
+        # The values of _FIELDS_TO_KEEP, in order.
+        values = [v or '' for v in
+                  request_log_match.group(*_FIELDS_TO_KEEP)]
         # -- Now we add derived fields.
 
         # Map the URL to its route.
-        sorted_fields.append(('url_route',
-                              route_for_url(route_map,
-                                  request_log_match.group('url'),
-                                  request_log_match.group('method'))))
+        values.append(route_matcher.route_for_url(
+            request_log_match.group('url'),
+            request_log_match.group('method')))
 
         # Add the bingo_id and kalog if it exists in the app logs
         for line in app_log_lines:
+            # Most app logs aren't KALOGs, and this is much cheaper than
+            # failing to match _KA_LOG_MATCHER.
+            if 'KALOG;' not in line:
+                continue
             kalog_match = _KA_LOG_MATCHER.match(line)
             if kalog_match:
 
                 # We extract out the bingo_id and unquote it now for ease of
                 # searching the lines by bingo_id (note bingo_ids will still
                 # be put into hive urllib quoted.
-                sorted_fields.append(('bingo_id',
-                                      kalog_match.group("bingo_id")))
-                sorted_fields.append(('kalog',
-                                      kalog_match.group("keyvalues")))
+                values.append(kalog_match.group("bingo_id"))
+                values.append(kalog_match.group("keyvalues"))
 
                 # There seems to be a bug that very occassionally the kalog
                 # line gets duplicated such as on  07/Jan/2013:18:06:09
@@ -313,7 +466,23 @@ def main(input_file, route_map):
                 # which case we will ignore the second one
                 break
 
-        print '\t'.join(v for (k, v) in sorted_fields)
+        yield '\t'.join(values)
+
+
+def main(input_file, route_map):
+    """Print a converted logline for each request logline in input_file.
+
+    Arguments:
+        input_file: a file containing loglines as taken from appengine.
+        route_map: A list of app-yaml and wsgi-regexps, as returned
+            by route_map.py:generate_route_map(), or by
+            http://www.khanacademy.org/stats/route_map (but with the
+            regexp strings converted to actual regexps).  This is
+            used to build a RouteMatcher.
+    """
+    route_matcher = RouteMatcher(route_map)
+    for line in convert_request_logs(input_file, route_matcher):
+        print line
 
 if __name__ == '__main__':
     with open('route_map_file.json') as f:
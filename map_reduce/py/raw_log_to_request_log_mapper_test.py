@@ -0,0 +1,168 @@
+import copy
+import random
+import StringIO
+import sys
+import unittest
+
+import raw_log_to_request_log_mapper as mapper
+
+
+_REQUEST_LOGS = [
+    # From the docstring of raw_log_to_request_log_mapper.
+    ('91.174.232.10 - chris [24/Jul/2012:17:00:09 -0700] "GET '
+     '/assets/images/thumbnails/Rothko-13.jpg HTTP/1.1" 200 572 '
+     '"http://smarthistory.khanacademy.org/" "Mozilla/5.0" '
+     '"smarthistory.khanacademy.org" ms=65 cpu_ms=35 cpm_usd=0.000001 '
+     'pending_ms=0 instance=00c61b117c5f1f26699563074cdd44e841096e '
+     'version=1108-a63aecf373cb '
+     'request_id=00c61b117c5f1f26699563074cdd44e841096e\n'),
+    ('68.202.49.17 - - [29/Oct/2012:17:00:09 -0700] "GET / HTTP/1.1" 200 '
+     '11377 - "Mozilla/5.0 (Windows NT 6.0; WOW64) AppleWebKit/537.4 (KHTML, '
+     'like Gecko) Chrome/22.0.1229.94 Safari/537.4" "www.khanacademy.org" '
+     'ms=200 cpu_ms=103 cpm_usd=0.000001 pending_ms=0 '
+     'instance=00c61b117c4811eae292cd1ee62739468526 '
+     'version=1108-a63aecf373cb '
+     'request_id=00c61b117c5f1f26699563074cdd44e841096e\n'),
+    ('0.1.0.2 - - [31/Jul/2012:17:00:09 -0700] "POST '
+     '/_ah/queue/deferred_problemlog HTTP/1.1" 200 84 '
+     '"http://www.khanacademy.org/api/v1/user/exercises/converting_between_po'
+     'int_slope_and_slope_intercept/problems/1/attempt" "AppEngine-Google; '
+     '(+http://code.google.com/appengine)" "www.khanacademy.org" ms=88 '
+     'cpu_ms=300 cpm_usd=0.000007 queue_name=problem-log-queue '
+     'task_name=10459794276075119660 pending_ms=0 '
+     'instance=00c61b117cca420ac067602b717789e7aec8ca '
+     'version=1108-a63aecf373cb '
+     'request_id=00c61b117c5f1f26699563074cdd44e841096e\n'),
+    ('122.11.36.130 - - [06/Oct/2012:16:00:09 -0700] "GET '
+     '/api/v1/user/topic/precache/addition-subtraction/e/addition_1?casing=ca'
+     'mel HTTP/1.1" 200 2421 '
+     '"http://www.khanacademy.org/math/arithmetic/addition-subtraction/v/basi'
+     'c-addition" "Mozilla/5.0 (iPad; CPU OS 5_1_1 like Mac OS X) '
+     'AppleWebKit/534.46 (KHTML, like Gecko) Version/5.1 Mobile/9B206 '
+     'Safari/7534.48.3" "www.khanacademy.org" ms=263 cpu_ms=415 '
+     'cpm_usd=0.000000 pending_ms=0 '
+     'instance=00c61b117c29add96b8c86824f3be8d9b22d5537 '
+     'version=1108-a63aecf373cb '
+     'request_id=00c61b117c5f1f26699563074cdd44e841096e\n'),
+    ('174.211.15.119 - - [06/Oct/2012:16:00:09 -0700] "GET '
+     '/images/featured-actions/campbells-soup.png HTTP/1.1" 204 154518 '
+     '"http://www.khanacademy.org/" "Mozilla/5.0 (iPhone; CPU iPhone OS '
+     '5_0_1 like Mac OS X) AppleWebKit/534.46 (KHTML, like Gecko) '
+     'Version/5.1 Mobile/9A405 Safari/7534.48.3" "www.khanacademy.org" ms=19 '
+     'cpu_ms=0 cpm_usd=0.000017 pending_ms=0 instance=None '
+     'version=1108-a63aecf373cb '
+     'request_id=00c61b117c5f1f26699563074cdd44e841096e\n'),
+    # Old logs had an api_cpu_ms field.
+    ('1.2.3.4 - - [06/Oct/2012:16:00:09 -0700] "GET / HTTP/1.1" 200 1 - - '
+     '"www.khanacademy.org" ms=19 cpu_ms=0 api_cpu_ms=0 cpm_usd=0.000017 '
+     'pending_ms=0 instance=None version=1108-a63aecf373cb request_id=00c6'),
+    # Escaped quotes, and an empty referer.
+    ('1.2.3.4 - - [06/Oct/2012:16:00:09 -0700] "GET /a HTTP/1.1" 200 1 "" '
+     '"Mozilla \\"5.0\\\\" "www.khanacademy.org" ms=19 cpu_ms=0 '
+     'cpm_usd=0.000017 task_name=5 pending_ms=0 instance=None '
+     'version=1108-a63aecf373cb request_id=00c6\n'),
+]
+
+_APP_LOGS = [
+    '\t0:1356120009.94 some app log\n',
+    ('        0:1356120009.94 '
+     'KALOG;pageload;id.bingo:_gae_bingo_random%3AL4o;\n'),
+    '\t0:1356120009.94 KALOG;pageload;id.bingo:duplicated;\n',
+    '\n',
+]
+
+_ROUTE_MAP = [
+    ['^/_ah/queue/.*', 'queue.main.application',
+     ['^/_ah/queue/deferred.*$', 'deferred', 'POST']],
+    ['^/api/.*', 'api.main.application',
+     ['^/api/v1/user/topic/precache/([^/]+)/e/([^/]+)$', 'precache']],
+    ['.*', 'main.application', ['^/$', 'homepage'], ['^/(.*)/e$', 'ex']],
+]
+
+# Characters that are significant to the regexps.
+_MUTATION_CHARACTERS = ' \t\r\n"\\-[]=;:x0'
+
+
+def _reference_output(lines, route_map):
+    """What main() should print for lines, computed the simple way."""
+    output = []
+    for line, match, app_log_lines in mapper.RequestLogIterator(lines):
+        if match is None:
+            continue
+        if '\t' in line:
+            raise RuntimeError('tab')
+        values = [match.group(f) or '' for f in mapper._FIELDS_TO_KEEP]
+        values.append(mapper.route_for_url(route_map, match.group('url'),
+                                           match.group('method')))
+        for app_log_line in app_log_lines:
+            kalog_match = mapper._KA_LOG_MATCHER.match(app_log_line)
+            if kalog_match:
+                values.append(kalog_match.group('bingo_id'))
+                values.append(kalog_match.group('keyvalues'))
+                break
+        output.append('\t'.join(values) + '\n')
+    return ''.join(output)
+
+
+class MapperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.route_map = copy.deepcopy(_ROUTE_MAP)
+        mapper.convert_stats_route_map_strings_to_regexps(self.route_map)
+        self.orig_stdout = sys.stdout
+
+    def tearDown(self):
+        sys.stdout = self.orig_stdout
+
+    def run_mapper(self, lines):
+        sys.stdout = StringIO.StringIO()
+        try:
+            mapper.main(lines, self.route_map)
+            return sys.stdout.getvalue()
+        except RuntimeError:
+            return RuntimeError
+        finally:
+            sys.stdout = self.orig_stdout
+
+    def assert_same_as_reference(self, lines):
+        try:
+            expected = _reference_output(lines, self.route_map)
+        except RuntimeError:
+            expected = RuntimeError
+        self.assertEqual(expected, self.run_mapper(lines),
+                         'Different output for %r' % lines)
+
+    def test_logs(self):
+        lines = []
+        for request_log in _REQUEST_LOGS:
+            lines.append(request_log.rstrip('\n') + '\n')
+            lines.extend(_APP_LOGS)
+        output = self.run_mapper(lines)
+        self.assertEqual(len(_REQUEST_LOGS), len(output.splitlines()))
+        self.assertEqual(len(_REQUEST_LOGS), output.count('L4o\tpageload;'))
+        self.assert_same_as_reference(lines)
+
+    def test_mutated_logs(self):
+        rand = random.Random(4)
+        for _ in xrange(5000):
+            lines = [rand.choice(_REQUEST_LOGS).rstrip('\n') + '\n',
+                     rand.choice(_APP_LOGS),
+                     rand.choice(_REQUEST_LOGS).rstrip('\n') + '\n',
+                     rand.choice(_APP_LOGS)]
+            for _ in xrange(rand.randint(1, 3)):
+                line_index = rand.randrange(len(lines))
+                mutated = list(lines[line_index])
+                i = rand.randrange(len(mutated) + 1)
+                action = rand.random()
+                if action < 0.3 and i < len(mutated):
+                    del mutated[i]
+                elif action < 0.6 and i < len(mutated):
+                    mutated[i] = rand.choice(_MUTATION_CHARACTERS)
+                else:
+                    mutated.insert(i, rand.choice(_MUTATION_CHARACTERS))
+                lines[line_index] = ''.join(mutated)
+            self.assert_same_as_reference(lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
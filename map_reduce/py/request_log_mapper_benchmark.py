@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Benchmark raw_log_to_request_log_mapper on real logs.
+
+Takes a route map and a log file, as described in the docstring of
+raw_log_to_request_log_mapper.py, e.g.
+
+    request_log_mapper_benchmark.py route_map_file.json \
+        backends-00:00:00Z.log.gz
+
+and reports how fast main() processes the log, and how fast
+route_for_url() and RouteMatcher route the requests in it, and how many
+urls they disagree on.  Any disagreement is a bug in RouteMatcher.
+"""
+
+import gzip
+import json
+import optparse
+import sys
+import time
+
+import raw_log_to_request_log_mapper as mapper
+
+
+def read_lines(log_filename):
+    if log_filename.endswith('.gz'):
+        f = gzip.open(log_filename, 'rb')
+    else:
+        f = open(log_filename, 'rb')
+    with f:
+        return f.readlines()
+
+
+class _NullOutput(object):
+    def write(self, data):
+        pass
+
+
+def benchmark_mapper(lines, route_map):
+    """Print how fast main() processes the lines."""
+    stdout = sys.stdout
+    sys.stdout = _NullOutput()
+    try:
+        start = time.time()
+        mapper.main(lines, route_map)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+    print "%d lines. main() %.0f lines/s" % (len(lines), len(lines) / elapsed)
+
+
+def read_requests(lines):
+    """Return the (url, method) of every request log line."""
+    requests = []
+    for line in lines:
+        match = mapper._LOG_MATCHER.match(line)
+        if match:
+            requests.append((match.group('url'), match.group('method')))
+    return requests
+
+
+def time_routing(route, requests):
+    """Return (seconds taken, routes) for routing all the requests."""
+    start = time.time()
+    routes = [route(url, method) for (url, method) in requests]
+    return time.time() - start, routes
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="%prog [options] ROUTE_MAP_FILE LOG_FILE")
+    parser.add_option("-s", "--cache_size", type="int", default=10000,
+                      help="size of RouteMatcher's cache")
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Specify a route map and a log file")
+
+    with open(args[0]) as f:
+        route_map = json.load(f)
+    mapper.convert_stats_route_map_strings_to_regexps(route_map)
+    lines = read_lines(args[1])
+    benchmark_mapper(lines, route_map)
+    requests = read_requests(lines)
+    if not requests:
+        print "%s: no request logs" % args[1]
+        return
+
+    slow_secs, slow_routes = time_routing(
+        lambda url, method: mapper.route_for_url(route_map, url, method),
+        requests)
+    start = time.time()
+    matcher = mapper.RouteMatcher(route_map, cache_size=options.cache_size)
+    build_secs = time.time() - start
+    fast_secs, fast_routes = time_routing(matcher.route_for_url, requests)
+
+    mismatches = 0
+    for (url, method), slow, fast in zip(requests, slow_routes, fast_routes):
+        if slow != fast:
+            if not mismatches:
+                print >>sys.stderr, "First mismatch: %s %s\n%s\n%s" % (
+                    method, url, slow, fast)
+            mismatches += 1
+
+    num = len(requests)
+    print ("%d requests. route_for_url %.0f/s, RouteMatcher %.0f/s (%.1fx, "
+           "plus %.3fs to build), %d mismatches" % (
+               num, num / slow_secs, num / fast_secs, slow_secs / fast_secs,
+               build_secs, mismatches))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,12 @@ and group and normalize for custom reducer functions.
 
 
 import json
+import os
 import sys
 
+sys.path.append(os.path.dirname(__file__))
+import hive_io
+
 
 def parse_user_topic_input(callback):
     """Takes input from stdin -- exercise attempts done in topic mode clustered
@@ -24,6 +28,18 @@ def parse_user_topic_input(callback):
         user_segment - group(s) that the user is a member of for dashboard
             comparison purposes (eg. A/B test experiments, has coach, etc.)
     """
+    for attempts, user_topic, user_segment in iter_user_topic_input():
+        callback(attempts, user_topic, user_segment)
+
+
+def iter_user_topic_input(input_file=None):
+    """Yields the (attempts, user_topic, user_segment) arguments that
+    parse_user_topic_input() would call its callback with, for the rows of
+    input_file (default stdin).
+
+    Reducers that yield their output rows can write them all with one
+    hive_io.Output.write_rows(), which is faster than printing them.
+    """
 
     def should_skip(attempts):
         """Whether the reducer should not be called.
@@ -37,29 +53,15 @@ def parse_user_topic_input(callback):
         #     in stacklogs or something.
         return not attempts or attempts[0][1] != 1
 
-    prev_user_segment = None
-    prev_user_topic = None
-    attempts = []
-
-    for line in sys.stdin:
-        (user, topic, exercise, time_done, time_taken, problem_number, correct,
-                scheduler_info, user_segment, dt) = line.rstrip().split('\t')
-
-        user_topic = (user, topic)
-        if user_topic != prev_user_topic:
-            # We're getting a new user-topic, so perform the reduce operation
-            # on our previous group of user-topics
-            if not should_skip(attempts):
-                callback(attempts, prev_user_topic, prev_user_segment)
-            attempts = []
-
-        correct = correct == 'true'
-        problem_number = int(problem_number)
-        scheduler_info = json.loads(scheduler_info)
-        attempts.append((correct, problem_number, scheduler_info))
-
-        prev_user_topic = user_topic
-        prev_user_segment = user_segment
+    rows = hive_io.iter_rows(input_file)
+    for user_topic, group in hive_io.group_by_key(rows, 0, 1):
+        attempts = []
+        for (user, topic, exercise, time_done, time_taken, problem_number,
+                correct, scheduler_info, user_segment, dt) in group:
+            correct = correct == 'true'
+            problem_number = int(problem_number)
+            scheduler_info = json.loads(scheduler_info)
+            attempts.append((correct, problem_number, scheduler_info))
 
-    if not should_skip(attempts):
-        callback(attempts, prev_user_topic, prev_user_segment)
+        if not should_skip(attempts):
+            yield attempts, user_topic, user_segment
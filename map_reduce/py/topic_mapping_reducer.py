@@ -17,17 +17,20 @@ Output format:
 
 
 import json
+import os
 import sys
 
+sys.path.append(os.path.dirname(__file__))
+import hive_io
+
 
 def main():
     topics_map = {}
     ancestor_lookup_errors = 0
     # Load all the topics to the topic_map
-    for line in sys.stdin:
-        line = line.strip()
-        (key, topic_json) = line.split('\t')
+    for (key, topic_json) in hive_io.iter_rows():
         topics_map[key] = json.loads(topic_json)
+    output = hive_io.Output()
     # Go through topics_map and output the ones with any ancestor keys
     for topic_key, topic_dict in topics_map.iteritems():
         if 'ancestor_keys' in topic_dict:
@@ -44,13 +47,11 @@ def main():
             ancestor_titles.append(topic_title)
             ancestor_keys_str = json.dumps({'keys': ancestors})
             ancestor_title_str = json.dumps({'titles': ancestor_titles})
-            s = u"%s\t%s\t%s\t%s" % (topic_key, topic_title,
-                                      ancestor_keys_str, ancestor_title_str)
-
-            # some titles, like L'Hopitals rule use non-ASCII characters.
-            # Not UTF-8 encoding can throw "UnicodeEncodeError: 'ascii' codec
-            # can't encode character u'\xf4' in position..".
-            print s.encode("UTF-8")
+            # some titles, like L'Hopitals rule use non-ASCII characters,
+            # which Output writes as UTF-8.
+            output.write_row([topic_key, topic_title,
+                              ancestor_keys_str, ancestor_title_str])
+    output.close()
     print >>sys.stderr, "%d ancestor lookup errors." % ancestor_lookup_errors
 
 if __name__ == '__main__':
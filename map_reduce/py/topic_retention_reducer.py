@@ -14,6 +14,7 @@ import os.path
 # Add the directory where table_parser.py is to the Python path.
 sys.path.append(os.path.dirname(__file__))
 
+import hive_io
 import table_parser
 
 
@@ -40,9 +41,16 @@ def emit_topic_retention(attempts, user_topic, user_segment):
     # Output retention stats by card number
     # TODO(david): Output time taken buckets
     for i, attempt in enumerate(attempts, 1):
-        print '%s\t%s\t%s\t%s\t%s\t%s' % (topic, user_segment,
-                is_randomized(attempt[2]), "card_number", i, int(attempt[0]))
+        yield [topic, user_segment, is_randomized(attempt[2]),
+               "card_number", str(i), str(int(attempt[0]))]
+
+
+def main():
+    output = hive_io.Output()
+    output.write_rows(row for args in table_parser.iter_user_topic_input()
+                      for row in emit_topic_retention(*args))
+    output.close()
 
 
 if __name__ == '__main__':
-    table_parser.parse_user_topic_input(emit_topic_retention)
+    main()
@@ -13,8 +13,12 @@ computes three time series:  joins, deactivations, and reactivations.
 """
 
 import datetime
+import os
 import sys
 
+sys.path.append(os.path.dirname(__file__))
+import hive_io
+
 g_err_late_join = 0
 # start_dt and end_dt define the date range for which to output data.
 # end_dt defines the as-of date of the ouput, which is necessary to
@@ -32,17 +36,19 @@ WINDOW_LEN = 28
 
 
 def emit_data_point(dt, series, value):
+    """Yields the (dt, series, value) row if dt is in range."""
     if dt >= g_start_dt and dt < g_end_dt:
-        print "%s\t%s\t%s" % (dt, series, str(value))
+        yield [dt, series, str(value)]
 
 
 def emit_deactivation(last_date):
     deactivation_date = last_date + datetime.timedelta(days=WINDOW_LEN)
     deactivation_dt = deactivation_date.strftime('%Y-%m-%d')
-    emit_data_point(deactivation_dt, 'deactivations', 1)
+    return emit_data_point(deactivation_dt, 'deactivations', 1)
 
 
 def emit_delta_series(activity):
+    """Yields the output rows for a user's activity."""
     global g_err_late_join
 
     # Loop through daily activity (assume it's sorted by dt)
@@ -51,7 +57,8 @@ def emit_delta_series(activity):
         user, dt, joined = act
 
         if joined == 'true':
-            emit_data_point(dt, 'joins', 1)
+            for row in emit_data_point(dt, 'joins', 1):
+                yield row
             if last_date:
                 # I would not expect the join to be set on any but the
                 # first day of activity.  Double check that.
@@ -61,16 +68,27 @@ def emit_delta_series(activity):
 
         if last_date and (curr_date - last_date).days > WINDOW_LEN:
             # emit a deactivation and a re-activation
-            emit_deactivation(last_date)
+            for row in emit_deactivation(last_date):
+                yield row
 
-            emit_data_point(dt, 'reactivations', 1)
+            for row in emit_data_point(dt, 'reactivations', 1):
+                yield row
 
         last_date = curr_date
 
     # make sure to emit a deactivation if the stream ends with inactivity
     end_date = datetime.datetime.strptime(g_end_dt, '%Y-%m-%d')
     if last_date and (end_date - last_date).days > WINDOW_LEN:
-        emit_deactivation(last_date)
+        for row in emit_deactivation(last_date):
+            yield row
+
+
+def emit_user_growth(rows):
+    """Yields the output rows for the input rows of all users."""
+    rows = (row for row in rows if row[0])  # skip blank users
+    for _, activity in hive_io.group_by_key(rows):
+        for row in emit_delta_series(activity):
+            yield row
 
 
 def main():
@@ -82,28 +100,9 @@ def main():
     global g_start_dt, g_end_dt
     g_start_dt, g_end_dt = sys.argv[1:3]
 
-    prev_user = None
-    activity = []
-
-    for line in sys.stdin:
-        day_activity = tuple(line.rstrip('\n').split('\t'))
-
-        user = day_activity[0]
-
-        if not user:
-            continue  # blank user
-
-        if user != prev_user:
-            # We're getting a new user, so perform the reduce operation
-            # on the current user's activity sequence
-            emit_delta_series(activity)
-            activity = []
-
-        prev_user = user
-
-        activity.append(day_activity)
-
-    emit_delta_series(activity)
+    output = hive_io.Output()
+    output.write_rows(emit_user_growth(hive_io.iter_rows()))
+    output.close()
 
     print >>sys.stderr, "Finished main. %d late join errors." % g_err_late_join
 
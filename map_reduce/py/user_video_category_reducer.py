@@ -13,8 +13,12 @@ Ouput format:
 
 import json
 import optparse
+import os
 import sys
 
+sys.path.append(os.path.dirname(__file__))
+import hive_io
+
 
 def get_cmd_line_args():
     parser = optparse.OptionParser(
@@ -41,27 +45,24 @@ def main():
 
     for v in options.values.split(','):
         val_fields.append(int(v))
-    user = None
-    user_dict = {}
-    for line in sys.stdin:
-        data = line.strip().split('\t')
-        current_user = data[0]
-        if current_user != user and user != None:
-            json_string = json.dumps(user_dict)
-            print "%s\t%s" % (user, json_string)
+
+    def user_rows():
+        for user, rows in hive_io.group_by_key(hive_io.iter_rows()):
             user_dict = {}
-        user = current_user
-        keys = []
-        values = []
-        for k in key_fields:
-            keys.append(data[k])
-        for v in val_fields:
-            values.append(data[v])
-        key = '_'.join(keys).lower().replace(' ', '_')
-        user_dict[key] = values
+            for data in rows:
+                keys = []
+                values = []
+                for k in key_fields:
+                    keys.append(data[k])
+                for v in val_fields:
+                    values.append(data[v])
+                key = '_'.join(keys).lower().replace(' ', '_')
+                user_dict[key] = values
+            yield [user, json.dumps(user_dict)]
 
-    json_string = json.dumps(user_dict)
-    print "%s\t%s" % (user, json_string)
+    output = hive_io.Output()
+    output.write_rows(user_rows())
+    output.close()
 
 
 if __name__ == '__main__':
@@ -28,8 +28,12 @@ video_j's score after having watched video_i.
 
 import heapq
 import math
+import os
 import sys
 
+sys.path.append(os.path.dirname(__file__))
+import hive_io
+
 
 # Default separator between column values.
 DELIMITER = '\t'
@@ -44,19 +48,18 @@ _OUT = sys.stdout
 
 
 def emit_best_pairs(video_key, scored_pairs):
-    """Emit a video and its computed best pairs of videos.
+    """Return the rows for a video and its computed best pairs of videos.
     Arguments:
         video_key - a string for the video key these pairs belong to
         scored_pairs - a list of [vid1, vid2, score] values
     """
     if not video_key:
-        return
+        return []
 
     best_pairs = heapq.nlargest(NUM_BEST,
                                 scored_pairs,
                                 key=lambda scored_pair: scored_pair[2])
-    for vid1, vid2, score in best_pairs:
-        _OUT.write(DELIMITER.join([vid1, vid2, str(score)]) + '\n')
+    return [[vid1, vid2, str(score)] for vid1, vid2, score in best_pairs]
 
 
 def compute_score(preceed_count, succeed_count, video1_count, video2_count):
@@ -64,17 +67,12 @@ def compute_score(preceed_count, succeed_count, video1_count, video2_count):
             (math.sqrt(video1_count) * math.sqrt(video2_count)))
 
 
-def main():
+def prune(rows):
+    """Yields the best pairs rows for the matrix entry rows."""
     last_video = None
     scored_pairs = []
 
-    for line in _IN:
-        if not line:
-            # EOF
-            break
-
-        parts = line.rstrip().split(DELIMITER)
-
+    for parts in rows:
         if len(parts) != 6:
             # TODO(benkomalo): error handling.
             continue
@@ -94,7 +92,8 @@ def main():
             continue
 
         if last_video != vid1_key:
-            emit_best_pairs(last_video, scored_pairs)
+            for row in emit_best_pairs(last_video, scored_pairs):
+                yield row
             scored_pairs = []
 
         # TODO(benkomalo): do we have to re-normalize after pruning?
@@ -103,7 +102,14 @@ def main():
         scored_pairs.append([vid1_key, vid2_key, score])
         last_video = vid1_key
 
-    emit_best_pairs(last_video, scored_pairs)
+    for row in emit_best_pairs(last_video, scored_pairs):
+        yield row
+
+
+def main():
+    output = hive_io.Output(_OUT)
+    output.write_rows(prune(hive_io.iter_rows(_IN, DELIMITER)))
+    output.flush()
 
 
 if __name__ == '__main__':
@@ -32,25 +32,28 @@ https://sites.google.com/a/khanacademy.org/forge/technical/data_n/collaborative-
 
 
 import itertools
+import os
 import sys
 
+sys.path.append(os.path.dirname(__file__))
+import hive_io
+
 
 _out = sys.stdout  # For testing purposes
 _in = sys.stdin  # For testing purposes
 
 
 def output_tab_delimited(s1, s2, i1, i2):
-    """Write given strs and ints to outfile specified above (tab-delimited), 2x
+    """Return the rows for the given strs and ints, 2x
     (the second time, we change order, as necessary for output to be correct.)
 
     """
-    _out.write("%s\t%s\t%d\t%d\n" % (s1, s2, i1, i2))
-    _out.write("%s\t%s\t%d\t%d\n" % (s2, s1, i2, i1))
+    return [[s1, s2, str(i1), str(i2)], [s2, s1, str(i2), str(i1)]]
 
 
 def emit_reducer_output(videos):
     """Given all videos a user watched (list of tuples of (video, timestamp)),
-    output the 4-tuples for that user, as defined above.
+    yield the 4-tuple rows for that user, as defined above.
 
     """
     for (vid_i, vid_j) in itertools.combinations(videos, 2):
@@ -58,23 +61,21 @@ def emit_reducer_output(videos):
             i_before_j = 1
         else:
             i_before_j = 0
-        output_tab_delimited(vid_i[0], vid_j[0], i_before_j, 1 - i_before_j)
+        for row in output_tab_delimited(vid_i[0], vid_j[0],
+                                        i_before_j, 1 - i_before_j):
+            yield row
 
 
-def main():
-    """Get the input, aggregate all videos and timestamps for each user,
-    and pass that to the function that emits it in correct format.
+def reduce_videos(rows):
+    """Aggregate all videos and timestamps for each user, and yield the
+    output rows for them.
 
     """
     # Initialize so we can use it later
     last_user = None
     videos = []
 
-    for line in _in:
-        if not line:
-            continue
-
-        line = line.rstrip().split("\t")
+    for line in rows:
         if len(line) != 3:
             sys.stderr.write("Malformed input: '%s'!\n" % "\t".join(line))
             return
@@ -84,11 +85,22 @@ def main():
         if last_user == user:
             videos.append((video, timestamp))
         else:
-            emit_reducer_output(videos)  # If len(videos) <= 1, this is no-op
+            # If len(videos) <= 1, this is no-op
+            for row in emit_reducer_output(videos):
+                yield row
             videos = [(video, timestamp)]
         last_user = user
 
-    emit_reducer_output(videos)  # Make sure we emit for the last user
+    # Make sure we emit for the last user
+    for row in emit_reducer_output(videos):
+        yield row
+
+
+def main():
+    """Get the input, and write the output rows for it in correct format."""
+    output = hive_io.Output(_out)
+    output.write_rows(reduce_videos(hive_io.iter_rows(_in)))
+    output.flush()
 
 if __name__ == '__main__':
     main()
@@ -31,7 +31,10 @@ sha1s = {}  # stores the most recent sha1 for content
 err_count = khan_ex_count = perseus_count = sha1_tosses = unicode_err = 0
 
 loader = entity_loader.EntityLoader()
-for log in loader.entities("ProblemLog", end_date, begin_date, limit=None):
+logs = loader.entities("ProblemLog", end_date, begin_date, limit=None,
+                       fields=['attempts', 'seed', 'exercise', 'problem_type',
+                               'sha1'])
+for log in logs:
     data = log.get('json')
 
     # Data validation
@@ -12,7 +12,10 @@ This script parses out these lines from the logfile and does some ad-hoc
 analysis on them.
 """
 
+import array
+import collections
 import gzip
+import itertools
 import optparse
 import re
 import sys
@@ -67,23 +70,109 @@ def _key_prefix(key):
     return _KEY_PREFIX_RE.sub(lambda m: m.group(1) + '...', key)
 
 
+class MemcacheLineStore(object):
+    """Every memcache line in the logs, stored a column at a time.
+
+    There are hundreds of thousands of memcache lines, and memory is the
+    bottleneck, so rather than an object (or even a tuple) per line, we
+    keep one typed array per field, and store each distinct command and
+    key just once.  Line i of the store is:
+       time_t[i]: the time_t of the memcache access
+       command[i]: index into commands: get, set, get_multi, etc
+       key[i]: index into keys: the memcache key
+       success[i]: for get-like commands, 1 if it succeeded and 0 if it
+          failed; -1 for all other commands
+       value_size[i]: for set-like commands, sizeof(value); 4 for
+          incr/decr/offset_multi (appengine stores them as ints); else 0
+       expires[i]: for set-like commands, when the set expires; else 0
+
+    The analyses below make a pass over a column or two at a time.  The
+    lines of each WebRequest are contiguous in the store.
+    """
+    def __init__(self):
+        self.time_t = array.array('d')
+        self.command = array.array('B')
+        self.key = array.array('l')
+        self.success = array.array('b')
+        self.value_size = array.array('l')
+        self.expires = array.array('l')
+        self.commands = []
+        self.keys = []
+        self._command_ids = {}
+        self._key_ids = {}
+        self._key_prefixes = None
+        self._time_order = (None, None)
+
+    def __len__(self):
+        return len(self.time_t)
+
+    @staticmethod
+    def _intern(value, values, ids):
+        """Return the index of value in values, adding it if need be."""
+        value_id = ids.get(value)
+        if value_id is None:
+            value_id = ids[value] = len(values)
+            values.append(value)
+        return value_id
+
+    def append(self, time_t, command, key, success, num_bytes, expires):
+        self.time_t.append(time_t)
+        self.command.append(self._intern(command, self.commands,
+                                         self._command_ids))
+        self.key.append(self._intern(key, self.keys, self._key_ids))
+        if command in WebRequest.GETLIKE_COMMANDS:
+            self.success.append(1 if success else 0)
+        else:
+            self.success.append(-1)
+        if command in WebRequest.SETLIKE_COMMANDS:
+            self.value_size.append(num_bytes)
+            self.expires.append(expires)
+        else:
+            self.value_size.append(
+                4 if command in ('incr', 'decr', 'offset_multi') else 0)
+            self.expires.append(0)
+
+    def command_ids(self, commands):
+        """Return the set of ids of those of commands seen in the logs."""
+        return set(self._command_ids[c] for c in commands
+                   if c in self._command_ids)
+
+    def key_prefixes(self):
+        """Return a list of the key-prefix of each key, indexed by key id."""
+        if self._key_prefixes is None or (len(self._key_prefixes) !=
+                                          len(self.keys)):
+            prefix_ids = {}
+            prefixes = []
+            # Intern the prefixes, since many keys share each of them.
+            self._key_prefixes = [
+                prefixes[self._intern(_key_prefix(k), prefixes, prefix_ids)]
+                for k in self.keys]
+        return self._key_prefixes
+
+    def time_order(self, requests):
+        """Return the indices of the requests' memcache lines, by time."""
+        if self._time_order[0] is not requests:
+            order = [i for r in requests
+                     for i in xrange(r.first_line, r.end_line)]
+            # This sort is stable, like the sort of memcache lines used to
+            # be, so lines with the same time_t stay in request order.
+            order.sort(key=self.time_t.__getitem__)
+            self._time_order = (requests, array.array('l', order))
+        return self._time_order[1]
+
+
 class WebRequest(object):
     """Holds information about a single webserver request."""
-    def __init__(self):
+    __slots__ = ('url', 'time_t', 'store', 'first_line', 'end_line')
+
+    def __init__(self, store):
         self.url = None
         self.time_t = None
-        # Each memcache line is a tuple (I'd like to store it as an
-        # object, but there's too much overhead).  The tuple is
-        # (
-        # 0: time_t of request,
-        # 1: command: get, set, get_multi, etc,
-        # 2: memcache key,
-        # 3 <for get/getlike requests>: did the get request succeed or fail,
-        # 3 <for set/setlike requests>: sizeof(value),
-        # 4 <for set/setlike requests>: when a set expires,
-        # )
-        # TODO(csilvers): instead of using a tuple, use a class + __slots__.
-        self.memcache_line_tuples = []
+        # The memcache lines of this request are lines
+        # [first_line, end_line) of store, a MemcacheLineStore.
+        self.store = store
+        self.first_line = len(store)
+        self.end_line = self.first_line
 
     # incr/decr/offset_multi are here because of what is logged for them,
     # even though they add more like 'replace' and other 'set' commands.
@@ -94,45 +183,42 @@ class WebRequest(object):
 
     def add_memcache_line(self,
                           time_t, command, key, success, num_bytes, expires):
-        if command in self.GETLIKE_COMMANDS:
-            tup = (time_t, command, key, success)
-        elif command in self.SETLIKE_COMMANDS:
-            tup = (time_t, command, key, num_bytes, expires)
-        else:
-            tup = (time_t, command, key)
-        self.memcache_line_tuples.append(tup)
+        assert self.end_line == len(self.store), 'Lines must be contiguous'
+        self.store.append(time_t, command, key, success, num_bytes, expires)
+        self.end_line += 1
 
     def memcache_lines(self):
         """All the request's memcache loglines, as ParsedMemcacheLine's."""
         # While it's too expensive, memory-wise, to store all memcache
-        # lines in the logs as ParsedMemcacheLine objects (the
-        # overhead for an object vs a tuple is very high, and there
-        # are hundreds of thousands of these), it's not too expensive
-        # to store just the memcache lines for a single request as a
-        # ParsedMemcacheLine: there are only a dozen-ish of them, at
-        # most.  Having the object makes it much easier to reason
-        # about memcache lines in the analysis functions below.
-        return [ParsedMemcacheLine(t) for t in self.memcache_line_tuples]
+        # lines in the logs as ParsedMemcacheLine objects (there are
+        # hundreds of thousands of these), it's not too expensive to
+        # create them for just the memcache lines of a single request:
+        # there are only a dozen-ish of them, at most.
+        return [ParsedMemcacheLine(self.store, i)
+                for i in xrange(self.first_line, self.end_line)]
 
     def has_memcache_lines(self):
-        return self.memcache_line_tuples
+        return self.end_line > self.first_line
 
 
 class ParsedMemcacheLine(object):
-    def __init__(self, memcache_line_tuple):
-        """memcache_line_tuple is in the format described in WebRequest."""
-        self.time_t = memcache_line_tuple[0]
-        self.command = memcache_line_tuple[1]
-        self.key = memcache_line_tuple[2]
+    __slots__ = ('time_t', 'command', 'key', 'success', 'value_size',
+                 'expires')
+
+    def __init__(self, store, i):
+        """A view of line i of store, a MemcacheLineStore."""
+        self.time_t = store.time_t[i]
+        self.command = store.commands[store.command[i]]
+        self.key = store.keys[store.key[i]]
 
         self.success = None
         self.value_size = None
         self.expires = None
-        if self.command in WebRequest.GETLIKE_COMMANDS:
-            self.success = memcache_line_tuple[3]
+        if store.success[i] != -1:
+            self.success = store.success[i] == 1
         if self.command in WebRequest.SETLIKE_COMMANDS:
-            self.value_size = memcache_line_tuple[3]
-            self.expires = memcache_line_tuple[4]
+            self.value_size = store.value_size[i]
+            self.expires = store.expires[i]
         # For incr/decr/offset commands, appengine stores them as ints.
         if self.command in ('incr', 'decr', 'offset_multi'):
             self.value_size = 4   # size of an int, more or less
@@ -144,13 +230,11 @@ class ParsedMemcacheLine(object):
         # because WebRequest cares about the format in which the
         # memcache line is logged, while we care about the semantics
         # of the command.
-        return self.command in ('set', 'set_multi', 'add', 'add_multi',
-                                'replace', 'replace_multi',
-                                'incr', 'decr', 'offset_multi')
+        return self.command in SETTING_COMMANDS
 
     def does_get(self):
         """Whether the command retrieves a value from the cache."""
-        return self.command in ('get', 'get_multi')
+        return self.command in GETTING_COMMANDS
 
     def is_successful_get(self):
         """True if this was a 'get' request and it succeeded."""
@@ -166,6 +250,13 @@ class ParsedMemcacheLine(object):
         return _key_prefix(self.key)
 
 
+# The commands for which ParsedMemcacheLine.does_set()/does_get() is True.
+SETTING_COMMANDS = ('set', 'set_multi', 'add', 'add_multi',
+                    'replace', 'replace_multi',
+                    'incr', 'decr', 'offset_multi')
+GETTING_COMMANDS = ('get', 'get_multi')
+
+
 def _extract_digits(s):
     """Returns the digits from s, throwing away everything else."""
     if s is None:
@@ -193,12 +284,14 @@ def read_logs(filenames, ignore_before=None):
     Returns:
        A tuple (list of WebRequest objects, number-of-non-memcache-requests).
        The list of Request objects holds those web requests that caused
-       at least one memcache access.  For all other requests, we don't
-       store the request, but we do count it, and return that total count
-       as the second argument of the return value.  NOTE: number-of-non-
+       at least one memcache access.  They share one MemcacheLineStore.
+       For all other requests, we don't store the request, but we do
+       count it, and return that total count as the second argument of
+       the return value.  NOTE: number-of-non-
        memcache-requests doesn't interact with ignore_before, so that
        number may be high if ignore_before is set.
     """
+    store = MemcacheLineStore()
     requests = []
     num_non_memcache_requests = [0]   # list to work inside the closure below
     num_records = [0]                 # for logging
@@ -233,7 +326,7 @@ def read_logs(filenames, ignore_before=None):
                 m = _REQUEST_LINE_RE.match(line)
                 if m:
                     _save_request(current_request)
-                    current_request = WebRequest()
+                    current_request = WebRequest(store)
                     current_request.time_t = time.mktime(time.strptime(
                         m.group('time'), _REQUEST_LINE_DATE_FORMAT))
                     current_request.url = m.group('url')
@@ -277,23 +370,26 @@ def read_logs(filenames, ignore_before=None):
     return (requests, num_non_memcache_requests[0])
 
 
-# To make subsequent calls to memcache-lines faster.
-_g_memcache_line_tuples_cache = {}   # key is the tuple of requests
-
-
 def memcache_lines(requests):
     """Give the memcache lines in order, when you don't care about requests."""
-    if requests in _g_memcache_line_tuples_cache:
-        all_memcache_tuples = _g_memcache_line_tuples_cache[requests]
-    else:
-        all_memcache_tuples = []
-        for request in requests:
-            all_memcache_tuples.extend(request.memcache_line_tuples)
-        all_memcache_tuples.sort(key=lambda tup: tup[0])  # sort by time-t
-        _g_memcache_line_tuples_cache[requests] = tuple(all_memcache_tuples)
+    if not requests:
+        return
+    store = requests[0].store
+    for i in store.time_order(requests):
+        yield ParsedMemcacheLine(store, i)
 
-    for tup in all_memcache_tuples:
-        yield ParsedMemcacheLine(tup)
+
+def memcache_columns(requests):
+    """Like memcache_lines, but for making passes over store columns.
+
+    Returns:
+       The MemcacheLineStore of the requests, and an array of the indices
+       of the requests' memcache lines in it, in time order.
+    """
+    if not requests:
+        return (MemcacheLineStore(), array.array('l'))
+    store = requests[0].store
+    return (store, store.time_order(requests))
 
 
 def _incr(m, k, delta=1):
@@ -356,17 +452,17 @@ def run(func):
 @run
 def print_distribution(requests):
     """Print the distribution of memcache operations."""
-    counts = {}
-    num_success = 0   # for get requests
-    num_fail = 0
-    for memcache_line in memcache_lines(requests):
-        _incr(counts, memcache_line.command)
-
-        # Also keep track of how many get's succeeded vs failed
-        if memcache_line.is_successful_get():
-            num_success += 1
-        elif memcache_line.is_failed_get():
-            num_fail += 1
+    (store, order) = memcache_columns(requests)
+    command_id_counts = collections.Counter(
+        itertools.imap(store.command.__getitem__, order))
+    counts = dict((store.commands[command_id], count)
+                  for (command_id, count) in command_id_counts.iteritems())
+
+    # Also keep track of how many get's succeeded vs failed
+    success_counts = collections.Counter(
+        itertools.imap(store.success.__getitem__, order))
+    num_success = success_counts[1]   # for get requests
+    num_fail = success_counts[0]
 
     print_header('DISTRIBUTION OF MEMCACHE REQUEST TYPES',
                  'The types are "get", "set", etc.')
@@ -382,10 +478,13 @@ def print_distribution(requests):
 @run
 def print_is_failed_gets(requests):
     """For each key-prefix, print how many times a 'get' on it failed."""
+    (store, order) = memcache_columns(requests)
+    (key, success) = (store.key, store.success)
+    key_prefixes = store.key_prefixes()
     counts = {}
-    for memcache_line in memcache_lines(requests):
-        if memcache_line.is_failed_get():
-            _incr(counts, memcache_line.key_prefix())
+    for i in order:
+        if success[i] == 0:     # a failed get
+            _incr(counts, key_prefixes[key[i]])
 
     print_header('FAILED GETS',
                  'The number of times we did a memcache "get" for this\n'
@@ -400,17 +499,19 @@ def print_memcache_access_pattern_per_http_request(requests):
     total_fail = 0
     total_success = 0
 
+    (store, _) = memcache_columns(requests)
+    setting_command_ids = store.command_ids(SETTING_COMMANDS)
+
     for request in requests:
-        num_fail = 0
-        num_success = 0
-        num_set = 0
-        for memcache_line in request.memcache_lines():
-            if memcache_line.is_successful_get():
-                num_success += 1
-            elif memcache_line.is_failed_get():
-                num_fail += 1
-            elif memcache_line.does_set():
-                num_set += 1
+        lines = slice(request.first_line, request.end_line)
+        success = store.success[lines]
+        num_fail = success.count(0)
+        num_success = success.count(1)
+        # (incr and the like can set, but they count as gets here.)
+        num_set = sum(1 for (command_id, succeeded)
+                      in itertools.izip(store.command[lines], success)
+                      if succeeded == -1 and
+                      command_id in setting_command_ids)
         _incr(count, (num_fail, num_set, num_success))
         if num_set and num_fail:
             total_fail += 1
@@ -437,15 +538,19 @@ def print_memcache_access_pattern_per_http_request(requests):
 @run
 def print_evicted_gets(requests):
     """For each key-prefix, print how many times a get-after-set failed."""
-    set_keys = set()
+    (store, order) = memcache_columns(requests)
+    (command, key, success) = (store.command, store.key, store.success)
+    setting_command_ids = store.command_ids(SETTING_COMMANDS)
+    key_prefixes = store.key_prefixes()
+    set_key_ids = set()
     evicted_key_prefix_count = {}
 
-    for memcache_line in memcache_lines(requests):
-        if memcache_line.does_set():
-            set_keys.add(memcache_line.key)
-        elif (memcache_line.is_failed_get() and     # failed get request
-              memcache_line.key in set_keys):       # and is after a set
-            _incr(evicted_key_prefix_count, memcache_line.key_prefix())
+    for i in order:
+        if command[i] in setting_command_ids:
+            set_key_ids.add(key[i])
+        elif (success[i] == 0 and                 # failed get request
+              key[i] in set_key_ids):             # and is after a set
+            _incr(evicted_key_prefix_count, key_prefixes[key[i]])
 
     print_header('EVICTED GETS',
                  'The number of times we did a memcache "get" for this\n'
@@ -459,11 +564,13 @@ def print_evicted_gets(requests):
 @run
 def print_most_gets(requests):
     """Print the 10 keys we do the most successful lookups of."""
+    (store, order) = memcache_columns(requests)
+    (key, success) = (store.key, store.success)
     is_successful_get_count = {}
 
-    for memcache_line in memcache_lines(requests):
-        if memcache_line.is_successful_get():
-            _incr(is_successful_get_count, memcache_line.key)
+    for i in order:
+        if success[i] == 1:
+            _incr(is_successful_get_count, store.keys[key[i]])
 
     print_header('MOST GETS',
                  'The 10 keys with the most successful "gets".\n'
@@ -474,16 +581,21 @@ def print_most_gets(requests):
 @run
 def print_set_but_never_get(requests):
     """Print info about keys we set in the memcache and never look up."""
+    (store, order) = memcache_columns(requests)
+    (command, key) = (store.command, store.key)
+    setting_command_ids = store.command_ids(SETTING_COMMANDS)
+    getting_command_ids = store.command_ids(GETTING_COMMANDS)
     set_but_not_get_keys = set()
     set_and_get_keys = set()
 
-    for memcache_line in memcache_lines(requests):
-        if memcache_line.does_set():
-            set_but_not_get_keys.add(memcache_line.key)
-        elif memcache_line.does_get():
-            if memcache_line.key in set_but_not_get_keys:
-                set_but_not_get_keys.discard(memcache_line.key)
-                set_and_get_keys.add(memcache_line.key)
+    for i in order:
+        if command[i] in setting_command_ids:
+            set_but_not_get_keys.add(store.keys[key[i]])
+        elif command[i] in getting_command_ids:
+            k = store.keys[key[i]]
+            if k in set_but_not_get_keys:
+                set_but_not_get_keys.discard(k)
+                set_and_get_keys.add(k)
 
     set_no_get_count = {}
     for k in set_but_not_get_keys:
@@ -515,17 +627,21 @@ def print_set_but_never_get(requests):
 @run
 def print_get_but_never_set(requests):
     """Print keys we successfully get but never set."""
-    set_keys = set()
+    (store, order) = memcache_columns(requests)
+    (command, key, success) = (store.command, store.key, store.success)
+    setting_command_ids = store.command_ids(SETTING_COMMANDS)
+    key_prefixes = store.key_prefixes()
+    set_key_ids = set()
     get_but_not_set_count = {}
     get_but_not_set_times = set()
 
-    for memcache_line in memcache_lines(requests):
-        if memcache_line.does_set():
-            set_keys.add(memcache_line.key)
-        elif (memcache_line.is_successful_get() and
-              memcache_line.key not in set_keys):   # ...but no previous set
-            _incr(get_but_not_set_count, memcache_line.key_prefix())
-            get_but_not_set_times.add(memcache_line.time_t)
+    for i in order:
+        if command[i] in setting_command_ids:
+            set_key_ids.add(key[i])
+        elif (success[i] == 1 and
+              key[i] not in set_key_ids):           # ...but no previous set
+            _incr(get_but_not_set_count, key_prefixes[key[i]])
+            get_but_not_set_times.add(store.time_t[i])
 
     print_header('GET WITHOUT PREVIOUS SET',
                  'Keys that had a successful get, but we never saw a set.\n'
@@ -545,15 +661,20 @@ def print_space_usage(requests):
     """Print info on which keys take up how much space in the cache."""
     # The problem here is keys being inserted multiple times.
     # We only count the size taken by the last one.
+    (store, order) = memcache_columns(requests)
+    (command, key, success) = (store.command, store.key, store.success)
+    setting_command_ids = store.command_ids(SETTING_COMMANDS)
     key_sizes = {}    # value here is (size, True-if-present/False-if-evicted)
-    for memcache_line in memcache_lines(requests):
-        if memcache_line.does_set():
-            entry_size = len(memcache_line.key) + memcache_line.value_size
-            key_sizes[memcache_line.key] = [entry_size, True]
-        elif (memcache_line.is_failed_get() and       # get request tha failed
-              memcache_line.key in key_sizes):        # but we'd seen a set
-            # This key looks to have been evicted, so set the value-bool.
-            key_sizes[memcache_line.key][1] = False
+    for i in order:
+        if command[i] in setting_command_ids:
+            k = store.keys[key[i]]
+            entry_size = len(k) + store.value_size[i]
+            key_sizes[k] = [entry_size, True]
+        elif success[i] == 0:                         # get request tha failed
+            k = store.keys[key[i]]
+            if k in key_sizes:                        # but we'd seen a set
+                # This key looks to have been evicted, so set the value-bool.
+                key_sizes[k][1] = False
 
     key_prefix_sizes = {}
     total = 0
@@ -614,7 +735,9 @@ def main(logfiles, ignore_before=None):
     print num_non_memcache_requests
 
     if requests:
-        requests = tuple(requests)      # needed so they can be a hash key
+        # Every analysis gets this same tuple, so the store's time_order
+        # (cached by the identity of requests) is only computed once.
+        requests = tuple(requests)
         for fn in g_analyses_to_run:    # set via the @run decorator
             fn(requests)
 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""Per-date, per-kind manifests of the archives gae_download.py writes.
+
+Each {archive_dir}/{date}/{kind} directory gets a MANIFEST file listing
+the archive files in it, one json object per line:
+
+    {"file": "ProblemLog-...json.gz", "format": "json", "rows": 1234,
+     "bytes": 567890, "min_backup_timestamp": 1375315200.0,
+     "max_backup_timestamp": 1375315499.9}
+
+gae_download.py appends an entry as it saves each file.  Download slices
+run in parallel processes, so entries are appended with a single write
+to a file opened with O_APPEND, which keeps concurrent appends from
+interleaving.  A file that is downloaded again gets a new entry; the last
+entry for a file wins.
+
+EntityLoader uses the entries' timestamp ranges to skip files that can't
+match a query.  Files in the directory that aren't in the manifest (from
+before there was one, or from back_populate.py) are always read.
+
+To write manifests for directories that were downloaded before there
+were manifests, run:
+
+    archive_manifest.py DIR...
+"""
+
+import bz2
+import gzip
+import json
+import optparse
+import os
+import sys
+
+import columnar_archive
+
+
+MANIFEST_FILENAME = 'MANIFEST'
+
+# The formats of archive files, by the extension that precedes the
+# compression extension (if any).
+FORMATS = ('pickle', 'json', 'cols')
+
+
+def file_format(filename):
+    """Return the format of an archive file name, or None."""
+    parts = filename.split('.')
+    if parts[-1] in ('gz', 'bz2'):
+        parts.pop()
+    if len(parts) > 1 and parts[-1] in FORMATS:
+        return parts[-1]
+    return None
+
+
+def _stem(filename):
+    """The file name without its format and compression extensions."""
+    return filename[:filename.rindex('.' + file_format(filename))]
+
+
+def make_entry(filename, rows, min_timestamp, max_timestamp):
+    return {
+        'file': os.path.basename(filename),
+        'format': file_format(filename),
+        'rows': rows,
+        'bytes': os.path.getsize(filename),
+        'min_backup_timestamp': min_timestamp,
+        'max_backup_timestamp': max_timestamp,
+    }
+
+
+def append_entries(dirname, entries):
+    """Append manifest entries to dirname's manifest."""
+    data = ''.join(json.dumps(entry) + '\n' for entry in entries)
+    fd = os.open(os.path.join(dirname, MANIFEST_FILENAME),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def read_manifest(dirname):
+    """Return {file name: entry} for dirname, or None if it has no manifest.
+
+    A truncated last line (from a writer that died mid-write) is ignored.
+    """
+    try:
+        f = open(os.path.join(dirname, MANIFEST_FILENAME))
+    except IOError:
+        return None
+    entries = {}
+    with f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['file']] = entry
+    return entries
+
+
+def _json_file_stats(filename):
+    """Return (rows, min backup_timestamp, max backup_timestamp)."""
+    if filename.endswith('.gz'):
+        f = gzip.open(filename, 'rb')
+    elif filename.endswith('.bz2'):
+        f = bz2.BZ2File(filename, 'rb')
+    else:
+        f = open(filename, 'rb')
+    rows = 0
+    timestamps = []
+    with f:
+        for line in f:
+            rows += 1
+            doc = json.loads(line.split('\t', 1)[1])
+            if doc.get('backup_timestamp') is not None:
+                timestamps.append(doc['backup_timestamp'])
+    if not timestamps:
+        return rows, None, None
+    return rows, min(timestamps), max(timestamps)
+
+
+def _columnar_file_stats(filename):
+    with open(filename, 'rb') as f:
+        reader = columnar_archive.ColumnarReader(f)
+        minimums = []
+        maximums = []
+        for group in reader.row_groups:
+            column = group['columns'].get('backup_timestamp')
+            if column and column['min'] is not None:
+                minimums.append(column['min'])
+                maximums.append(column['max'])
+        return (reader.num_rows, min(minimums) if minimums else None,
+                max(maximums) if maximums else None)
+
+
+def rebuild_manifest(dirname):
+    """Write a manifest for dirname by reading the archives in it.
+
+    Files with the same name but different formats hold the same
+    entities, so only one of them (json or cols) needs to be read.
+    Returns the number of entries written.
+    """
+    stats = {}
+    filenames = sorted(f for f in os.listdir(dirname) if file_format(f))
+    for filename in filenames:
+        stem = _stem(filename)
+        path = os.path.join(dirname, filename)
+        if stem not in stats:
+            if file_format(filename) == 'json':
+                stats[stem] = _json_file_stats(path)
+            elif file_format(filename) == 'cols':
+                stats[stem] = _columnar_file_stats(path)
+
+    entries = []
+    for filename in filenames:
+        rows, min_timestamp, max_timestamp = stats.get(
+            _stem(filename), (None, None, None))
+        entries.append(make_entry(os.path.join(dirname, filename),
+                                  rows, min_timestamp, max_timestamp))
+
+    tmp_filename = os.path.join(dirname, MANIFEST_FILENAME + '.tmp')
+    with open(tmp_filename, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    os.rename(tmp_filename, os.path.join(dirname, MANIFEST_FILENAME))
+    return len(entries)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog DIR...",
+        description="Write the manifests of archive directories (like "
+                    "archive/2013-08-01/ProblemLog) from their contents.")
+    _, dirnames = parser.parse_args()
+    if not dirnames:
+        parser.error("Specify at least one directory")
+    for dirname in dirnames:
+        num_entries = rebuild_manifest(dirname)
+        print >>sys.stderr, "Wrote %d entries to %s" % (
+            num_entries, os.path.join(dirname, MANIFEST_FILENAME))
+
+
+if __name__ == '__main__':
+    main()
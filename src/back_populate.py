@@ -1,16 +1,25 @@
 #!/usr/bin/env python
-"""One time script to back populate ProblemLog and VideoLog pickle files"""
+"""One time script to back populate ProblemLog and VideoLog pickle files
+
+Each pickle.gz archive listed is converted to the key<tab>json .json.gz
+archive that gae_download.py writes alongside it.
+"""
 
-import datetime as dt
 import time
 import gzip
-import pickle
+import os
 import re
+import sys
 
 from optparse import OptionParser
-from multiprocessing import Process, active_children
+from multiprocessing import Process, active_children, cpu_count
+
+import gae_util
+gae_util.fix_sys_path()
+
+sys.path.append(os.path.dirname(__file__) + "/../map_reduce/py")
+import load_pbufs_to_hive
 
-import gae_download
 import util
 
 
@@ -18,7 +27,7 @@ g_logger = util.get_logger()
 
 def get_cmd_line_args():
     parser = OptionParser(usage="%prog [options]",
-        description="Back populate data to mongo")
+        description="Back populate json archives from pickle archives")
     parser.add_option("-c", "--config", 
         help="json config same as gae_download ")
     parser.add_option("-f", "--file_list", 
@@ -34,16 +43,23 @@ def get_cmd_line_args():
             "Please specify the file that contains list of pickle files") 
         exit(1)
     return options
-def gz_pickle_to_mongo(config, gzfile):
-    mongo = gae_download.open_db_conn(config)
-    (year, month, day)  = re.match(r'.*(\d{4})-(\d{2})-(\d{2})', gzfile).groups()
-    start_dt = dt.datetime(int(year), int(month), int(day))
-    end_dt = start_dt + dt.timedelta(days=1)
-    f = gzip.open(gzfile, "rb") 
-    entity_list = pickle.load(f)
-    f.close()
-    g_logger.info("Loading %s entries to db" % len(entity_list))
-    gae_download.load_pbufs_to_db(config, mongo, entity_list, start_dt, end_dt) 
+def gz_pickle_to_json(config, gzfile):
+    """Convert a {kind}-....pickle.gz archive to {kind}-....json.gz."""
+    # gae_download.get_archive_file_name strips leading underscores off of
+    # the kinds in file names, e.g. for _GAEBingoIdentityRecord.
+    kinds = dict((re.sub(r'^_*', '', kind), kind) for kind in config['kinds'])
+    kind = kinds[os.path.basename(gzfile).split('-')[0]]
+    json_key = config['kinds'][kind][4]
+    json_file = gzfile.replace('.pickle.gz', '.json.gz')
+    g_logger.info("Converting %s to %s" % (gzfile, json_file))
+    # Share the cores between the files being converted at once.
+    processes = max(1, cpu_count() // config['max_threads'])
+    with gzip.open(gzfile, "rb") as pickle_f:
+        with gzip.open(json_file, "wb") as f:
+            for lines in load_pbufs_to_hive.iter_json_lines(
+                    load_pbufs_to_hive.iter_pickled_list(pickle_f),
+                    json_key, processes=processes):
+                f.write(lines)
 def monitor(config, processes): 
     """Monitor the concurrent processes"""
     remaining = [] 
@@ -62,7 +78,6 @@ def main():
     config = util.load_unstripped_json(options.config)
     #hard code some args
     config['max_threads'] = 2
-    config['coordinator_cfg']['control_db'] = "ka_backpopulate_cntrl"
     config["sub_process_time_out"] = 86400*3
     with open(options.file_list) as f:
         file_list = f.readlines()
@@ -71,7 +86,7 @@ def main():
         while True:
             if len(active_children()) < config['max_threads']:         
                g_logger.info("Starting loading %s ...", gzfile)
-               p = Process(target = gz_pickle_to_mongo,
+               p = Process(target = gz_pickle_to_json,
                            args = (config, gzfile.strip()))
                processes.append((p, gzfile.strip(), time.time()))
                p.start()
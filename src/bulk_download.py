@@ -137,10 +137,13 @@ def jsonify_downloaded_file(kind, config):
     cursor = sqlite_conn.cursor()
     cursor.execute(sqlstring)
     f = open(json_filename, 'wb')
-    for unused_entity_id, pb in cursor:
-        doc = load_pbufs_to_hive.pb_to_dict(pb, parent=True)
-        json_str = json.dumps(doc)
-        print >>f, "%s\t%s" % (doc['key'], json_str)
+    # sqlite returns blobs as buffers, which can't be sent to other
+    # processes, so turn them into strings.
+    pbs = (str(pb) for unused_entity_id, pb in cursor)
+    for lines in load_pbufs_to_hive.iter_json_lines(
+            pbs, 'key', parent=True,
+            processes=config.get('json_processes', 1)):
+        f.write(lines)
     f.close()
     sqlite_conn.close()
 
@@ -0,0 +1,301 @@
+"""Compressed, columnar archives of entity documents.
+
+gae_download.py can write one of these per (kind, interval) next to the
+key<tab>json archive.  Each top-level field of the documents is stored as
+its own typed, zlib-compressed column, in row groups of a few thousand
+documents, with min/max/null-count statistics per column per row group.
+Readers only decompress the columns they ask for, can skip whole row
+groups using the statistics, and never decode JSON for scalar fields.
+
+File layout:
+    MAGIC
+    column chunks, row group after row group
+    footer: zlib-compressed JSON describing the row groups
+    footer length (8 bytes, little-endian) + MAGIC
+
+Usage:
+    with open(filename, 'rb') as f:
+        reader = ColumnarReader(f)
+        for row in reader.iter_rows(['exercise', 'correct']):
+            ...
+"""
+
+import json
+import struct
+import zlib
+
+
+MAGIC = 'KACOLS1\n'
+
+# Column chunk types.  A column's type can differ between row groups; a
+# row group whose values don't all fit one of the scalar types stores
+# them as JSON.
+BOOL = 'bool'
+INT = 'int'
+FLOAT = 'float'
+STRING = 'str'
+JSON = 'json'
+
+_MIN_INT64 = -2 ** 63
+_MAX_INT64 = 2 ** 63 - 1
+
+# Strings longer than this don't get min/max statistics, to keep the
+# footer small.
+_MAX_STRING_STAT_LENGTH = 64
+
+DEFAULT_ROW_GROUP_SIZE = 5000
+
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return BOOL
+    elif isinstance(value, (int, long)):
+        if _MIN_INT64 <= value <= _MAX_INT64:
+            return INT
+        return JSON
+    elif isinstance(value, float):
+        return FLOAT
+    elif isinstance(value, basestring):
+        return STRING
+    return JSON
+
+
+def _column_type(values):
+    """The type of column chunk that can hold all of the values."""
+    column_type = None
+    for value in values:
+        value_type = _value_type(value)
+        if column_type is None:
+            column_type = value_type
+        elif value_type != column_type:
+            return JSON
+        if column_type == JSON:
+            return JSON
+    return column_type or JSON
+
+
+def _encode_strings(strings):
+    strings = [s.encode('utf-8') if isinstance(s, unicode) else s
+               for s in strings]
+    lengths = struct.pack('<%dI' % len(strings), *[len(s) for s in strings])
+    return lengths + ''.join(strings)
+
+
+def _decode_strings(data, count):
+    lengths = struct.unpack_from('<%dI' % count, data)
+    pos = 4 * count
+    strings = []
+    for length in lengths:
+        strings.append(data[pos:pos + length].decode('utf-8'))
+        pos += length
+    return strings
+
+
+def _encode_values(column_type, values):
+    if column_type == INT:
+        return struct.pack('<%dq' % len(values), *values)
+    elif column_type == FLOAT:
+        return struct.pack('<%dd' % len(values), *values)
+    elif column_type == BOOL:
+        return ''.join('\x01' if v else '\x00' for v in values)
+    elif column_type == STRING:
+        return _encode_strings(values)
+    return _encode_strings([json.dumps(v) for v in values])
+
+
+def _decode_values(column_type, data, count):
+    if column_type == INT:
+        return list(struct.unpack_from('<%dq' % count, data))
+    elif column_type == FLOAT:
+        return list(struct.unpack_from('<%dd' % count, data))
+    elif column_type == BOOL:
+        return [c == '\x01' for c in data[:count]]
+    elif column_type == STRING:
+        return _decode_strings(data, count)
+    return [json.loads(s) for s in _decode_strings(data, count)]
+
+
+def _statistics(column_type, values):
+    """Return (min, max) of the values, or (None, None) if not useful."""
+    if not values or column_type == JSON:
+        return None, None
+    if column_type == STRING and max(len(v) for v in values) > (
+            _MAX_STRING_STAT_LENGTH):
+        return None, None
+    return min(values), max(values)
+
+
+class ColumnarWriter(object):
+    """Writes documents (dicts) to a columnar archive.
+
+    Documents are buffered until there are row_group_size of them, so
+    memory use is bounded by the row group size.  close() must be called
+    to write the footer; it doesn't close the underlying file.
+    """
+
+    def __init__(self, f, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                 compression_level=6):
+        self._file = f
+        self._row_group_size = row_group_size
+        self._compression_level = compression_level
+        self._rows = []
+        self._row_groups = []
+        self._offset = len(MAGIC)
+        self.count = 0
+        self._file.write(MAGIC)
+
+    def write(self, document):
+        self._rows.append(document)
+        self.count += 1
+        if len(self._rows) >= self._row_group_size:
+            self._flush_row_group()
+
+    def _flush_row_group(self):
+        if not self._rows:
+            return
+        names = []
+        seen = set()
+        for row in self._rows:
+            for name in row:
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+
+        columns = {}
+        for name in names:
+            values = [row.get(name) for row in self._rows]
+            present = [v for v in values if v is not None]
+            column_type = _column_type(present)
+            null_count = len(values) - len(present)
+
+            data = ''
+            if null_count:
+                data = ''.join('\x00' if v is None else '\x01'
+                               for v in values)
+            data += _encode_values(column_type, present)
+            data = zlib.compress(data, self._compression_level)
+            self._file.write(data)
+
+            min_value, max_value = _statistics(column_type, present)
+            columns[name] = {
+                'type': column_type,
+                'offset': self._offset,
+                'length': len(data),
+                'null_count': null_count,
+                'min': min_value,
+                'max': max_value,
+            }
+            self._offset += len(data)
+
+        self._row_groups.append({
+            'num_rows': len(self._rows),
+            'column_order': names,
+            'columns': columns,
+        })
+        self._rows = []
+
+    def close(self):
+        self._flush_row_group()
+        footer = zlib.compress(json.dumps({
+            'version': 1,
+            'row_groups': self._row_groups,
+        }))
+        self._file.write(footer)
+        self._file.write(struct.pack('<Q', len(footer)) + MAGIC)
+
+
+class ColumnarReader(object):
+    """Reads selected columns from a columnar archive.
+
+    f must be a seekable file object opened in binary mode.  Absent or
+    null values are returned as None.
+
+    Each entry of row_groups is a dict with 'num_rows', and 'columns',
+    which maps a column name to its statistics: 'type', 'null_count', and
+    (for non-JSON columns) 'min' and 'max', which are None when unknown.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        f.seek(0)
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a columnar archive')
+        trailer_length = 8 + len(MAGIC)
+        f.seek(-trailer_length, 2)
+        trailer = f.read(trailer_length)
+        if trailer[8:] != MAGIC:
+            raise ValueError('Truncated columnar archive')
+        footer_length = struct.unpack('<Q', trailer[:8])[0]
+        f.seek(-(trailer_length + footer_length), 2)
+        footer = json.loads(zlib.decompress(f.read(footer_length)))
+        self.row_groups = footer['row_groups']
+
+    @property
+    def num_rows(self):
+        return sum(group['num_rows'] for group in self.row_groups)
+
+    @property
+    def column_names(self):
+        names = []
+        seen = set()
+        for group in self.row_groups:
+            for name in group['column_order']:
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+        return names
+
+    def read_column(self, row_group_index, name):
+        """Return the list of values of one column of one row group."""
+        group = self.row_groups[row_group_index]
+        num_rows = group['num_rows']
+        column = group['columns'].get(name)
+        if column is None:
+            return [None] * num_rows
+
+        self._file.seek(column['offset'])
+        data = zlib.decompress(self._file.read(column['length']))
+        null_count = column['null_count']
+        if null_count == num_rows:
+            return [None] * num_rows
+        if not null_count:
+            return _decode_values(column['type'], data, num_rows)
+
+        mask, data = data[:num_rows], data[num_rows:]
+        present = iter(_decode_values(column['type'], data,
+                                      num_rows - null_count))
+        return [next(present) if m == '\x01' else None for m in mask]
+
+    def iter_columns(self, columns=None, row_group_filter=None):
+        """Yields a {name: list of values} dict for each row group.
+
+        Arguments:
+            columns: the names of the columns to read.  Defaults to all of
+                column_names, including those a row group doesn't have.
+            row_group_filter: if given, a function that takes a row group's
+                entry in row_groups and returns False to skip reading it.
+        """
+        names = columns
+        if names is None:
+            names = self.column_names
+        for index, group in enumerate(self.row_groups):
+            if row_group_filter and not row_group_filter(group):
+                continue
+            yield dict((name, self.read_column(index, name))
+                       for name in names)
+
+    def iter_rows(self, columns=None, row_group_filter=None):
+        """Yields a {name: value} dict for each row.
+
+        Takes the same arguments as iter_columns.
+        """
+        names = columns
+        if names is None:
+            names = self.column_names
+        for index, group in enumerate(self.row_groups):
+            if row_group_filter and not row_group_filter(group):
+                continue
+            values = [self.read_column(index, name) for name in names]
+            for i in xrange(group['num_rows']):
+                yield dict((name, column[i])
+                           for name, column in zip(names, values))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import StringIO
+import unittest
+
+import columnar_archive
+
+
+class ColumnarArchiveTest(unittest.TestCase):
+    def write(self, docs, row_group_size=3):
+        f = StringIO.StringIO()
+        writer = columnar_archive.ColumnarWriter(f, row_group_size)
+        for doc in docs:
+            writer.write(doc)
+        writer.close()
+        return columnar_archive.ColumnarReader(f)
+
+    def test_round_trip(self):
+        docs = [
+            {'exercise': u'addition_1', 'correct': True, 'time_taken': 5,
+             'backup_timestamp': 1375000000.0, 'attempts': [u'2']},
+            {'exercise': u'subtracté', 'correct': False,
+             'time_taken': None, 'backup_timestamp': 1375000001.5,
+             'attempts': []},
+            {'exercise': u'addition_1', 'correct': True, 'time_taken': 12,
+             'backup_timestamp': 1375000002.0, 'attempts': {'a': 1},
+             'hint_used': True},
+            {'exercise': u'x', 'correct': True, 'time_taken': 2 ** 70,
+             'backup_timestamp': 1375000003.0, 'attempts': None},
+        ]
+        reader = self.write(docs)
+        self.assertEquals(4, reader.num_rows)
+        self.assertEquals(2, len(reader.row_groups))
+        self.assertEquals(set(['exercise', 'correct', 'time_taken',
+                               'backup_timestamp', 'attempts', 'hint_used']),
+                          set(reader.column_names))
+
+        rows = list(reader.iter_rows())
+        for doc, row in zip(docs, rows):
+            for name, value in doc.iteritems():
+                self.assertEquals(value, row[name])
+        # Every row has every column, even in row groups without it.
+        for row in rows:
+            self.assertEquals(set(reader.column_names), set(row))
+        self.assertEquals(None, rows[0]['hint_used'])
+        self.assertEquals(None, rows[3]['hint_used'])
+
+    def test_projection(self):
+        docs = [{'a': i, 'b': str(i)} for i in xrange(10)]
+        reader = self.write(docs)
+        self.assertEquals([{'b': unicode(i)} for i in xrange(10)],
+                          list(reader.iter_rows(['b'])))
+
+    def test_statistics_and_row_group_filter(self):
+        docs = [{'n': i, 's': 'k%02d' % i} for i in xrange(9)]
+        reader = self.write(docs)
+        stats = [g['columns']['n'] for g in reader.row_groups]
+        self.assertEquals([(0, 2), (3, 5), (6, 8)],
+                          [(s['min'], s['max']) for s in stats])
+        self.assertEquals('k03', reader.row_groups[1]['columns']['s']['min'])
+
+        def overlaps_4(group):
+            stats = group['columns']['n']
+            return stats['min'] <= 4 <= stats['max']
+
+        self.assertEquals([3, 4, 5], [row['n'] for row in reader.iter_rows(
+            ['n'], row_group_filter=overlaps_4)])
+
+    def test_empty(self):
+        reader = self.write([])
+        self.assertEquals(0, reader.num_rows)
+        self.assertEquals([], list(reader.iter_rows()))
+
+    def test_not_an_archive(self):
+        self.assertRaises(ValueError, columnar_archive.ColumnarReader,
+                          StringIO.StringIO('{"key": 1}\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
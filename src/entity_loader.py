@@ -21,6 +21,7 @@ The following entity types are supported:
 
 Encodings:
     json is supported
+    cols (columnar_archive files) is supported
     pickle isn't
 
 Usage:
@@ -32,12 +33,221 @@ Usage:
     for log in loader.entities("ProblemLog"):
         data = log.get('json')
         # Do stuff with problem logs
+
+    # Only decode the fields you need, and skip entities early.
+    logs = loader.entities("ProblemLog", fields=['exercise', 'correct'],
+                           filters=[('user', '==', user_id),
+                                    ('time_done', '>=', begin_datetime)])
 """
 
+import bz2
+import collections
 import datetime
 import json
 import gzip
+import itertools
+import multiprocessing
+import operator
 import os
+import re
+import time
+
+import archive_manifest
+import columnar_archive
+
+
+def _comparable(value):
+    """Convert a filter value to how it's stored in the backups.
+
+    pb_to_dict stores datetimes as time.mktime() timestamps.
+    """
+    if isinstance(value, datetime.datetime):
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    elif isinstance(value, datetime.date):
+        return time.mktime(value.timetuple())
+    return value
+
+
+def _is_number(value):
+    return (isinstance(value, (int, long, float)) and
+            not isinstance(value, bool))
+
+
+def _parse_number(string):
+    if string.lstrip('-').isdigit():
+        return int(string)
+    return float(string)
+
+
+def _fits_column(value, column_type):
+    """Whether value is of the type of a columnar_archive column."""
+    if column_type in (columnar_archive.INT, columnar_archive.FLOAT):
+        return _is_number(value)
+    elif column_type == columnar_archive.STRING:
+        return isinstance(value, basestring)
+    elif column_type == columnar_archive.BOOL:
+        return isinstance(value, bool)
+    return False
+
+
+# A JSON number (or NaN/Infinity, which json.dumps writes for floats)
+_JSON_NUMBER = r'(-?(?:[0-9][0-9.eE+-]*|Infinity)|NaN)'
+
+
+class Filter(object):
+    """A predicate on one field of an entity.
+
+    field is either a column of the schema (like 'user') or a top-level
+    field of the json document (like 'exercise' or 'time_done').  Dates
+    and datetimes are compared as the timestamps the backups store them
+    as.  Entities without the field never match, and range comparisons
+    only match numbers against numbers and strings against strings.
+
+    Besides matches(), which is exact, Filter can cheaply rule out most
+    non-matching entities before they are decoded: may_match_raw() looks
+    at the undecoded json string, and may_match_row_group() at the
+    statistics of a columnar_archive row group.
+    """
+
+    _OPERATORS = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge,
+        'in': lambda value, values: value in values,
+    }
+    _RANGE_OPERATORS = ('<', '<=', '>', '>=')
+
+    def __init__(self, field, op, value):
+        if op not in self._OPERATORS:
+            raise ValueError('Invalid filter operator %s' % op)
+        self.field = field
+        self.op = op
+        if op == 'in':
+            self.value = [_comparable(v) for v in value]
+        else:
+            self.value = _comparable(value)
+        self._compare = self._OPERATORS[op]
+        self._raw_number_re = None
+        self._raw_value_re = None
+        self._compile_raw_check()
+
+    def __repr__(self):
+        return 'Filter(%r, %r, %r)' % (self.field, self.op, self.value)
+
+    def __reduce__(self):
+        # So filters can be sent to parallel_entities' worker processes.
+        return (Filter, (self.field, self.op, self.value))
+
+    def _compile_raw_check(self):
+        field = re.escape(json.dumps(self.field))
+        if self.op in ('==', 'in'):
+            values = self.value if self.op == 'in' else [self.value]
+            tokens = []
+            for value in values:
+                if _is_number(value):
+                    # 1 can be written 1.0, so numbers can't be matched
+                    # textually.
+                    return
+                token = json.dumps(value)
+                if '\\' in token:
+                    # Escapes can legitimately be written several ways.
+                    return
+                tokens.append(re.escape(token))
+            if tokens:
+                self._raw_value_re = re.compile(
+                    r'%s\s*:\s*(?:%s)' % (field, '|'.join(tokens)))
+        elif self.op in self._RANGE_OPERATORS and _is_number(self.value):
+            self._raw_number_re = re.compile(
+                r'%s\s*:\s*%s' % (field, _JSON_NUMBER))
+
+    def matches(self, value):
+        """Whether the (decoded) value of the field satisfies the filter."""
+        if value is None:
+            return False
+        if self.op in self._RANGE_OPERATORS:
+            if _is_number(self.value):
+                if not _is_number(value):
+                    return False
+            elif isinstance(self.value, basestring):
+                if not isinstance(value, basestring):
+                    return False
+        return self._compare(value, self.value)
+
+    def may_match_raw(self, json_string):
+        """False if the entity with this json document can't match.
+
+        The field's name and value are searched for in the undecoded
+        string; a nested field with the same name can only cause a false
+        positive, never a false negative.
+        """
+        if self._raw_value_re:
+            return self._raw_value_re.search(json_string) is not None
+        elif self._raw_number_re:
+            for number in self._raw_number_re.findall(json_string):
+                if self._compare(_parse_number(number), self.value):
+                    return True
+            return False
+        return True
+
+    def may_match_row_group(self, row_group):
+        """False if no entity in a columnar_archive row group can match."""
+        column = row_group['columns'].get(self.field)
+        if column is None or column['null_count'] == row_group['num_rows']:
+            return False
+        values = self.value if self.op == 'in' else [self.value]
+        if not all(_fits_column(v, column['type']) for v in values):
+            # A mixed (json) column, or values of another type than the
+            # column's, which range comparisons never match.
+            return not (self.op in self._RANGE_OPERATORS and
+                        column['type'] != columnar_archive.JSON and
+                        (_is_number(self.value) or
+                         isinstance(self.value, basestring)))
+
+        return self.may_match_range(column['min'], column['max'])
+
+    def may_match_range(self, low, high):
+        """False if no value between low and high (inclusive) can match.
+
+        low and high are None when unknown.
+        """
+        if low is None or high is None:
+            return True
+        values = self.value if self.op == 'in' else [self.value]
+        for value in values:
+            if _is_number(value) != _is_number(low):
+                return True
+        if self.op == '==':
+            return low <= self.value <= high
+        elif self.op == 'in':
+            return any(low <= v <= high for v in self.value)
+        elif self.op in ('<', '<='):
+            return self._compare(low, self.value)
+        elif self.op in ('>', '>='):
+            return self._compare(high, self.value)
+        return True
+
+
+def make_filters(filters):
+    """Convert a list of Filters or (field, op, value) tuples to Filters."""
+    if not filters:
+        return []
+    return [f if isinstance(f, Filter) else Filter(*f) for f in filters]
+
+
+def _entities_in_filename(loader, type, filename, filters, fields, limit):
+    """Worker for EntityLoader.parallel_entities: up to limit entities."""
+    entity_file = loader.open_entity_file(filename)
+    try:
+        entities = loader.entities_in_file(type, entity_file, filters=filters,
+                                           fields=fields)
+        if limit is not None:
+            entities = itertools.islice(entities, limit)
+        return list(entities)
+    finally:
+        entity_file.close()
 
 
 class EntityLoader(object):
@@ -115,7 +325,18 @@ class EntityLoader(object):
         for date in self.dates(end_date=end_date, begin_date=begin_date):
             yield self.entity_dirname(type, date)
 
-    def entity_filenames(self, type, end_date=None, begin_date=None):
+    def entity_filenames(self, type, end_date=None, begin_date=None,
+                         filters=None):
+        """Yields the names of the backup files, newest first.
+
+        Files that their directory's archive_manifest says are empty, or
+        whose backup_timestamps are all outside the range of the filters,
+        are skipped.  Files that aren't in the manifest (like those
+        written before there was one, or by back_populate.py) are always
+        yielded.
+        """
+        timestamp_filters = [f for f in make_filters(filters)
+                             if f.field == 'backup_timestamp']
         dirnames = self.entity_dirnames(
             type=type,
             end_date=end_date,
@@ -129,65 +350,235 @@ class EntityLoader(object):
                     raise StopIteration
                 continue
 
-            for filename in reversed(sorted(os.listdir(dirname))):
-                if self.encoding in filename:
-                    yield "%(path)s/%(filename)s" % {
-                        "path": dirname,
-                        "filename": filename
-                    }
+            manifest = archive_manifest.read_manifest(dirname) or {}
+            filenames = []
+            for filename in os.listdir(dirname):
+                if archive_manifest.file_format(filename) != self.encoding:
+                    continue
+                entry = manifest.get(filename)
+                if entry is None or self._may_match_entry(entry,
+                                                          timestamp_filters):
+                    filenames.append(filename)
+
+            for filename in reversed(sorted(filenames)):
+                yield "%(path)s/%(filename)s" % {
+                    "path": dirname,
+                    "filename": filename
+                }
+
+    def _may_match_entry(self, entry, timestamp_filters):
+        """False if no entity in a manifest entry's file can match."""
+        if entry['rows'] == 0:
+            return False
+        return all(f.may_match_range(entry['min_backup_timestamp'],
+                                     entry['max_backup_timestamp'])
+                   for f in timestamp_filters)
 
-    def entity_files(self, type, end_date=None, begin_date=None):
+    def open_entity_file(self, filename):
+        """Open a backup file, decompressing it according to its name."""
+        if filename.endswith('.gz'):
+            return gzip.open(filename, 'rb')
+        elif filename.endswith('.bz2'):
+            return bz2.BZ2File(filename, 'rb')
+        return open(filename, 'rb')
+
+    def entity_files(self, type, end_date=None, begin_date=None,
+                     filters=None):
         filenames = self.entity_filenames(
             type=type,
             end_date=end_date,
-            begin_date=begin_date)
+            begin_date=begin_date,
+            filters=filters)
         for filename in filenames:
-            entity_file = gzip.open(filename, 'rb')
+            entity_file = self.open_entity_file(filename)
             yield entity_file
             entity_file.close()
 
-    def entities_in_file(self, type, entity_file, filters=None):
+    def entities_in_file(self, type, entity_file, filters=None, fields=None):
+        """Yields the entities in a backup file that match all the filters.
+
+        Arguments:
+            filters: a list of Filters, or of (field, op, value) tuples
+                that are passed to Filter().
+            fields: if given, only these fields of the json document are
+                returned.  Columns of the schema (like 'user') are always
+                returned.
+        """
         if type not in self.schemas:
             raise ValueError('Invalid type %s' % type)
         schema = self.schemas[type]
+        filters = make_filters(filters)
+
+        if self.encoding == 'json':
+            return self._json_entities(schema, entity_file, filters, fields)
+        elif self.encoding == 'cols':
+            return self._columnar_entities(schema, entity_file, filters,
+                                           fields)
+        elif self.encoding == 'pickle':
+            # TODO(Bieber): Support pickle
+            raise ValueError('pickle not supported')
+        else:
+            raise ValueError('Invalid encoding %s' % self.encoding)
+
+    def _json_entities(self, schema, entity_file, filters, fields):
+        # Filters on the schema's columns are checked before anything is
+        # decoded, then filters on the document are checked against the
+        # raw json, and only then is it decoded.
+        column_filters = [(schema.index(f.field), f) for f in filters
+                          if f.field in schema and f.field != 'json']
+        document_filters = [f for f in filters if f.field not in schema]
 
         for entity_string in entity_file:
-            if self.encoding == 'json':
-                data = entity_string.split("\t")
-                entity = {}
-
-                for i in xrange(len(schema)):
-                    key = schema[i]
-                    value = data[i]
-                    if key == 'json':
-                        value = json.loads(value)
-                    entity[key] = value
-
-                # TODO(Bieber): Handle filters
-                yield entity
+            data = entity_string.split("\t")
+            if not all(f.matches(data[i]) for i, f in column_filters):
+                continue
 
-            elif self.encoding == 'pickle':
-                # TODO(Bieber): Support pickle
-                raise ValueError('pickle not supported')
+            entity = {}
+            for i in xrange(len(schema)):
+                key = schema[i]
+                value = data[i]
+                if key == 'json':
+                    if not all(f.may_match_raw(value)
+                               for f in document_filters):
+                        break
+                    value = json.loads(value)
+                    if not all(f.matches(value.get(f.field))
+                               for f in document_filters):
+                        break
+                    if fields is not None:
+                        value = dict((name, value[name]) for name in fields
+                                     if name in value)
+                entity[key] = value
             else:
-                raise ValueError('Invalid encoding %s' % self.encoding)
+                yield entity
+
+    def _columnar_entities(self, schema, entity_file, filters, fields):
+        # Row groups are skipped using their statistics, and only the
+        # columns that are returned or filtered on are decompressed.
+        # The schema's columns are fields of the documents.  Null fields
+        # are left out of the returned documents, since the archive doesn't
+        # distinguish them from missing ones.
+        columns = None
+        if fields is not None:
+            columns = set(fields)
+            columns.update(key for key in schema if key != 'json')
+            columns.update(f.field for f in filters)
+            columns = list(columns)
+
+        def row_group_filter(row_group):
+            return all(f.may_match_row_group(row_group) for f in filters)
+
+        reader = columnar_archive.ColumnarReader(entity_file)
+        for row in reader.iter_rows(columns, row_group_filter):
+            if not all(f.matches(row.get(f.field)) for f in filters):
+                continue
+
+            entity = {}
+            for key in schema:
+                if key == 'json':
+                    names = row.iterkeys() if fields is None else fields
+                    entity[key] = dict((name, row[name]) for name in names
+                                       if row[name] is not None)
+                else:
+                    entity[key] = row[key]
+            yield entity
 
     def entities(self,
                  type,
                  end_date=None,
                  begin_date=None,
                  limit=1000,
-                 filters=None):
+                 filters=None,
+                 fields=None):
+        """Yields up to limit entities, newest files first.
+
+        See entities_in_file for filters and fields.
+        """
         count = 0
+        filters = make_filters(filters)
         entity_files = self.entity_files(
             type=type,
             end_date=end_date,
-            begin_date=begin_date)
+            begin_date=begin_date,
+            filters=filters)
         for entity_file in entity_files:
-            ents = self.entities_in_file(type, entity_file, filters=filters)
+            ents = self.entities_in_file(type, entity_file, filters=filters,
+                                         fields=fields)
             for entity in ents:
                 if limit is not None and count >= limit:
                     raise StopIteration
 
                 count += 1
                 yield entity
+
+    def parallel_entities(self,
+                          type,
+                          end_date=None,
+                          begin_date=None,
+                          limit=1000,
+                          filters=None,
+                          fields=None,
+                          processes=None,
+                          ordered=True,
+                          max_pending_files=None):
+        """Like entities(), but reads files on a pool of processes.
+
+        Each worker decompresses, decodes and filters a whole file, so use
+        fields and filters to keep what is sent back small.
+
+        Arguments:
+            processes: the size of the pool.  Defaults to the number of CPUs.
+            ordered: if True, entities come in the same order as from
+                entities(); otherwise each file's entities come as soon as
+                that file is done.
+            max_pending_files: at most this many files are being read or
+                waiting to be consumed at once, which bounds memory use.
+                Defaults to twice the number of processes.
+
+        Once limit entities have been yielded, or the generator is closed,
+        the files still being read are abandoned.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if max_pending_files is None:
+            max_pending_files = 2 * processes
+        filters = make_filters(filters)
+        filenames = self.entity_filenames(
+            type=type,
+            end_date=end_date,
+            begin_date=begin_date,
+            filters=filters)
+
+        def next_done(in_flight):
+            if ordered:
+                return in_flight.popleft().get()
+            while True:
+                for result in in_flight:
+                    if result.ready():
+                        in_flight.remove(result)
+                        return result.get()
+                in_flight[0].wait(0.05)
+
+        def file_results(pool):
+            in_flight = collections.deque()
+            for filename in filenames:
+                if len(in_flight) >= max_pending_files:
+                    yield next_done(in_flight)
+                in_flight.append(pool.apply_async(
+                    _entities_in_filename,
+                    (self, type, filename, filters, fields, limit)))
+            while in_flight:
+                yield next_done(in_flight)
+
+        count = 0
+        pool = multiprocessing.Pool(processes)
+        try:
+            for entities in file_results(pool):
+                for entity in entities:
+                    if limit is not None and count >= limit:
+                        return
+                    count += 1
+                    yield entity
+        finally:
+            pool.terminate()
+            pool.join()
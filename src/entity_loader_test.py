@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import archive_manifest
+import columnar_archive
+import entity_loader
+
+
+class TestEntityLoaderFilters(unittest.TestCase):
+    def setUp(self):
+        self.data_prefix = tempfile.mkdtemp()
+        self.date = datetime.date(2013, 8, 1)
+        self.start = time.mktime(datetime.datetime(2013, 8, 1).timetuple())
+        self.docs = [{
+            'user': 'user%d' % (i % 3),
+            'exercise': 'addition_1' if i % 2 else u'subtraction_\xe9',
+            'time_done': self.start + i,
+            'backup_timestamp': self.start + i,
+            'correct': i % 4 == 0,
+            'attempts': ['%d' % i],
+            'nested': {'time_done': 0},
+        } for i in xrange(100)]
+
+        dirname = os.path.join(self.data_prefix, str(self.date), 'ProblemLog')
+        os.makedirs(dirname)
+        with gzip.open(os.path.join(dirname, 'ProblemLog.json.gz'), 'wb') as f:
+            for doc in self.docs:
+                f.write("%s\t%s\n" % (doc['user'], json.dumps(doc)))
+        with open(os.path.join(dirname, 'ProblemLog.cols'), 'wb') as f:
+            writer = columnar_archive.ColumnarWriter(f, row_group_size=10)
+            for doc in self.docs:
+                writer.write(doc)
+            writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_prefix)
+
+    def load(self, encoding, **kwargs):
+        loader = entity_loader.EntityLoader(data_prefix=self.data_prefix,
+                                            encoding=encoding)
+        return list(loader.entities('ProblemLog', self.date, self.date,
+                                    limit=None, **kwargs))
+
+    def assert_loads(self, expected_docs, **kwargs):
+        expected_users = [doc['user'] for doc in expected_docs]
+        fields = kwargs.get('fields')
+        if fields is not None:
+            expected_docs = [dict((k, doc[k]) for k in fields)
+                             for doc in expected_docs]
+        for encoding in ('json', 'cols'):
+            entities = self.load(encoding, **kwargs)
+            self.assertEqual(expected_users, [e['user'] for e in entities])
+            self.assertEqual(expected_docs, [e['json'] for e in entities])
+
+    def test_no_filters(self):
+        self.assert_loads(self.docs)
+
+    def test_projection(self):
+        self.assert_loads(self.docs, fields=['exercise', 'correct'])
+
+    def test_filters(self):
+        begin = datetime.datetime(2013, 8, 1, 0, 0, 25)
+        self.assert_loads(
+            [d for d in self.docs if d['user'] == 'user1' and
+             d['time_done'] >= self.start + 25],
+            filters=[('user', '==', 'user1'), ('time_done', '>=', begin)],
+            fields=['time_done'])
+        self.assert_loads(
+            [d for d in self.docs if d['exercise'] == u'subtraction_\xe9' and
+             d['correct']],
+            filters=[('exercise', 'in', [u'subtraction_\xe9', 'other']),
+                     ('correct', '==', True)])
+        self.assert_loads(
+            [d for d in self.docs if d['time_done'] < self.start + 5],
+            filters=[('time_done', '<', self.start + 5)])
+        self.assert_loads([], filters=[('time_done', '>', 'a string')])
+        self.assert_loads([], filters=[('missing', '==', 1)])
+
+    def test_parallel_entities(self):
+        dirname = os.path.join(self.data_prefix, str(self.date), 'ProblemLog')
+        for i in xrange(1, 5):
+            shutil.copy(os.path.join(dirname, 'ProblemLog.json.gz'),
+                        os.path.join(dirname, 'ProblemLog%d.json.gz' % i))
+        loader = entity_loader.EntityLoader(data_prefix=self.data_prefix)
+        filters = [('user', '==', 'user1')]
+        expected = list(loader.entities('ProblemLog', self.date, self.date,
+                                        limit=None, filters=filters))
+        self.assertEqual(5 * 33, len(expected))
+
+        for ordered in (True, False):
+            entities = list(loader.parallel_entities(
+                'ProblemLog', self.date, self.date, limit=None,
+                filters=filters, processes=2, ordered=ordered,
+                max_pending_files=2))
+            if ordered:
+                self.assertEqual(expected, entities)
+            else:
+                self.assertEqual(sorted(expected), sorted(entities))
+
+        entities = list(loader.parallel_entities(
+            'ProblemLog', self.date, self.date, limit=40, filters=filters,
+            processes=2))
+        self.assertEqual(expected[:40], entities)
+
+    def test_manifest(self):
+        dirname = os.path.join(self.data_prefix, str(self.date), 'ProblemLog')
+        with gzip.open(os.path.join(dirname, 'ProblemLog0.json.gz'),
+                       'wb') as f:
+            f.write("user3\t%s\n" % json.dumps(
+                {'user': 'user3', 'backup_timestamp': self.start + 1000}))
+        open(os.path.join(dirname, 'ProblemLog1.json.gz'), 'wb').close()
+        archive_manifest.rebuild_manifest(dirname)
+        # Files the manifest says are empty are skipped, files that aren't
+        # in it are listed, and entries for missing files are ignored.
+        with gzip.open(os.path.join(dirname, 'ProblemLog2.json.gz'),
+                       'wb') as f:
+            f.write("user4\t%s\n" % json.dumps(
+                {'user': 'user4', 'backup_timestamp': self.start}))
+        os.remove(os.path.join(dirname, 'ProblemLog.json.gz'))
+        shutil.copy(os.path.join(dirname, 'ProblemLog0.json.gz'),
+                    os.path.join(dirname, 'ProblemLog.json.gz.tmp'))
+
+        loader = entity_loader.EntityLoader(data_prefix=self.data_prefix)
+        self.assertEqual(
+            [os.path.join(dirname, 'ProblemLog2.json.gz'),
+             os.path.join(dirname, 'ProblemLog0.json.gz')],
+            list(loader.entity_filenames('ProblemLog', self.date, self.date)))
+        # Files that aren't in the manifest are never pruned.
+        self.assertEqual(
+            [os.path.join(dirname, 'ProblemLog2.json.gz'),
+             os.path.join(dirname, 'ProblemLog0.json.gz')],
+            list(loader.entity_filenames(
+                'ProblemLog', self.date, self.date,
+                filters=[('backup_timestamp', '>', self.start + 500)])))
+        self.assertEqual(
+            [os.path.join(dirname, 'ProblemLog2.json.gz')],
+            list(loader.entity_filenames(
+                'ProblemLog', self.date, self.date,
+                filters=[('backup_timestamp', '>', self.start + 5000)])))
+        self.assertEqual(['user4', 'user3'],
+                         [e['user'] for e in self.load('json')])
+
+    def test_raw_checks(self):
+        f = entity_loader.Filter('time_done', '<', 10)
+        self.assertTrue(f.may_match_raw('{"time_done": 5}'))
+        self.assertFalse(f.may_match_raw('{"time_done": 1.5e3}'))
+        self.assertFalse(f.may_match_raw('{"time_done": null}'))
+        f = entity_loader.Filter('exercise', '==', 'addition_1')
+        self.assertTrue(f.may_match_raw('{"exercise":"addition_1"}'))
+        self.assertFalse(f.may_match_raw('{"exercise": "addition_10"}'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,8 @@ that property is the "backup_timestamp" property used
 by backup_model.BackupModel.
 """
 
+import collections
+import cPickle
 import datetime as dt
 import optparse
 import pickle
@@ -12,6 +14,7 @@ import sys
 import time
 import urllib
 import urllib2
+from multiprocessing.pool import ThreadPool
 
 import gae_util
 gae_util.fix_sys_path()
@@ -59,7 +62,7 @@ def fetch_entities(entity_type, is_ndb, start_date=None, end_date=None,
     ])
     query_string = urllib.urlencode(qs_map)
 
-    # TODO(david): Send request headers that we accept gzipped data?
+    # oauth_util.fetch_url asks for (and decompresses) gzipped responses.
     response_url = '/api/v1/dev/protobuf/%s?%s' % (entity_type, query_string)
 
     return oauth_util.fetch_url.fetch_url(response_url)
@@ -106,30 +109,160 @@ def attempt_fetch_entities(kind,
     return response
 
 
-def download_entities(kind,
+# The largest page we'll ask the server for when more than
+# max_entities_per_fetch entities share a single timestamp.  Appengine
+# doesn't handle much beyond this in one request.
+MAX_ENTITIES_PER_INSTANT = 10000
+
+# Bounds, in seconds, on the fetch interval chosen in adaptive mode.
+MIN_ADAPTIVE_INTERVAL = 1
+MAX_ADAPTIVE_INTERVAL = 3600
+
+# In adaptive mode, aim for pages that are this fraction of
+# max_entities_per_fetch full.  Aiming below 1 leaves room for bursts.
+ADAPTIVE_TARGET_FILL = 0.5
+
+# Per-kind fetch interval (in seconds) learned by adaptive mode, so that
+# later downloads of a kind in this process start from a good guess.
+_adaptive_intervals = {}
+
+
+def get_adaptive_interval(kind):
+    """Return the fetch interval adaptive mode learned for kind, or None.
+
+    Callers that download each time range in a new process can pass this
+    back in as the fetch_interval_seconds of the next download of kind.
+    """
+    return _adaptive_intervals.get(kind)
+
+
+class TooManyMatchingTimestampsError(Exception):
+    """More than MAX_ENTITIES_PER_INSTANT entities share one timestamp."""
+    pass
+
+
+def _first_and_last_timestamps(page, index_name):
+    """Return the index_name values of the first and last pbs in page."""
+    # This works for both db and ndb models. To convert protobufs to
+    # ndb models you'd need to import the model and use a ndb
+    # ModelAdapter. But here we just need access to the
+    # backup_timestamp property (index_name), so deserializing the
+    # protobuf into the lower-level Entity will suffice.
+    entity_first = datastore.Entity._FromPb(entity_pb.EntityProto(page[0]))
+    entity_last = datastore.Entity._FromPb(entity_pb.EntityProto(page[-1]))
+    return (entity_first.get(index_name, None),
+            entity_last.get(index_name, None))
+
+
+def _next_adaptive_interval(interval_seconds, num_entities,
+                            max_entities_per_fetch):
+    """Size the next fetch interval from how full the last page was.
+
+    Full pages halve the interval, and sparse ones grow it (by at most a
+    factor of 2 at a time) towards ADAPTIVE_TARGET_FILL.
+    """
+    if num_entities >= max_entities_per_fetch:
+        scale = 0.5
+    elif num_entities == 0:
+        scale = 2.0
+    else:
+        target = ADAPTIVE_TARGET_FILL * max_entities_per_fetch
+        scale = min(2.0, max(0.5, target / num_entities))
+    return min(MAX_ADAPTIVE_INTERVAL,
+               max(MIN_ADAPTIVE_INTERVAL, interval_seconds * scale))
+
+
+def _fetch_instant(kind, is_ndb, timestamp, max_entities_per_fetch,
+                   max_attempts_per_fetch, index_name, verbose):
+    """Fetch every entity whose index_name is exactly timestamp.
+
+    The protobuf API doesn't return a query cursor, so we can't page
+    through entities that share a timestamp.  Instead we query the
+    one-microsecond window holding just that instant, doubling the page
+    size until everything fits.
+    """
+    instant_end = timestamp + dt.timedelta(microseconds=1)
+    max_logs = max_entities_per_fetch
+    while True:
+        max_logs = min(max_logs * 2, MAX_ENTITIES_PER_INSTANT)
+        page = pickle.loads(attempt_fetch_entities(kind,
+                                                   is_ndb,
+                                                   timestamp, instant_end,
+                                                   max_logs,
+                                                   max_attempts_per_fetch,
+                                                   index_name,
+                                                   verbose))
+        if len(page) < max_logs:
+            return page
+        if max_logs >= MAX_ENTITIES_PER_INSTANT:
+            return None
+
+
+def iter_entity_pages(kind,
                       is_ndb,
                       start_dt, end_dt,
                       fetch_interval_seconds,
                       max_entities_per_fetch,
                       max_attempts_per_fetch,
                       index_name,
-                      verbose=True):
-    """Downloads all entities between start_dt and end_dt  by
-    repeatedly calling attempt_fetch_entities if necessary.  Multiple calls
-    are only necessary if there are more entities in the time interval
-    than max_entities_per_fecth.
-
-    WARNING: because the API call returns entities in [start_dt, end_dt),
-    this, function may return some duplicates in its result.  The caller should
-    de-dupe by .key() of the entities if needed.
-
-    Returns a list of Entities in protocol buffer format.
+                      verbose=True,
+                      adaptive=False,
+                      max_in_flight=1):
+    """Yields all entities between start_dt and end_dt a page at a time.
+
+    Each page is a list of protocol buffers returned by the server, and is
+    yielded as soon as it is available, so callers that write pages out as
+    they go only hold a bounded number of pages in memory regardless of how
+    many entities are in [start_dt, end_dt).  Pages come out in timestamp
+    order, and entities re-fetched when continuing past a full page are
+    dropped.
+
+    If adaptive is True, fetch_interval_seconds is only a starting point:
+    the interval is resized after every fetch based on how many entities
+    came back, and the interval learned is remembered for the next
+    download of the same kind in this process (see get_adaptive_interval
+    for other processes).
+
+    If max_in_flight is more than 1, the range is split into
+    fetch_interval_seconds windows and up to max_in_flight of them are
+    fetched at once on a thread pool.  Pages are still yielded in the same
+    order a sequential download would produce them.  In adaptive mode each
+    window is sized from the entity counts of the windows finished before
+    it was started.
+
+    Raises TooManyMatchingTimestampsError (after notifying) if more than
+    MAX_ENTITIES_PER_INSTANT entities share the same index_name value.
+    Pages yielded before that point are still valid.
     """
-
-    entity_list = []
+    if max_in_flight > 1:
+        return _iter_entity_pages_concurrently(kind, is_ndb,
+                                               start_dt, end_dt,
+                                               fetch_interval_seconds,
+                                               max_entities_per_fetch,
+                                               max_attempts_per_fetch,
+                                               index_name, verbose,
+                                               adaptive, max_in_flight)
+    return _iter_entity_pages_sequentially(kind, is_ndb,
+                                           start_dt, end_dt,
+                                           fetch_interval_seconds,
+                                           max_entities_per_fetch,
+                                           max_attempts_per_fetch,
+                                           index_name, verbose, adaptive)
+
+
+def _iter_entity_pages_sequentially(kind, is_ndb, start_dt, end_dt,
+                                    fetch_interval_seconds,
+                                    max_entities_per_fetch,
+                                    max_attempts_per_fetch,
+                                    index_name, verbose, adaptive):
+    """iter_entity_pages, fetching one interval after another."""
+    if adaptive:
+        fetch_interval_seconds = _adaptive_intervals.get(
+            kind, fetch_interval_seconds)
     interval_start = start_dt
-    time_delta = dt.timedelta(seconds=fetch_interval_seconds)
+    previous_page = None
     while interval_start < end_dt:
+        time_delta = dt.timedelta(seconds=fetch_interval_seconds)
         interval_end = min(interval_start + time_delta, end_dt)
         response = attempt_fetch_entities(kind,
                                           is_ndb,
@@ -139,56 +272,211 @@ def download_entities(kind,
                                           index_name,
                                           verbose)
         response_list = pickle.loads(response)
-        entity_list += response_list
+        del response
+        seen, previous_page = previous_page, None
+
+        if adaptive:
+            fetch_interval_seconds = _next_adaptive_interval(
+                fetch_interval_seconds, len(response_list),
+                max_entities_per_fetch)
+            _adaptive_intervals[kind] = fetch_interval_seconds
 
         if len(response_list) == max_entities_per_fetch:
             # if we maxed out the number of entities for the fetch, there
             # might still be more so query again from the last timestamp
             # WARNING: this depends on the implementation of the API call
             # returning the protobuffs in sorted order
-            #
-            # This works for both db and ndb models. To convert protobufs to
-            # ndb models you'd need to import the model and use a ndb
-            # ModelAdapter. But here we just need access to the
-            # backup_timestamp property (index_name), so deserializing the
-            # protobuf into the lower-level Entity will suffice.
-            pb_first, pb_last = response_list[0], response_list[-1]
-            entity_first = datastore.Entity._FromPb(
-                entity_pb.EntityProto(pb_first))
-            entity_last = datastore.Entity._FromPb(
-                entity_pb.EntityProto(pb_last))
-            timestamp_first = entity_first.get(index_name, None)
-            timestamp_last = entity_last.get(index_name, None)
-
-            if (not timestamp_first or not timestamp_last or
-                    timestamp_first == timestamp_last):
-                # TODO(sitan): There is a possibility that the number of 
-                # entities with the exact same ISO 8601 timestamp exceeds the 
-                # number allowed by max_logs, in which case if we were to query
-                # again, we'd get the same entities back and never update 
-                # interval_start. The necessary and sufficient condition for
-                # this is that the ISO 8601 timestamps of the first and last 
-                # entity retrieved are the same. In such a case, raise an
-                # error. Ideally, we'd want to use a query cursor to fix this,
-                # but we'd have to change the api call to protobuf-query
-                # because protobuf doesn't return a query cursor.
+            timestamp_first, timestamp_last = _first_and_last_timestamps(
+                response_list, index_name)
+
+            next_start = None
+            if timestamp_first and timestamp_last:
+                if timestamp_first != timestamp_last:
+                    next_start = timestamp_last
+                else:
+                    # Every entity in the page has the same timestamp, so
+                    # querying again from timestamp_last would return the
+                    # same page forever.  Get everything at that instant in
+                    # one go and carry on from just after it.
+                    instant_list = _fetch_instant(kind, is_ndb,
+                                                  timestamp_last,
+                                                  max_entities_per_fetch,
+                                                  max_attempts_per_fetch,
+                                                  index_name, verbose)
+                    if instant_list is not None:
+                        response_list = instant_list
+                        next_start = (timestamp_last +
+                                      dt.timedelta(microseconds=1))
+
+            if next_start is None:
                 msg = (("Number of entities of kind %s with timestamp %s " +
                         "in range (%s,%s) exceeded max_logs = %s, " +
                         "pickle download failed") % (
                         kind, timestamp_last, start_dt,
-                        end_dt, max_entities_per_fetch))
+                        end_dt, MAX_ENTITIES_PER_INSTANT))
                 subject = "Failed to fetch entity, too many matching timestamps"
                 g_logger.error(msg)
                 notify.send_hipchat(msg)
                 notify.send_email(subject, msg)
-                return []
-            else:
-                interval_start = timestamp_last
+                raise TooManyMatchingTimestampsError(msg)
+            if next_start == timestamp_last:
+                previous_page = set(response_list)
+            interval_start = next_start
         else:
             interval_start = interval_end
+
+        if seen:
+            # The previous page was full, so we re-queried from its last
+            # timestamp and will have gotten some of its entities again.
+            response_list = [pb for pb in response_list if pb not in seen]
+        yield response_list
+
+
+def _fetch_window(kind, is_ndb, window_start, window_end,
+                  max_entities_per_fetch, max_attempts_per_fetch,
+                  index_name, verbose):
+    """Return the list of pages for [window_start, window_end)."""
+    window_seconds = (window_end - window_start).total_seconds()
+    return list(_iter_entity_pages_sequentially(kind, is_ndb,
+                                                window_start, window_end,
+                                                window_seconds,
+                                                max_entities_per_fetch,
+                                                max_attempts_per_fetch,
+                                                index_name, verbose,
+                                                adaptive=False))
+
+
+def _iter_entity_pages_concurrently(kind, is_ndb, start_dt, end_dt,
+                                    fetch_interval_seconds,
+                                    max_entities_per_fetch,
+                                    max_attempts_per_fetch,
+                                    index_name, verbose, adaptive,
+                                    max_in_flight):
+    """iter_entity_pages, fetching up to max_in_flight windows at once.
+
+    The windows don't overlap, and each one is paged through sequentially
+    by a single worker, so yielding each window's pages in window order
+    gives the same timestamp-ordered, de-duplicated output as a sequential
+    fetch.  At most max_in_flight windows are fetched or waiting to be
+    consumed at any time.
+    """
+    if adaptive:
+        fetch_interval_seconds = _adaptive_intervals.get(
+            kind, fetch_interval_seconds)
+
+    pool = ThreadPool(max_in_flight)
+    # of (fetch interval, window seconds, async result); the last window
+    # can be shorter than the interval it was sized with.
+    in_flight = collections.deque()
+    try:
+        window_start = start_dt
+        while window_start < end_dt or in_flight:
+            if window_start < end_dt and len(in_flight) < max_in_flight:
+                # Windows are sized when they're started, so in adaptive
+                # mode they pick up what the finished windows taught us.
+                window_end = min(
+                    window_start +
+                    dt.timedelta(seconds=fetch_interval_seconds),
+                    end_dt)
+                in_flight.append((fetch_interval_seconds,
+                    (window_end - window_start).total_seconds(),
+                    pool.apply_async(_fetch_window,
+                        (kind, is_ndb, window_start, window_end,
+                         max_entities_per_fetch, max_attempts_per_fetch,
+                         index_name, verbose))))
+                window_start = window_end
+                continue
+
+            interval_seconds, window_seconds, result = in_flight.popleft()
+            pages = result.get()
+            if adaptive:
+                num_entities = sum(len(page) for page in pages)
+                fetch_interval_seconds = _next_adaptive_interval(
+                    interval_seconds,
+                    num_entities * interval_seconds / window_seconds,
+                    max_entities_per_fetch)
+                _adaptive_intervals[kind] = fetch_interval_seconds
+            for page in pages:
+                yield page
+    finally:
+        # If the consumer stopped early or a window failed, don't wait
+        # around for the rest of the windows.
+        pool.terminate()
+
+
+def download_entities(kind,
+                      is_ndb,
+                      start_dt, end_dt,
+                      fetch_interval_seconds,
+                      max_entities_per_fetch,
+                      max_attempts_per_fetch,
+                      index_name,
+                      verbose=True,
+                      adaptive=False,
+                      max_in_flight=1):
+    """Downloads all entities between start_dt and end_dt  by
+    repeatedly calling attempt_fetch_entities if necessary.  Multiple calls
+    are only necessary if there are more entities in the time interval
+    than max_entities_per_fecth.
+
+    See iter_entity_pages for the adaptive and max_in_flight options.  This
+    holds the whole result in memory; use iter_entity_pages to process
+    a large time range a page at a time instead.
+
+    Returns a list of Entities in protocol buffer format.
+    """
+
+    entity_list = []
+    try:
+        for response_list in iter_entity_pages(kind,
+                                               is_ndb,
+                                               start_dt, end_dt,
+                                               fetch_interval_seconds,
+                                               max_entities_per_fetch,
+                                               max_attempts_per_fetch,
+                                               index_name,
+                                               verbose,
+                                               adaptive,
+                                               max_in_flight):
+            entity_list += response_list
+    except TooManyMatchingTimestampsError:
+        return []
     return entity_list
 
 
+class PickledListWriter(object):
+    """Writes a pickled list to a file one page of items at a time.
+
+    The resulting file unpickles with pickle.load() to the same list that
+    pickle.dump(entity_list, f) would have written, so readers of the
+    archives don't need to change, but the writer never needs the whole
+    list in memory.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self.count = 0
+        self._file.write(pickle.PROTO + chr(2) + pickle.EMPTY_LIST)
+
+    def write_page(self, page):
+        """Append the items in page to the pickled list."""
+        if not page:
+            return
+        # Strip the PROTO header and STOP opcode off of each item.  Any
+        # memo slots an item uses are only referenced from within its own
+        # pickle, so it is fine for items to reuse slot numbers.  The page
+        # is written in one go, which matters if f is a compressed file.
+        self._file.write(pickle.MARK +
+                         ''.join(cPickle.dumps(item, 2)[2:-1]
+                                 for item in page) +
+                         pickle.APPENDS)
+        self.count += len(page)
+
+    def close(self):
+        """Terminate the pickle.  Does not close the underlying file."""
+        self._file.write(pickle.STOP)
+
+
 def get_cmd_line_args():
     today_dt = dt.datetime.combine(dt.date.today(), dt.time())
     yesterday_dt = today_dt - dt.timedelta(days=1)
@@ -206,6 +494,11 @@ def get_cmd_line_args():
              "Defaults to today at 00:00.")
     parser.add_option("-i", "--interval", default=10,
         help="Time interval to fetch at a time, in seconds. Defaults to 10.")
+    parser.add_option("-a", "--adaptive", action="store_true", default=False,
+        help="Adjust the fetch interval to how dense the entities are, "
+             "using --interval as the starting point.")
+    parser.add_option("-f", "--max_in_flight", default=1,
+        help="Max # of intervals to fetch concurrently. Defaults to 1.")
     parser.add_option("-l", "--max_logs", default=1000,
         help="Max # of log entries to fetch per interval. Defaults to 1000.")
     parser.add_option("-r", "--max_retries", default=8,
@@ -236,19 +529,25 @@ def main():
     end_dt = date_util.from_date_iso(options.end_date)
     start_dt = date_util.from_date_iso(options.start_date)
 
-    entity_list = download_entities(options.type,
-                                    options.is_ndb,
-                                    start_dt, end_dt,
-                                    int(options.interval),
-                                    int(options.max_logs),
-                                    int(options.max_retries),
-                                    options.key)
-
     with open(options.output_file, 'wb') as f:
-        pickle.dump(entity_list, f)
+        writer = PickledListWriter(f)
+        try:
+            for page in iter_entity_pages(options.type,
+                                          options.is_ndb,
+                                          start_dt, end_dt,
+                                          int(options.interval),
+                                          int(options.max_logs),
+                                          int(options.max_retries),
+                                          options.key,
+                                          adaptive=options.adaptive,
+                                          max_in_flight=int(
+                                              options.max_in_flight)):
+                writer.write_page(page)
+        finally:
+            writer.close()
 
     print >> sys.stderr, ("Downloaded and wrote %d entities.  Exiting." %
-                          len(entity_list))
+                          writer.count)
 
 
 if __name__ == '__main__':
@@ -7,8 +7,12 @@ same format that AppEngine reports the logs itself.  However, this
 method is more reliable than using the appengine bulk-download tool to
 get logs.
 
-The KA api returns zlib-compressed logs.  We uncompress them and stream
-to stdout.
+The KA api returns zlib-compressed logs.  We uncompress them a piece at
+a time and stream them to stdout, or with --output, write them to a gzip
+file with a sidecar index that greplog.py can use (see log_index.py).
+Several intervals are fetched at once (while we write the earlier ones),
+and the length of the intervals is adjusted to keep responses well under
+the API's size limit.
 
 WARNING: AppEngine does not keep logs for all time -- if the
 end_time_t is too long ago, then AppEngine will return empty results.
@@ -17,18 +21,25 @@ This value is probably relative to the number of logs present, so will
 get smaller as time goes on.  You should run this script frequently.
 """
 
+import collections
 import datetime
+import itertools
+import multiprocessing.pool
 import optparse
+import struct
 import sys
 import time
 import zlib
 
 import date_util
+import log_index
 import oauth_util.fetch_url
 
 
 LOGS_URL = '/api/v1/fetch_logs/%(start_time_t)s/%(end_time_t)s'
 
+_DECOMPRESS_CHUNK_SIZE = 256 * 1024
+
 
 def _split_into_headers_and_body(loglines_string):
     """Split the fetch_logs output into header lines and log lines.
@@ -98,8 +109,19 @@ def get_cmd_line_args():
                             "in ISO 8601 format. "
                             "Defaults to today at 00:00."))
     parser.add_option("-i", "--interval", default=10,
-                      help=("Time interval to fetch at a time, in seconds. "
-                            "Defaults to 10."))
+                      help=("Time interval to fetch at a time, in seconds, "
+                            "to start with. Defaults to 10."))
+    parser.add_option("-t", "--target_response_size", default=4000000,
+                      help=("Adjust the interval so that each fetch returns "
+                            "about this many (compressed) bytes of logs. "
+                            "0 means always use --interval. Defaults to "
+                            "4000000; responses are limited to 10MB."))
+    parser.add_option("-m", "--max_interval", default=600,
+                      help=("Never fetch more than this many seconds of logs "
+                            "at a time. Defaults to 600."))
+    parser.add_option("-j", "--num_threads", default=4,
+                      help=("Number of intervals to fetch at once. "
+                            "Defaults to 4."))
     parser.add_option("-r", "--max_retries", default=8,
                       help=("Maximum # of retries for request attempts "
                             "before failing. Defaults to 8."))
@@ -113,6 +135,10 @@ def get_cmd_line_args():
                       help=("If set will try and read the logs from all of "
                         "the currently deployed logical backends (those "
                         "that end with 'backend')."))
+    parser.add_option("-o", "--output", default=None,
+                      help=("If set, write the logs to this gzip file, and "
+                            "an index of it next to it, instead of to "
+                            "stdout."))
 
     options, extra_args = parser.parse_args()
 
@@ -128,7 +154,7 @@ def get_cmd_line_args():
 
 def fetch_appengine_logs(start_time, end_time, server_class,
     appengine_version):
-    """Return the output from /api/v1/fetch_logs.
+    """Return the output from /api/v1/fetch_logs, still zlib-compressed.
 
     Arguments:
       start_time: a datetime object saying when to start fetching from.
@@ -140,6 +166,7 @@ def fetch_appengine_logs(start_time, end_time, server_class,
 
     Returns:
       A string, the output of the /api/v1/fetch_logs/x/x?... command.
+      Use _iter_decompressed to decompress it.
     """
     start_time_t = int(time.mktime(start_time.timetuple()))
     end_time_t = int(time.mktime(end_time.timetuple()))
@@ -151,13 +178,208 @@ def fetch_appengine_logs(start_time, end_time, server_class,
     else:
         url = url_base + '?server_class=%s' % server_class
 
-    compressed_retval = oauth_util.fetch_url.fetch_url(url)
-    retval = zlib.decompress(compressed_retval)
-    (_, loglines_as_string) = _split_into_headers_and_body(retval)
-    if loglines_as_string:
-        return retval
+    return oauth_util.fetch_url.fetch_url(url)
+
+
+def _iter_decompressed(compressed, chunk_size=_DECOMPRESS_CHUNK_SIZE):
+    """Yields the decompression of a zlib string, chunk_size bytes at a time.
+
+    A 10-second interval of logs is about 1.5MB compressed, but ten times
+    that uncompressed, so we never hold all of it in memory at once.
+
+    Raises zlib.error, after yielding what it could, if compressed is
+    corrupt or cut short.
+    """
+    decompressor = zlib.decompressobj()
+    checksum = zlib.adler32('')
+    data = compressed
+    while data:
+        chunk = decompressor.decompress(data, chunk_size)
+        data = decompressor.unconsumed_tail
+        if chunk:
+            checksum = zlib.adler32(chunk, checksum)
+            yield chunk
+    chunk = decompressor.flush()
+    if chunk:
+        checksum = zlib.adler32(chunk, checksum)
+        yield chunk
+    # zlib checks the Adler-32 checksum that ends the stream when it gets
+    # to it, but doesn't complain if the stream stops before then.
+    if compressed[-4:] != struct.pack('>I', checksum & 0xffffffff):
+        raise zlib.error('Incomplete zlib stream')
+
+
+def _split_stream_into_headers_and_body(chunks):
+    """Like _split_into_headers_and_body, for an iterator over the output.
+
+    Only reads as many chunks as it takes to tell where the headers end.
+
+    Returns:
+       The header lines, and an iterator over the chunks of the log lines.
+    """
+    chunks = iter(chunks)
+    head = ''
+    for chunk in chunks:
+        head += chunk
+        # These are the parts of the output that
+        # _split_into_headers_and_body looks at to find the headers.
+        if head[0].isdigit():
+            if len(head) >= 4096:
+                break
+        elif '\n\n' in head:
+            break
+    (headers, body) = _split_into_headers_and_body(head)
+    return (headers, itertools.chain([body] if body else [], chunks))
+
+
+def _write_logs(body_chunks, output):
+    """Write the log lines to output.
+
+    If body_chunks raises partway, a partial last line is ended before
+    the exception is passed on, so it doesn't run into the next logs.
+
+    Returns:
+       The number of bytes written and the number of user requests in them.
+    """
+    num_bytes = 0
+    num_requests = 0
+    tail = ''
+    try:
+        for chunk in body_chunks:
+            output.write(chunk)
+            num_bytes += len(chunk)
+            num_requests += _num_requests_in_logs(chunk)
+            # Count the ' ms=' that straddle chunks, if any.  tail is
+            # the last 3 bytes written, which may span several chunks.
+            num_requests += _num_requests_in_logs(tail + chunk[:3])
+            tail = (tail + chunk)[-3:]
+    except:
+        if tail and not tail.endswith('\n'):
+            output.write('\n')
+        raise
+    return (num_bytes, num_requests)
+
+
+def _fetch_interval(options, start_dt, next_dt, tries=0):
+    """Fetch the logs for [start_dt, next_dt), retrying on errors.
+
+    Every time a fetch fails, the interval is split in half and each half
+    is fetched (and retried) on its own, since a response that is too big
+    will fail however often we retry it.  Intervals of under 2 seconds
+    are just retried.  tries is the number of failures so far.
+
+    Returns:
+       A list of (start, end, the compressed response) for consecutive
+       intervals covering [start_dt, next_dt).  Once a fetch has failed
+       options.max_retries times, the rest of [start_dt, next_dt) is
+       given up on: the last item is then (start, next_dt, None).
+    """
+    print >>sys.stderr, '[%s] Fetching logs from [%s, %s)...' % (
+        datetime.datetime.now(), start_dt, next_dt)
+
+    while True:
+        try:
+            if options.backend:
+                response = fetch_appengine_logs(start_dt, next_dt,
+                    "backend", None)
+            elif options.appengine_version:
+                response = fetch_appengine_logs(start_dt, next_dt,
+                    None, options.appengine_version)
+            else:
+                response = fetch_appengine_logs(start_dt, next_dt,
+                    "frontend", None)
+        except Exception, why:
+            sleep_secs = 2 ** tries
+            tries += 1
+            if tries >= int(options.max_retries):
+                print >>sys.stderr, ('ERROR fetching [%s, %s): %s.'
+                                     % (start_dt, next_dt, why))
+                return [(start_dt, next_dt, None)]
+            print >>sys.stderr, ('ERROR fetching [%s, %s): %s.\n'
+                                 'Retrying in %s seconds...'
+                                 % (start_dt, next_dt, why, sleep_secs))
+            time.sleep(sleep_secs)
+            seconds = int((next_dt - start_dt).total_seconds())
+            if seconds >= 2:
+                mid_dt = start_dt + datetime.timedelta(seconds=seconds // 2)
+                pieces = _fetch_interval(options, start_dt, mid_dt, tries)
+                if pieces[-1][2] is None:
+                    # Don't keep hammering a server that's failing.
+                    return pieces[:-1] + [(pieces[-1][0], next_dt, None)]
+                return pieces + _fetch_interval(options, mid_dt, next_dt,
+                                                tries)
+        else:
+            return [(start_dt, next_dt, response)]
+
+
+def _next_interval(interval, bytes_per_sec, target_response_size,
+                   max_interval):
+    """Return how many seconds of logs to ask for in one request.
+
+    Aims for responses of about target_response_size compressed bytes,
+    given that the last response had bytes_per_sec bytes per second of
+    logs, but never changes interval by more than a factor of 2 at once.
+    """
+    if bytes_per_sec:
+        target = target_response_size / bytes_per_sec
     else:
-        return ''
+        target = max_interval
+    target = max(interval / 2.0, min(interval * 2.0, target))
+    return int(max(1, min(max_interval, target)))
+
+
+def _fetch_intervals(options, start_dt, end_dt):
+    """Fetch the logs from start_dt to end_dt, many intervals at a time.
+
+    options.num_threads intervals are fetched at once, each retried (and
+    split, see _fetch_interval) on its own.  The width of each interval is
+    adapted to how much log data the last fetched interval had (see
+    _next_interval), unless options.target_response_size is 0.
+
+    Yields (interval start, interval end, compressed response or None if
+    all the retries failed) for each interval, in time order.
+    """
+    num_threads = int(options.num_threads)
+    interval = int(options.interval)
+    target_response_size = int(options.target_response_size)
+    max_interval = int(options.max_interval)
+    # The log bytes per second of the most recently fetched interval.
+    # It's set by the pool's result thread, so we only ever replace it.
+    last_rate = [None]
+
+    def record_rate(pieces):
+        num_bytes = seconds = 0
+        for (fetched_start_dt, fetched_next_dt, response) in pieces:
+            if response is not None:
+                num_bytes += len(response)
+                seconds += (fetched_next_dt -
+                            fetched_start_dt).total_seconds()
+        if seconds:
+            last_rate[0] = num_bytes / seconds
+
+    pool = multiprocessing.pool.ThreadPool(num_threads)
+    in_flight = collections.deque()
+    try:
+        while start_dt < end_dt:
+            if len(in_flight) >= 2 * num_threads:
+                for piece in in_flight.popleft().get():
+                    yield piece
+            if target_response_size and last_rate[0] is not None:
+                interval = _next_interval(interval, last_rate[0],
+                                          target_response_size, max_interval)
+            next_dt = min(start_dt + datetime.timedelta(seconds=interval),
+                          end_dt)
+            in_flight.append(pool.apply_async(
+                _fetch_interval, (options, start_dt, next_dt),
+                callback=record_rate))
+            start_dt = next_dt
+        while in_flight:
+            for piece in in_flight.popleft().get():
+                yield piece
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def main():
@@ -166,51 +388,46 @@ def main():
 
     start_dt = date_util.from_date_iso(options.start_date)
     end_dt = date_util.from_date_iso(options.end_date)
-    interval = int(options.interval)
-    max_retries = int(options.max_retries)
+
+    if options.output:
+        output = log_index.IndexedLogWriter(options.output)
+    else:
+        output = sys.stdout
 
     num_errors = 0
-    while start_dt < end_dt:
-        next_dt = min(start_dt + datetime.timedelta(seconds=interval), end_dt)
-
-        print >>sys.stderr, '[%s] Fetching logs from [%s, %s)...' % (
-            datetime.datetime.now(), start_dt, next_dt)
-
-        for tries in xrange(max_retries):
-            try:
-                if options.backend:
-                    response = fetch_appengine_logs(start_dt, next_dt,
-                        "backend", None)
-                elif options.appengine_version:
-                    response = fetch_appengine_logs(start_dt, next_dt,
-                        None, options.appengine_version)
-                else:
-                    response = fetch_appengine_logs(start_dt, next_dt,
-                        "frontend", None)
-            except Exception, why:
-                sleep_secs = 2 ** tries
-                print >>sys.stderr, ('ERROR: %s.\n'
-                                     'Retrying in %s seconds...'
-                                     % (why, sleep_secs))
-                time.sleep(sleep_secs)
-            else:
-                # The 'header' portion of the response goes into the
-                # fetch-log.  The rest goes into the actual logs.
-                (headers, body) = _split_into_headers_and_body(response)
-                sys.stderr.write(headers)
-                # It's nice to give a brief summary of what the logs are like.
-                print >>sys.stderr, ('%s request lines found'
-                                     % _num_requests_in_logs(body))
-                if not body:
-                    print >>sys.stderr, 'WARNING: No logs found'
-                print body,
-                break
-        else:  # for/else: if we get here, we never succeeded in fetching
+    for (interval_start, interval_end, response) in _fetch_intervals(
+            options, start_dt, end_dt):
+        if response is None:
+            # We never succeeded in fetching this interval.
             num_errors += 1
             print >>sys.stderr, ('SKIPPING logs from %s to %s: error fetching.'
-                                 % (start_dt, next_dt))
-
-        start_dt = next_dt
+                                 % (interval_start, interval_end))
+            continue
+
+        # The 'header' portion of the response goes into the
+        # fetch-log.  The rest goes into the actual logs.  The response is
+        # only decompressed as it's written, so if it turns out to be
+        # corrupt, what came before the problem has been written already.
+        try:
+            (headers, body_chunks) = _split_stream_into_headers_and_body(
+                _iter_decompressed(response))
+            sys.stderr.write(headers)
+            (num_bytes, num_requests) = _write_logs(body_chunks, output)
+        except zlib.error, why:
+            num_errors += 1
+            print >>sys.stderr, ('ERROR: logs from %s to %s are incomplete: '
+                                 '%s.' % (interval_start, interval_end, why))
+            continue
+        # It's nice to give a brief summary of what the logs are like.
+        print >>sys.stderr, ('%s request lines found in [%s, %s)'
+                             % (num_requests, interval_start, interval_end))
+        if not num_bytes:
+            print >>sys.stderr, 'WARNING: No logs found'
+
+    if options.output:
+        output.close()
+
+    return num_errors
 
 
 if __name__ == '__main__':
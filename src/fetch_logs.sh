@@ -53,44 +53,37 @@ export PYTHONPATH="${ROOT}:${PYTHONPATH}"   # for oauth_util/ directory
 prev_statusfile="$log_dir/`echo $hour_prev | tr T- //`-status.log"
 
 # Running fetch_logs.py serially for FEs and BEs takes longer than an
-# hour and this script is killed by a timeout in the crontab. So we want
-# to fetch FE and BE logs in parallel, but PIPESTATUS is only available
-# for the most recent foreground pipeline. We use a named pipe and
-# bash's "wait" to obtain the exit status of a background job.
-tmppipe="/tmp/`basename $0`-$$"
-mkfifo "$tmppipe"
+# hour and this script is killed by a timeout in the crontab.  So we
+# fetch FE and BE logs in parallel, and use bash's "wait" to obtain the
+# exit status of the background job.  fetch_logs.py writes the gzipped
+# logs itself, along with the index greplog.py uses (see log_index.py).
 
 # During peak hours (8am - 4pm Pacific), we generate about 20,000 log lines
 # every 10 seconds. When compressed these log lines represent about 1.5 MB of
 # data, which we download from GAE. The limit on response size is currently
 # 10MB, which we need to stay below.
-# It currently takes about 43 minutes to download 1 hour's worth of log files.
-# Measured 11/5/2013
-# TODO(mattfaus): Make fetch_logs.py download multiple intervals worth of logs
-# concurrently, but make sure to output to the log file in-order.
+# Fetched one interval at a time, it took about 43 minutes to download 1 hour's
+# worth of log files (measured 11/5/2013), so fetch_logs.py now fetches several
+# intervals concurrently, writes them in order, and widens or narrows the
+# interval to keep each response at about 4MB (see --target_response_size).
 "$ROOT/fetch_logs.py" -s "$hour" -e "$hour_next" \
-    2> "${outfile_prefix}-status.log" \
-    > "$tmppipe" &
+    -o "${outfile_prefix}.log.gz" \
+    2> "${outfile_prefix}-status.log" &
 # Store the PID to later determine the exit-code of fetch_logs.
 pid_frontends=$!
-gzip -c < "$tmppipe" > "${outfile_prefix}.log.gz" &
 
 # Backends do not generate too much log data, so we can set the interval
 # fairly high. It currently takes about 8 minutes to download 1 hour's worth
 # of log files.
 # Measured 11/5/2013
 "$ROOT/fetch_logs.py" --backend -s "$hour" -e "$hour_next" -i 60 \
-    2> "${backend_outfile_prefix}-status.log" \
-    | gzip -c > "${backend_outfile_prefix}.log.gz"
-# Use a bash-ism to return the exit-code of fetch_logs (not gzip).
-exit_code_backends=${PIPESTATUS[0]}
+    -o "${backend_outfile_prefix}.log.gz" \
+    2> "${backend_outfile_prefix}-status.log"
+exit_code_backends=$?
 
 wait $pid_frontends
 exit_code_frontends=$?
 
-wait  # wait to finish reading from $tmppipe in the background
-rm "$tmppipe"
-
 # TODO: don't conflate failure of FE and BE fetching. Until then, check
 # *-status.log for more info about which failed.
 [[ $exit_code_frontends == 0 ]] || exit $exit_code_frontends
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import datetime
+import optparse
+import StringIO
+import sys
+import time
+import unittest
+import zlib
+
+import fetch_logs
+
+
+_LOGS = ('1.2.3.4 - - [06/Oct/2012:16:00:00 -0700] "GET /a HTTP/1.1" 200 1 '
+         '- "Mozilla" "www.khanacademy.org" ms=19 cpu_ms=0\n'
+         '\t0:1349564409.94 some app log\n'
+         '1.2.3.4 - - [06/Oct/2012:16:00:01 -0700] "GET /b HTTP/1.1" 200 1 '
+         '- "Mozilla" "www.khanacademy.org" ms=7 cpu_ms=0\n')
+
+
+class FetchIntervalsTest(unittest.TestCase):
+    def setUp(self):
+        self.start = datetime.datetime(2012, 10, 6, 16, 0, 0)
+        self.options = optparse.Values({
+            'backend': False,
+            'appengine_version': None,
+            'max_retries': 8,
+            'num_threads': 2,
+            'interval': 10,
+            'target_response_size': 0,
+            'max_interval': 600,
+        })
+        # Called with the (start, end) seconds after self.start of each
+        # fetch; the fetch fails if it returns True.
+        self.should_fail = lambda start, end: False
+        self.fetches = []
+        self.sleeps = []
+        self.orig_fetch_appengine_logs = fetch_logs.fetch_appengine_logs
+        self.orig_sleep = time.sleep
+        self.orig_stderr = sys.stderr
+        fetch_logs.fetch_appengine_logs = self.fake_fetch_appengine_logs
+        time.sleep = self.sleeps.append
+        sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        fetch_logs.fetch_appengine_logs = self.orig_fetch_appengine_logs
+        time.sleep = self.orig_sleep
+        sys.stderr = self.orig_stderr
+
+    def dt(self, seconds):
+        return self.start + datetime.timedelta(seconds=seconds)
+
+    def fake_fetch_appengine_logs(self, start_time, end_time, server_class,
+                                  appengine_version):
+        interval = ((start_time - self.start).total_seconds(),
+                    (end_time - self.start).total_seconds())
+        self.fetches.append(interval)
+        if self.should_fail(*interval):
+            raise IOError('fetch of [%s, %s) failed' % interval)
+        return 'logs for [%s, %s)' % interval
+
+    def assertCovers(self, pieces, start, end):
+        self.assertEqual(self.dt(start), pieces[0][0])
+        self.assertEqual(self.dt(end), pieces[-1][1])
+        for (piece, next_piece) in zip(pieces, pieces[1:]):
+            self.assertEqual(piece[1], next_piece[0])
+        for (piece_start, piece_end, response) in pieces:
+            self.assertLess(piece_start, piece_end)
+
+    def test_success(self):
+        self.assertEqual(
+            [(self.dt(0), self.dt(10), 'logs for [0.0, 10.0)')],
+            fetch_logs._fetch_interval(self.options, self.dt(0), self.dt(10)))
+        self.assertEqual([], self.sleeps)
+
+    def test_splits_failing_interval(self):
+        # Like a response that is too big: fails however often it's tried.
+        self.should_fail = lambda start, end: end - start > 4
+        pieces = fetch_logs._fetch_interval(self.options, self.dt(0),
+                                            self.dt(10))
+        self.assertCovers(pieces, 0, 10)
+        self.assertEqual(
+            [(self.dt(0), self.dt(2)), (self.dt(2), self.dt(5)),
+             (self.dt(5), self.dt(7)), (self.dt(7), self.dt(10))],
+            [piece[:2] for piece in pieces])
+        for (piece_start, piece_end, response) in pieces:
+            self.assertEqual('logs for [%s, %s)'
+                             % ((piece_start - self.start).total_seconds(),
+                                (piece_end - self.start).total_seconds()),
+                             response)
+
+    def test_retries_short_interval(self):
+        failures = [True, True]
+        self.should_fail = lambda start, end: failures and failures.pop()
+        self.assertEqual(
+            [(self.dt(0), self.dt(1), 'logs for [0.0, 1.0)')],
+            fetch_logs._fetch_interval(self.options, self.dt(0), self.dt(1)))
+        self.assertEqual([(0, 1)] * 3, self.fetches)
+        self.assertEqual([1, 2], self.sleeps)
+
+    def test_gives_up(self):
+        self.options.max_retries = 3
+        self.should_fail = lambda start, end: True
+        self.assertEqual(
+            [(self.dt(0), self.dt(10), None)],
+            fetch_logs._fetch_interval(self.options, self.dt(0), self.dt(10)))
+        self.assertEqual([(0, 10), (0, 5), (0, 2)], self.fetches)
+        self.assertEqual([1, 2], self.sleeps)
+
+    def test_gives_up_on_rest_of_interval(self):
+        self.options.max_retries = 3
+        self.should_fail = lambda start, end: end > 6
+        pieces = fetch_logs._fetch_interval(self.options, self.dt(0),
+                                            self.dt(10))
+        self.assertEqual(
+            [(self.dt(0), self.dt(5), 'logs for [0.0, 5.0)'),
+             (self.dt(5), self.dt(10), None)],
+            pieces)
+        # [7, 10) isn't tried once [5, 7) has failed too often.
+        self.assertNotIn((7, 10), self.fetches)
+
+    def test_fetch_intervals(self):
+        self.options.max_retries = 3
+        self.should_fail = lambda start, end: (
+            (20 <= start < 30 and end - start > 4) or
+            (start < 50 and end > 47))
+        pieces = list(fetch_logs._fetch_intervals(self.options, self.dt(0),
+                                                  self.dt(65)))
+        self.assertCovers(pieces, 0, 65)
+        self.assertEqual(
+            [(self.dt(40), self.dt(45)), (self.dt(45), self.dt(47)),
+             (self.dt(47), self.dt(50))],
+            [piece[:2] for piece in pieces if 40 <= piece[0].second < 50])
+        self.assertEqual([(self.dt(47), self.dt(50))],
+                         [piece[:2] for piece in pieces if piece[2] is None])
+        self.assertEqual((self.dt(60), self.dt(65)), pieces[-1][:2])
+
+
+class WriteLogsTest(unittest.TestCase):
+    def test_counts_requests_across_chunks(self):
+        logs = _LOGS * 5
+        for chunk_size in (1, 2, 3, 4, 5, len(logs)):
+            output = StringIO.StringIO()
+            chunks = [logs[i:i + chunk_size]
+                      for i in xrange(0, len(logs), chunk_size)]
+            self.assertEqual((len(logs), 10),
+                             fetch_logs._write_logs(chunks, output))
+            self.assertEqual(logs, output.getvalue())
+
+    def test_ends_partial_line_on_error(self):
+        def chunks():
+            yield _LOGS[:30]
+            raise zlib.error('Incomplete zlib stream')
+
+        output = StringIO.StringIO()
+        self.assertRaises(zlib.error, fetch_logs._write_logs, chunks(),
+                          output)
+        self.assertEqual(_LOGS[:30] + '\n', output.getvalue())
+
+
+class IterDecompressedTest(unittest.TestCase):
+    def setUp(self):
+        self.logs = _LOGS * 100
+        self.compressed = zlib.compress(self.logs)
+
+    def test_decompresses_in_chunks(self):
+        chunks = list(fetch_logs._iter_decompressed(self.compressed,
+                                                    chunk_size=100))
+        self.assertEqual(self.logs, ''.join(chunks))
+        self.assertTrue(all(len(chunk) <= 100 for chunk in chunks))
+
+    def test_truncated(self):
+        for length in (0, 1, len(self.compressed) // 2,
+                       len(self.compressed) - 1):
+            self.assertRaises(zlib.error, list, fetch_logs._iter_decompressed(
+                self.compressed[:length]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,18 +10,20 @@ TODO(yunfang): adding a controldb in mongo to coordinate the fetch and
                db load of gae data
 """
 
+import bz2
+import contextlib
 import datetime as dt
+import gzip
 import json
 import os
-import pickle
 import re
-import subprocess
 import sys
 import time
 
 from optparse import OptionParser
-from multiprocessing import active_children
 from multiprocessing import Process
+from multiprocessing import Queue
+from Queue import Empty as QueueEmpty
 
 import pymongo
 
@@ -31,6 +33,8 @@ gae_util.fix_sys_path()
 sys.path.append(os.path.dirname(__file__) + "/../map_reduce/py")
 import load_pbufs_to_hive
 
+import archive_manifest
+import columnar_archive
 import date_util
 import fetch_entities
 from util import (mkdir_p, load_unstripped_json,
@@ -43,11 +47,34 @@ DEFAULT_DOWNLOAD_SETTINGS = {
     "max_tries": 8,  # max number of tries to download entities
     "interval": 120,  # data accumulated before writing into mongodb
     "sub_process_time_out": 10800,  # sub process timeout in seconds (3 hours)
+    "max_requeues": 1,  # times to retry a slice that hung or crashed
+    # kinds with a higher priority are downloaded first (default 0)
+    "kind_priorities": {"ProblemLog": 10, "VideoLog": 10},
+    # number of the max_threads worker slots a kind occupies (default 1)
+    "kind_weights": {"ProblemLog": 2, "VideoLog": 2},
     "max_logs": 1000,  # max number of entities from gae foreach pbuf call
+    # resize the per-kind fetch interval according to entity density
+    "adaptive_fetch_interval": False,
+    # number of fetch intervals each download slice requests concurrently
+    "max_fetches_in_flight": 1,
+    # number of fetch intervals requested concurrently by all slices
+    "max_total_fetches_in_flight": 8,
     "dbhost": "localhost",
     "dbport": 28017,
     "default_db": "testdb",  # dbname to write to
-    "archive_dir": "archive"
+    "archive_dir": "archive",
+    "archive_codec": "gzip",  # one of ARCHIVE_CODECS
+    "archive_compression_level": 6,  # 1 (fastest) to 9 (smallest)
+    # also write a columnar_archive .cols file for each download slice
+    "columnar_archive": False,
+}
+
+# Codecs that archives can be compressed with: (file extension,
+# function taking (filename, mode, compression level) to open a file).
+ARCHIVE_CODECS = {
+    "gzip": ("gz", gzip.GzipFile),
+    "bz2": ("bz2", lambda filename, mode, level: bz2.BZ2File(
+        filename, mode, compresslevel=level)),
 }
 
 g_logger = get_logger()
@@ -131,68 +158,184 @@ def log_timestamp_outside_window(kind, raw_timestamp, start_dt, end_dt):
         pass
 
 
+def get_compressed_archive_name(filename, config):
+    """Return filename plus the extension of config['archive_codec']."""
+    extension, _ = ARCHIVE_CODECS[config['archive_codec']]
+    return "%s.%s" % (filename, extension)
+
+
+@contextlib.contextmanager
+def _write_then_rename(filename, open_func):
+    """Context manager for writing filename with open_func(tmp_name).
+
+    The data goes to a .tmp file that only gets its real name once it's
+    been closed at the end of the with block, and is removed if the block
+    raises.  So a download that fails or is killed never leaves a
+    truncated archive under the real name.
+    """
+    tmp_name = filename + '.tmp'
+    f = open_func(tmp_name)
+    try:
+        yield f
+    except:
+        f.close()
+        os.remove(tmp_name)
+        raise
+    f.close()
+    os.rename(tmp_name, filename)
+
+
+def open_archive(filename, config):
+    """Open filename plus the codec's extension for compressed writing.
+
+    The codec and level come from config['archive_codec'] (one of
+    ARCHIVE_CODECS) and config['archive_compression_level'].  This is a
+    context manager, see _write_then_rename.
+    """
+    _, open_func = ARCHIVE_CODECS[config['archive_codec']]
+    level = int(config['archive_compression_level'])
+    return _write_then_rename(get_compressed_archive_name(filename, config),
+                              lambda tmp_name: open_func(tmp_name, 'wb',
+                                                         level))
+
+
+@contextlib.contextmanager
+def open_columnar_archive(filename, config):
+    """Context manager for a columnar_archive.ColumnarWriter to filename.
+
+    Yields None instead if config['columnar_archive'] is off.  Like
+    open_archive, the archive only gets its name (and footer) if the with
+    block finishes.
+    """
+    if not config['columnar_archive']:
+        yield None
+        return
+    with _write_then_rename(filename,
+                            lambda tmp_name: open(tmp_name, 'wb')) as f:
+        column_writer = columnar_archive.ColumnarWriter(f,
+            compression_level=int(config['archive_compression_level']))
+        yield column_writer
+        column_writer.close()
+
+
+def write_json_page(f, page, kind, json_key, start_dt, end_dt,
+                    column_writer=None):
+    """Write a page of protobufs to f as key<tab>json lines.
+
+    If column_writer (a columnar_archive.ColumnarWriter) is given, the
+    documents are written to it too.  Returns the (min, max)
+    backup_timestamp of the page, or (None, None).
+    """
+    lines = []
+    timestamps = []
+    for pb in page:
+        doc = load_pbufs_to_hive.pb_to_dict(pb)
+        if column_writer:
+            column_writer.write(doc)
+
+        # TODO(mattfaus): Make configurable, like for download_entities()
+        backup_timestamp = doc.get('backup_timestamp')
+        log_timestamp_outside_window(
+            kind, backup_timestamp, start_dt, end_dt)
+        if backup_timestamp is not None:
+            timestamps.append(backup_timestamp)
+
+        json_str = json.dumps(doc)
+        lines.append("%s\t%s\n" % (doc[json_key], json_str))
+    # One write per page keeps the per-call overhead of the compressor down.
+    f.write(''.join(lines))
+    if not timestamps:
+        return None, None
+    return min(timestamps), max(timestamps)
+
+
 def fetch_and_process_data(kind, start_dt_arg, end_dt_arg,
-    fetch_interval, config):
-    """Main function: fetching data and load it to mongodb."""
+    fetch_interval, config, max_in_flight=None):
+    """Main function: fetching data and load it to mongodb.
+
+    max_in_flight is the number of fetch intervals to request at once, and
+    defaults to config['max_fetches_in_flight'].
+
+    Returns the number of entities downloaded.
+    """
+    if max_in_flight is None:
+        max_in_flight = config['max_fetches_in_flight']
     if config['dbhost']:
         mongo = open_db_conn(config)
         kdc.record_progress(mongo, config['coordinator_cfg'],
             kind, start_dt_arg, end_dt_arg, kdc.DownloadStatus.STARTED)
 
-    # fetch
+    # fetch, writing each page to the pickle and json archives as it
+    # arrives so that we only ever hold one page of entities in memory
     g_logger.info("Downloading data for %s from %s to %s starts" % (
         kind, start_dt_arg, end_dt_arg))
     is_ndb = bool(config['kinds'][kind][3])
-    entity_list = fetch_entities.download_entities(
-                      kind,
-                      is_ndb,
-                      start_dt_arg, end_dt_arg,
-                      fetch_interval,
-                      config['max_logs'], config['max_tries'],
-                      "backup_timestamp",  # TODO(jace): make configurable
-                      verbose=False)
-    g_logger.info(
-        "Data downloaded for %s from %s to %s.# rows: %d finishes" % (
-            kind, start_dt_arg, end_dt_arg, len(entity_list)))
-
-    if config['dbhost']:
-        kdc.record_progress(mongo, config['coordinator_cfg'],
-            kind, start_dt_arg, end_dt_arg, kdc.DownloadStatus.FETCHED)
+    json_key = config['kinds'][kind][4]
 
-    # save to a file
     # TODO(yunfang): revisit if we should save the pickled pb
     archived_file = get_archive_file_name(config, kind,
         start_dt_arg, end_dt_arg, 'pickle')
-    with open(archived_file, 'wb') as f:
-        pickle.dump(entity_list, f)
-    ret = subprocess.call(["gzip", "-f", archived_file])
-    if ret == 0:
-        g_logger.info("%s rows saved to %s.gz" % (len(entity_list),
-            archived_file))
-    else:
-        g_logger.error("Cannot gzip %s" % (archived_file))
-
-    #jsonize the entities
     json_filename = get_archive_file_name(config, kind,
         start_dt_arg, end_dt_arg, 'json')
-    json_key = config['kinds'][kind][4]
-    f = open(json_filename, 'wb')
-    for pb in entity_list:
-        doc = load_pbufs_to_hive.pb_to_dict(pb)
+    columns_filename = get_archive_file_name(config, kind,
+        start_dt_arg, end_dt_arg, 'cols')
+    saved_files = [get_compressed_archive_name(archived_file, config),
+                   get_compressed_archive_name(json_filename, config)]
+    if config['columnar_archive']:
+        saved_files.append(columns_filename)
+    # Both archives are compressed as they are written, so the
+    # uncompressed data never touches the disk.
+    with open_archive(archived_file, config) as pickle_f, \
+            open_archive(json_filename, config) as json_f, \
+            open_columnar_archive(columns_filename, config) as column_writer:
+        pickle_writer = fetch_entities.PickledListWriter(pickle_f)
+        pages = fetch_entities.iter_entity_pages(
+                          kind,
+                          is_ndb,
+                          start_dt_arg, end_dt_arg,
+                          fetch_interval,
+                          config['max_logs'], config['max_tries'],
+                          "backup_timestamp",  # TODO(jace): configurable
+                          verbose=False,
+                          adaptive=config['adaptive_fetch_interval'],
+                          max_in_flight=max_in_flight)
+        min_timestamp = max_timestamp = None
+        try:
+            for page in pages:
+                pickle_writer.write_page(page)
+                page_min, page_max = write_json_page(
+                    json_f, page, kind, json_key,
+                    start_dt_arg, end_dt_arg, column_writer)
+                if min_timestamp is None:
+                    min_timestamp, max_timestamp = page_min, page_max
+                elif page_min is not None:
+                    min_timestamp = min(min_timestamp, page_min)
+                    max_timestamp = max(max_timestamp, page_max)
+        except fetch_entities.TooManyMatchingTimestampsError:
+            # iter_entity_pages has already notified about this.  Keep
+            # the pages we did get rather than throwing them away.
+            g_logger.error("Download for %s from %s to %s incomplete" % (
+                kind, start_dt_arg, end_dt_arg))
+        # Only terminate the pickle of a download that didn't fail, so that
+        # a partial one never looks complete.
+        pickle_writer.close()
+    num_rows = pickle_writer.count
+    g_logger.info(
+        "Data downloaded for %s from %s to %s.# rows: %d finishes" % (
+            kind, start_dt_arg, end_dt_arg, num_rows))
 
-        # TODO(mattfaus): Make configurable, like for download_entities() above
-        log_timestamp_outside_window(
-            kind, doc.get('backup_timestamp'), start_dt_arg, end_dt_arg)
+    if config['dbhost']:
+        kdc.record_progress(mongo, config['coordinator_cfg'],
+            kind, start_dt_arg, end_dt_arg, kdc.DownloadStatus.FETCHED)
 
-        json_str = json.dumps(doc)
-        print >>f, "%s\t%s" % (doc[json_key], json_str)
-    f.close()
-    ret = subprocess.call(["gzip", "-f", json_filename])
-    if ret == 0:
-        g_logger.info("%s rows saved to %s.gz" % (len(entity_list),
-            json_filename))
-    else:
-        g_logger.error("Cannot gzip %s" % (json_filename))
+    for filename in saved_files:
+        g_logger.info("%s rows saved to %s" % (num_rows, filename))
+    # EntityLoader trusts the manifest's row counts and timestamp ranges,
+    # so only add the files once they're complete.
+    archive_manifest.append_entries(os.path.dirname(json_filename), [
+        archive_manifest.make_entry(filename, num_rows,
+                                    min_timestamp, max_timestamp)
+        for filename in saved_files])
 
     if config['dbhost']:
         kdc.record_progress(mongo, config['coordinator_cfg'],
@@ -203,6 +346,8 @@ def fetch_and_process_data(kind, start_dt_arg, end_dt_arg,
         kdc.record_progress(mongo, config['coordinator_cfg'],
             kind, start_dt_arg, end_dt_arg, kdc.DownloadStatus.LOADED)
 
+    return num_rows
+
 
 def open_db_conn(config):
     """Get a mongodb connection (and reuse it)"""
@@ -212,28 +357,219 @@ def open_db_conn(config):
     return func(config)
 
 
-def monitor(config, processes):
-    """Monitor the concurrent processes"""
-    remaining = []
-    now = time.time()
-    for (process, params) in processes:
-        if process.is_alive():
-            if (now - params['start']) > int(config["sub_process_time_out"]):
-                #timeout
+class _DownloadSlice(object):
+    """One unit of download work: a single kind over [start_dt, end_dt)."""
+
+    def __init__(self, slice_id, kind, start_dt, end_dt, fetch_interval,
+                 priority, weight):
+        self.slice_id = slice_id
+        self.kind = kind
+        self.start_dt = start_dt
+        self.end_dt = end_dt
+        self.fetch_interval = fetch_interval
+        self.priority = priority
+        self.weight = weight
+        self.fetches_in_flight = 0  # set when the slice is started
+        self.attempts = 0
+        self.completed = False
+
+    def sort_key(self):
+        # Higher priority first, then oldest data first.
+        return (-self.priority, self.start_dt, self.slice_id)
+
+    def __str__(self):
+        return "%s [%s, %s)" % (self.kind, self.start_dt, self.end_dt)
+
+
+def _run_download_slice(result_queue, slice_id, attempt, kind, start_dt,
+                        end_dt, fetch_interval, max_in_flight, config):
+    """Process target: download one slice and report back its row count.
+
+    The fetch interval learned in adaptive mode is reported back too, so
+    that the next slice of the kind can start from it.
+    """
+    num_rows = fetch_and_process_data(kind, start_dt, end_dt,
+                                      fetch_interval, config, max_in_flight)
+    result_queue.put((slice_id, attempt, num_rows,
+                      fetch_entities.get_adaptive_interval(kind)))
+
+
+class DownloadScheduler(object):
+    """Runs download slices on a bounded pool of worker processes.
+
+    Slices are started in priority order (see "kind_priorities" in the
+    config) as soon as there is capacity for them, rather than at a fixed
+    rate.  Each slice occupies "kind_weights"[kind] (default 1) of the
+    "max_threads" worker slots, so expensive kinds like ProblemLog don't
+    oversubscribe the machine.  Each running slice also gets up to
+    "max_fetches_in_flight" concurrent fetches out of a budget of
+    "max_total_fetches_in_flight" shared by all of them, so that the
+    slices together don't flood the server with requests.  A slice that
+    runs for longer than "sub_process_time_out" seconds, or whose process
+    dies, is terminated and requeued up to "max_requeues" times.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.capacity = int(config['max_threads'])
+        self.fetches_per_slice = int(config['max_fetches_in_flight'])
+        self.fetch_budget = int(config['max_total_fetches_in_flight'])
+        self.time_out = int(config['sub_process_time_out'])
+        self.max_requeues = int(config['max_requeues'])
+        self.result_queue = Queue()
+        self.pending = []
+        self.running = {}  # slice_id -> (process, slice, start time)
+        self.slices = {}
+        self.stats = {}
+        # kind -> the latest fetch interval learned in adaptive mode
+        self.fetch_intervals = {}
+
+    def add(self, kind, start_dt, end_dt, fetch_interval):
+        priority = int(self.config['kind_priorities'].get(kind, 0))
+        weight = int(self.config['kind_weights'].get(kind, 1))
+        # A slice heavier than the whole pool would never get to run.
+        weight = max(1, min(weight, self.capacity))
+        download_slice = _DownloadSlice(len(self.slices), kind, start_dt,
+            end_dt, fetch_interval, priority, weight)
+        self.slices[download_slice.slice_id] = download_slice
+        self.pending.append(download_slice)
+        self.stats.setdefault(kind, {
+            'slices': 0, 'rows': 0, 'failed': 0, 'requeued': 0,
+            'worker_secs': 0.0, 'first_start': None, 'last_end': None})
+
+    def used_capacity(self):
+        return sum(s.weight for _, s, _ in self.running.itervalues())
+
+    def used_fetch_budget(self):
+        return sum(s.fetches_in_flight
+                   for _, s, _ in self.running.itervalues())
+
+    def run(self):
+        """Run all added slices to completion, then log a summary."""
+        self.pending.sort(key=_DownloadSlice.sort_key)
+        while self.pending or self.running:
+            self._start_ready_slices()
+            self._wait_for_results(timeout=1)
+            self._reap()
+        self.log_summary()
+
+    def _start_ready_slices(self):
+        # Slices are started strictly in priority order; a heavy slice at
+        # the head of the queue waits for capacity rather than being
+        # starved by lighter ones behind it.
+        while self.pending:
+            download_slice = self.pending[0]
+            if self.used_capacity() + download_slice.weight > self.capacity:
+                break
+            free_fetches = self.fetch_budget - self.used_fetch_budget()
+            # Always let one slice run, however small the budget is.
+            if free_fetches < 1 and self.running:
+                break
+            self.pending.pop(0)
+            download_slice.fetches_in_flight = max(1,
+                min(self.fetches_per_slice, free_fetches))
+            download_slice.attempts += 1
+            fetch_interval = self.fetch_intervals.get(download_slice.kind,
+                download_slice.fetch_interval)
+            p = Process(target=_run_download_slice,
+                args=(self.result_queue, download_slice.slice_id,
+                      download_slice.attempts, download_slice.kind,
+                      download_slice.start_dt, download_slice.end_dt,
+                      fetch_interval,
+                      download_slice.fetches_in_flight,
+                      self.config))
+            p.start()
+            now = time.time()
+            self.running[download_slice.slice_id] = (p, download_slice, now)
+            stats = self.stats[download_slice.kind]
+            if stats['first_start'] is None:
+                stats['first_start'] = now
+
+    def _wait_for_results(self, timeout):
+        """Record results from finished workers, waiting up to timeout."""
+        while True:
+            try:
+                slice_id, attempt, num_rows, fetch_interval = (
+                    self.result_queue.get(timeout=timeout))
+            except QueueEmpty:
+                return
+            download_slice = self.slices[slice_id]
+            if fetch_interval is not None:
+                self.fetch_intervals[download_slice.kind] = fetch_interval
+            if (slice_id not in self.running or
+                    attempt != download_slice.attempts):
+                # A result from a process we already gave up on.
+                continue
+            started = self.running[slice_id][2]
+            download_slice.completed = True
+            stats = self.stats[download_slice.kind]
+            stats['slices'] += 1
+            stats['rows'] += num_rows
+            stats['worker_secs'] += time.time() - started
+            stats['last_end'] = time.time()
+            # Don't wait around once we've got a result, just drain any
+            # others that are already available.
+            timeout = 0
+
+    def _reap(self):
+        """Clean up finished processes and kill hung ones."""
+        now = time.time()
+        for slice_id, (process, download_slice, started) in (
+                self.running.items()):
+            if process.is_alive():
+                if (now - started) <= self.time_out:
+                    continue
                 process.terminate()
-                #NOTE: Although it get terminated. The duration should be
-                # re-scheduled with the upcoming control-db implementation.
-                msg = (("Process hung with kind: %s" + 
-                        " start_dt: %s end_dt: %s" +
-                        " after %s seconds") % (
-                        params["kind"], params["start_dt"], 
-                        params["end_dt"], config["sub_process_time_out"]))
-                g_logger.error(msg)
-                notify.send_hipchat(msg)
-                notify.send_email("WARNING: gae subprocess hung", msg)
-            else:
-                remaining.append((process, params))
-    processes = remaining
+                process.join()
+                self._handle_failure(download_slice,
+                    "Process hung with kind: %s start_dt: %s end_dt: %s "
+                    "after %s seconds" % (download_slice.kind,
+                        download_slice.start_dt, download_slice.end_dt,
+                        self.time_out))
+                del self.running[slice_id]
+                continue
+
+            process.join()
+            # Make sure we've seen the result of a slice that just exited
+            # before deciding whether it succeeded.
+            self._wait_for_results(timeout=0)
+            if process.exitcode != 0 or not download_slice.completed:
+                self._handle_failure(download_slice,
+                    "Process for %s exited with code %s" % (
+                        download_slice, process.exitcode))
+            del self.running[slice_id]
+
+    def _handle_failure(self, download_slice, msg):
+        stats = self.stats[download_slice.kind]
+        stats['worker_secs'] += time.time() - self.running[
+            download_slice.slice_id][2]
+        if download_slice.attempts <= self.max_requeues:
+            g_logger.error("%s; requeueing" % msg)
+            stats['requeued'] += 1
+            self.pending.append(download_slice)
+            self.pending.sort(key=_DownloadSlice.sort_key)
+        else:
+            # The slice stays marked as incomplete in the download control
+            # db, so gae_reprocess.py will pick it up later.
+            g_logger.error(msg)
+            stats['failed'] += 1
+            notify.send_hipchat(msg)
+            notify.send_email("WARNING: gae subprocess failed", msg)
+
+    def log_summary(self):
+        """Log per-kind throughput for the slices run so far."""
+        for kind in sorted(self.stats):
+            stats = self.stats[kind]
+            elapsed = 0.0
+            if stats['first_start'] is not None and stats['last_end']:
+                elapsed = stats['last_end'] - stats['first_start']
+            rate = stats['rows'] / elapsed if elapsed > 0 else 0.0
+            g_logger.info(
+                "%s: %d slices, %d rows in %.1fs (%.1f rows/s, %.1f "
+                "worker-secs), %d requeued, %d failed" % (
+                    kind, stats['slices'], stats['rows'], elapsed, rate,
+                    stats['worker_secs'], stats['requeued'],
+                    stats['failed']))
 
 
 def start_data_process(config, start_dt_arg, end_dt_arg):
@@ -241,7 +577,7 @@ def start_data_process(config, start_dt_arg, end_dt_arg):
     g_logger.info("Start processing data from %s to %s" %
                   (str(start_dt_arg), str(end_dt_arg)))
 
-    processes = []
+    scheduler = DownloadScheduler(config)
     for kind, fetch_intervals in config['kinds'].iteritems():
         # fetch_intervals is an array with format [int, int, bool, bool, str]
         # [Save interval, fetch interval, isMutable, is_ndb, json key]
@@ -250,22 +586,10 @@ def start_data_process(config, start_dt_arg, end_dt_arg):
         start_dt = start_dt_arg
         end_dt = end_dt_arg
         while start_dt < end_dt:
-            if len(active_children()) < config['max_threads']:
-                next_dt = min(start_dt + interval, end_dt)
-                p = Process(target=fetch_and_process_data,
-                    args=(kind, start_dt, next_dt, fetch_interval, config))
-                p.start()
-                download_params = {"kind": kind, "start_dt": start_dt,
-                                   "end_dt": next_dt, "start": time.time()}
-                processes.append((p, download_params))
-                start_dt = next_dt
-            else:
-                monitor(config, processes)
-            # wait for 2 secs to space out the queries
-            time.sleep(2)
-    while len(active_children()) > 0:
-        monitor(config, processes)
-        time.sleep(10)
+            next_dt = min(start_dt + interval, end_dt)
+            scheduler.add(kind, start_dt, next_dt, fetch_interval)
+            start_dt = next_dt
+    scheduler.run()
 
 
 def write_tokens(start_dt, end_dt):
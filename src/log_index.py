@@ -0,0 +1,293 @@
+"""Hourly log archives that can be searched without decompressing them.
+
+fetch_logs.py -o writes the logs it fetches with an IndexedLogWriter.
+The archive is an ordinary gzip file (zcat, zgrep and gzip.open read it
+as usual), but it's made of many gzip members, each holding about
+block_size bytes of logs.  A member always starts with a request log, so
+the app logs of a request are in the same block as the request itself.
+
+Next to ARCHIVE (e.g. 2013/11/01/08:00:00Z.log.gz), two sidecar files
+describe the blocks:
+
+    ARCHIVE.idx: json, {"version": 1,
+                        "blocks": [[offset, length, min_time_t,
+                                    max_time_t, num_requests], ...],
+                        "statuses": {"500": [block number, ...], ...}}
+    ARCHIVE.bingo_ids: "bingo_id<tab>block number,block number...\\n"
+        lines, sorted by bingo_id so they can be binary searched without
+        reading the whole file.
+
+min_time_t and max_time_t are the range of the request timestamps in a
+block (logs aren't quite in time order), or null if it has no requests.
+
+greplog.py uses LogIndex to read only the blocks that can hold the
+requests it's looking for.
+"""
+
+import calendar
+import json
+import os
+import sys
+import zlib
+
+sys.path.append(os.path.join(os.path.dirname(__file__),
+                             '..', 'map_reduce', 'py'))
+import raw_log_to_request_log_mapper as rlm
+
+
+INDEX_VERSION = 1
+DEFAULT_BLOCK_SIZE = 1024 * 1024  # uncompressed bytes
+
+_MONTHS = dict((month, i) for (i, month) in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1))
+
+
+def request_log_time_t(time_stamp):
+    """Convert a request log time_stamp, like 24/Jul/2012:17:00:09 -0700.
+
+    Returns seconds since the epoch, or None if time_stamp is malformed.
+    """
+    try:
+        day, month, rest = time_stamp.split('/', 2)
+        year, hour, minute, second_and_zone = rest.split(':', 3)
+        second, zone = second_and_zone.split(' ')
+        time_t = calendar.timegm((int(year), _MONTHS[month], int(day),
+                                  int(hour), int(minute), int(second)))
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+    except (ValueError, KeyError, IndexError):
+        return None
+    if zone[0] == '-':
+        return time_t + offset
+    return time_t - offset
+
+
+def _is_request_log_at(data, pos):
+    """Whether the line of data starting at pos is a request log."""
+    if data[pos:pos + 1] in ' \t\n':    # app logs start with whitespace
+        return False
+    # _LOG_MATCHER ends with $, so it has to be given just the one line.
+    line_end = data.find('\n', pos) + 1 or len(data)
+    return rlm._LOG_MATCHER.match(data[pos:line_end]) is not None
+
+
+def grep_requests(data, search_string):
+    """Yields each request log in data, with its app logs, with search_string.
+
+    data is log lines, like a block of an indexed archive, and starts with
+    a request log.  This is what zgrep -C does for greplog.py, but never
+    cuts off a request's app logs or includes a request twice.
+    """
+    end = 0
+    while True:
+        pos = data.find(search_string, end)
+        if pos == -1:
+            return
+        # Go back to the request log this line belongs to...
+        start = data.rfind('\n', 0, pos) + 1
+        while start > end and not _is_request_log_at(data, start):
+            start = data.rfind('\n', 0, start - 1) + 1
+        # ...and forward to the next request log.
+        end = data.find('\n', pos) + 1 or len(data)
+        while end < len(data) and not _is_request_log_at(data, end):
+            end = data.find('\n', end) + 1 or len(data)
+        yield data[start:end]
+
+
+def index_filename(archive_filename):
+    return archive_filename + '.idx'
+
+
+def bingo_ids_filename(archive_filename):
+    return archive_filename + '.bingo_ids'
+
+
+class IndexedLogWriter(object):
+    """Writes log lines to a block-gzip archive and its sidecar index.
+
+    The sidecar files are written by close(), so an archive without them
+    is either incomplete or from before there were indexes.
+    """
+
+    def __init__(self, filename, block_size=DEFAULT_BLOCK_SIZE,
+                 compression_level=6):
+        self.filename = filename
+        self._file = open(filename, 'wb')
+        self._block_size = block_size
+        self._compression_level = compression_level
+        self._partial_line = ''
+        self._blocks = []
+        self._statuses = {}
+        self._bingo_ids = {}
+        self._start_block()
+
+    def _start_block(self):
+        self._lines = []
+        self._size = 0
+        self._min_time_t = None
+        self._max_time_t = None
+        self._num_requests = 0
+        self._block_statuses = set()
+        self._block_bingo_ids = set()
+
+    def write(self, data):
+        """Write some log lines.  data needn't end at a line boundary."""
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._write_line(line + '\n')
+
+    def _write_line(self, line):
+        request_log_match = None
+        if line[:1] not in ' \t\n':     # app logs start with whitespace
+            request_log_match = rlm._LOG_MATCHER.match(line)
+        if request_log_match:
+            if self._size >= self._block_size:
+                self._flush_block()
+            time_t = request_log_time_t(request_log_match.group('time_stamp'))
+            if time_t is not None:
+                self._min_time_t = min(time_t, self._min_time_t or time_t)
+                self._max_time_t = max(time_t, self._max_time_t)
+            self._block_statuses.add(request_log_match.group('status'))
+            self._num_requests += 1
+        elif 'KALOG;' in line:
+            kalog_match = rlm._KA_LOG_MATCHER.match(line)
+            if kalog_match:
+                self._block_bingo_ids.add(kalog_match.group('bingo_id'))
+        self._lines.append(line)
+        self._size += len(line)
+
+    def _flush_block(self):
+        if not self._lines:
+            return
+        compressor = zlib.compressobj(self._compression_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)  # a gzip member
+        data = (compressor.compress(''.join(self._lines)) +
+                compressor.flush())
+        block_number = len(self._blocks)
+        self._blocks.append([self._file.tell(), len(data), self._min_time_t,
+                             self._max_time_t, self._num_requests])
+        self._file.write(data)
+        for status in self._block_statuses:
+            self._statuses.setdefault(status, []).append(block_number)
+        for bingo_id in self._block_bingo_ids:
+            self._bingo_ids.setdefault(bingo_id, []).append(block_number)
+        self._start_block()
+
+    def close(self):
+        if self._partial_line:
+            self._write_line(self._partial_line)
+            self._partial_line = ''
+        self._flush_block()
+        self._file.close()
+
+        _write_atomically(index_filename(self.filename), json.dumps({
+            'version': INDEX_VERSION,
+            'blocks': self._blocks,
+            'statuses': self._statuses,
+        }))
+        _write_atomically(bingo_ids_filename(self.filename), ''.join(
+            '%s\t%s\n' % (bingo_id, ','.join(str(b) for b in blocks))
+            for (bingo_id, blocks) in sorted(self._bingo_ids.iteritems())
+            if '\t' not in bingo_id and '\n' not in bingo_id))
+
+
+def _write_atomically(filename, data):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_filename, filename)
+
+
+def _find_line(f, size, key):
+    """Return the line of sorted file f that starts with key<tab>, or None.
+
+    Binary searches by byte offset, so only reads O(log(size)) lines.
+    """
+    def line_at_or_after(offset):
+        # The first whole line starting at or after offset.
+        if offset == 0:
+            f.seek(0)
+        else:
+            f.seek(offset - 1)
+            f.readline()
+        return f.readline()
+
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        line = line_at_or_after(mid)
+        if not line or line.split('\t', 1)[0] >= key:
+            hi = mid
+        else:
+            lo = mid + 1
+    line = line_at_or_after(lo)
+    if line.split('\t', 1)[0] == key:
+        return line
+    return None
+
+
+class LogIndex(object):
+    """The sidecar index of an archive written by IndexedLogWriter."""
+
+    def __init__(self, archive_filename, index):
+        self.archive_filename = archive_filename
+        self.blocks = index['blocks']
+        self.statuses = index['statuses']
+
+    @classmethod
+    def load(cls, archive_filename):
+        """Return the archive's LogIndex, or None if it has no index."""
+        try:
+            with open(index_filename(archive_filename)) as f:
+                index = json.load(f)
+        except IOError:
+            return None
+        if index.get('version') != INDEX_VERSION:
+            return None
+        return cls(archive_filename, index)
+
+    def blocks_for_bingo_id(self, bingo_id):
+        """Return the numbers of the blocks with a KALOG for bingo_id."""
+        filename = bingo_ids_filename(self.archive_filename)
+        with open(filename, 'rb') as f:
+            line = _find_line(f, os.path.getsize(filename), bingo_id)
+        if not line:
+            return []
+        return [int(b) for b in line.rstrip('\n').split('\t')[1].split(',')]
+
+    def find_blocks(self, start_time_t=None, end_time_t=None, status=None,
+                    bingo_id=None):
+        """Return the numbers of the blocks that can have matching requests.
+
+        Arguments:
+            start_time_t, end_time_t: if given, only blocks with requests
+                in [start_time_t, end_time_t] are returned.
+            status: if given, only blocks with a request with this status.
+            bingo_id: if given, only blocks with a KALOG for this bingo_id.
+        """
+        block_numbers = set(xrange(len(self.blocks)))
+        if status is not None:
+            block_numbers.intersection_update(
+                self.statuses.get(str(status), []))
+        if bingo_id is not None:
+            block_numbers.intersection_update(
+                self.blocks_for_bingo_id(bingo_id))
+        if start_time_t is not None or end_time_t is not None:
+            for block_number in list(block_numbers):
+                min_time_t, max_time_t = self.blocks[block_number][2:4]
+                if min_time_t is None:
+                    continue    # no requests; keep it, to be safe
+                if ((start_time_t is not None and max_time_t < start_time_t)
+                        or (end_time_t is not None and
+                            min_time_t > end_time_t)):
+                    block_numbers.discard(block_number)
+        return sorted(block_numbers)
+
+    def read_blocks(self, block_numbers):
+        """Yields the (uncompressed) contents of each of the blocks."""
+        with open(self.archive_filename, 'rb') as f:
+            for block_number in block_numbers:
+                offset, length = self.blocks[block_number][:2]
+                f.seek(offset)
+                yield zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import log_index
+
+
+_REQUEST_LOG = ('1.2.3.4 - - [06/Oct/2012:16:%02d:%02d -0700] "GET /a%d '
+                'HTTP/1.1" %d 1 - "Mozilla" "www.khanacademy.org" ms=19 '
+                'cpu_ms=0 cpm_usd=0.000017 pending_ms=0 instance=None '
+                'version=1108-a63aecf373cb request_id=00c6\n')
+_APP_LOGS = ('\t0:1349564409.94 some app log\n'
+             '\t0:1349564409.94 KALOG;pageload;id.bingo:bingo%d;\n')
+
+
+class IndexedLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, '23:00:00Z.log.gz')
+        self.logs = ''.join(
+            _REQUEST_LOG % (i // 60, i % 60, i, 500 if i == 77 else 200) +
+            _APP_LOGS % (i % 50) for i in xrange(300))
+        writer = log_index.IndexedLogWriter(self.filename, block_size=2000)
+        # Write in pieces that don't end at line boundaries.
+        for i in xrange(0, len(self.logs), 777):
+            writer.write(self.logs[i:i + 777])
+        writer.close()
+        self.index = log_index.LogIndex.load(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_archive_is_gzip(self):
+        self.assertEqual(self.logs, gzip.open(self.filename).read())
+        self.assertTrue(len(self.index.blocks) > 10)
+        self.assertEqual(300, sum(b[4] for b in self.index.blocks))
+        self.assertEqual(self.logs,
+                         ''.join(self.index.read_blocks(
+                             range(len(self.index.blocks)))))
+
+    def test_blocks_start_with_request_logs(self):
+        for block in self.index.read_blocks(range(len(self.index.blocks))):
+            self.assertTrue(block.startswith('1.2.3.4 '))
+
+    def test_request_log_time_t(self):
+        self.assertEqual(1349564409, log_index.request_log_time_t(
+            '06/Oct/2012:16:00:09 -0700'))
+        self.assertEqual(1349564409, log_index.request_log_time_t(
+            '06/Oct/2012:23:00:09 +0000'))
+        self.assertEqual(None, log_index.request_log_time_t('06/Oct/2012'))
+
+    def _requests_in(self, block_numbers):
+        return [line for block in self.index.read_blocks(block_numbers)
+                for line in block.splitlines(True) if line[0] == '1']
+
+    def test_find_blocks(self):
+        self.assertEqual([_REQUEST_LOG % (1, 17, 77, 500)],
+                         [l for l in self._requests_in(
+                             self.index.find_blocks(status=500))
+                          if ' 500 ' in l])
+
+        requests = self._requests_in(self.index.find_blocks(bingo_id='bingo7'))
+        for i in (7, 57, 107, 157, 207, 257):
+            self.assertIn(_REQUEST_LOG % (i // 60, i % 60, i, 200), requests)
+        self.assertTrue(len(requests) < 300)
+
+        start = log_index.request_log_time_t('06/Oct/2012:16:02:00 -0700')
+        requests = self._requests_in(
+            self.index.find_blocks(start, start + 59))
+        for i in xrange(120, 180):
+            self.assertIn(_REQUEST_LOG % (i // 60, i % 60, i, 200), requests)
+        self.assertTrue(len(requests) < 100)
+
+        self.assertEqual([], self.index.find_blocks(bingo_id='bingo'))
+        self.assertEqual([], self.index.find_blocks(bingo_id='bingo99'))
+        self.assertEqual([], self.index.find_blocks(status=404))
+
+    def test_no_index(self):
+        self.assertEqual(None, log_index.LogIndex.load(
+            os.path.join(self.tmpdir, 'missing.log.gz')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ hard-coded authentication token with the oauth library.
 import sys
 
 import consts
+import http_pool
 import oauth
 import test_oauth_client
 try:
@@ -21,23 +22,34 @@ update the contents of oauth_util/access_token.py on this machine.
 """)
 
 
-def fetch_url(url_path, post_params=None):
-    """url_path is like '/api/v1/users'.  Hostname is taken from consts.py."""
-    client = test_oauth_client.TestOAuthClient(
-        consts.SERVER_URL, consts.CONSUMER_KEY, consts.CONSUMER_SECRET)
+# Shared by every request this process makes, so that connections (and
+# their TLS sessions) are reused and the token is only parsed once.
+_HTTP_POOL = http_pool.HTTPConnectionPool()
+_client = None
+_access_token = None
+
+
+def _get_client_and_token():
+    global _client, _access_token
+    if _client is None:
+        _client = test_oauth_client.TestOAuthClient(
+            consts.SERVER_URL, consts.CONSUMER_KEY, consts.CONSUMER_SECRET,
+            http=_HTTP_POOL)
+        _access_token = oauth.OAuthToken.from_string(ACCESS_TOKEN_RESPONSE)
+    return _client, _access_token
+
 
-    access_token = oauth.OAuthToken.from_string(ACCESS_TOKEN_RESPONSE)
+def fetch_url(url_path, post_params=None):
+    """url_path is like '/api/v1/users'.  Hostname is taken from consts.py.
 
+    Responses are requested gzipped and decompressed before returning.
+    """
+    client, access_token = _get_client_and_token()
     method = "POST" if post_params else "GET"
     return client.access_resource(url_path, access_token, method, post_params)
 
 
 def post_json(url_path, json=None):
-    client = test_oauth_client.TestOAuthClient(
-        consts.SERVER_URL, consts.CONSUMER_KEY, consts.CONSUMER_SECRET)
-
-    access_token = oauth.OAuthToken.from_string(ACCESS_TOKEN_RESPONSE)
-
+    client, access_token = _get_client_and_token()
     return client.post_resources(url_path, access_token, "POST", json,
                             "application/json")
-
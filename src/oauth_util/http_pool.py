@@ -0,0 +1,143 @@
+"""Keep-alive HTTP(S) connections that are reused across requests.
+
+urllib2 opens (and for https, handshakes) a new connection for every
+request, and never asks for a compressed response.  HTTPConnectionPool
+keeps one persistent connection per host for each thread that uses it,
+asks for gzip/deflate responses and decompresses them transparently.
+
+Errors are reported the same way urllib2 reports them (urllib2.HTTPError
+for non-2xx responses, urllib2.URLError for connection problems), so
+callers' existing error handling keeps working.
+"""
+
+import httplib
+import socket
+import StringIO
+import threading
+import urllib2
+import urlparse
+import zlib
+
+
+_REDIRECT_CODES = (301, 302, 303, 307)
+_MAX_REDIRECTS = 5
+
+
+def decompress(data, content_encoding):
+    """Undo a gzip or deflate Content-Encoding."""
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        # 16 + MAX_WBITS tells zlib to expect a gzip header and trailer.
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif content_encoding == 'deflate':
+        # Servers disagree about whether "deflate" means a zlib stream or
+        # a raw deflate stream, so handle both.
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+
+class HTTPConnectionPool(object):
+    """Persistent, per-thread HTTP(S) connections keyed by host.
+
+    Has the same get_response/post_response interface as the module-level
+    functions in test_oauth_client, so it can be handed to a
+    TestOAuthClient in their place.
+    """
+
+    def __init__(self, timeout=None, compress=True):
+        self.timeout = timeout
+        self.compress = compress
+        self._local = threading.local()
+
+    def _connections(self):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _connection(self, scheme, netloc):
+        """Return (connection, is_new) for scheme://netloc."""
+        connections = self._connections()
+        key = (scheme, netloc)
+        if key in connections:
+            return connections[key], False
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == 'http':
+            conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise urllib2.URLError('unknown url type: %s' % scheme)
+        connections[key] = conn
+        return conn, True
+
+    def _discard(self, scheme, netloc):
+        conn = self._connections().pop((scheme, netloc), None)
+        if conn:
+            conn.close()
+
+    def close(self):
+        """Close all of this thread's connections."""
+        for key in self._connections().keys():
+            self._discard(*key)
+
+    def _request_once(self, method, url, body, headers):
+        """Send one request, returning (status, reason, headers, body)."""
+        parts = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', parts.path or '/',
+                                    parts.query, ''))
+        while True:
+            conn, is_new = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                self._discard(parts.scheme, parts.netloc)
+                if not is_new:
+                    # The server probably closed the idle connection on us;
+                    # retry once on a fresh one.
+                    continue
+                raise urllib2.URLError(e)
+            if response.will_close:
+                self._discard(parts.scheme, parts.netloc)
+            return (response.status, response.reason, response.msg,
+                    decompress(data, response.getheader('content-encoding')))
+
+    def request(self, method, url, body=None, headers=None):
+        """Make a request and return the (decompressed) response body.
+
+        Redirects are followed the way urllib2 follows them.  Raises
+        urllib2.HTTPError if the final response isn't a 2xx.
+        """
+        headers = dict(headers or {})
+        if self.compress:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        for _ in xrange(_MAX_REDIRECTS + 1):
+            status, reason, response_headers, data = self._request_once(
+                method, url, body, headers)
+            location = response_headers.getheader('location')
+            if status not in _REDIRECT_CODES or not location:
+                break
+            url = urlparse.urljoin(url, location)
+            if method == 'POST':
+                # Like urllib2, redirected POSTs turn into GETs.
+                method, body = 'GET', None
+                headers.pop('Content-Type', None)
+
+        if not 200 <= status < 300:
+            raise urllib2.HTTPError(url, status, reason, response_headers,
+                                    StringIO.StringIO(data))
+        return data
+
+    def get_response(self, url):
+        return self.request('GET', url)
+
+    def post_response(self, url, data, content_type=None):
+        headers = {}
+        if content_type:
+            headers['Content-Type'] = content_type
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return self.request('POST', url, data, headers)
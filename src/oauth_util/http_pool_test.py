@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import BaseHTTPServer
+import gzip
+import StringIO
+import threading
+import unittest
+import urllib2
+import zlib
+
+import http_pool
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        if self.path == '/redirect':
+            self._send(302, '', {'Location': '/plain'})
+        elif self.path == '/missing':
+            self._send(404, 'not here')
+        elif 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write('hello ' + self.path)
+            self._send(200, buf.getvalue(), {'Content-Encoding': 'gzip'})
+        else:
+            self._send(200, 'hello ' + self.path)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self._send(200, self.headers['Content-Type'] + ':' + body)
+
+    def _send(self, code, body, headers={}):
+        self.send_response(code)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.connections = set()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.pool = http_pool.HTTPConnectionPool(timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuses_connection_and_decompresses(self):
+        for i in xrange(3):
+            url = '%s/%s' % (self.base_url, i)
+            self.assertEquals('hello /%s' % i, self.pool.get_response(url))
+        self.assertEquals(1, len(self.server.connections))
+
+    def test_uncompressed(self):
+        pool = http_pool.HTTPConnectionPool(timeout=5, compress=False)
+        self.assertEquals('hello /x', pool.get_response(self.base_url + '/x'))
+
+    def test_follows_redirects(self):
+        self.assertEquals('hello /plain',
+                          self.pool.get_response(self.base_url + '/redirect'))
+
+    def test_http_error(self):
+        try:
+            self.pool.get_response(self.base_url + '/missing')
+        except urllib2.HTTPError as e:
+            self.assertEquals(404, e.code)
+            self.assertEquals('not here', e.read())
+        else:
+            self.fail('Expected an HTTPError')
+
+    def test_post(self):
+        self.assertEquals('application/json:{}', self.pool.post_response(
+            self.base_url + '/', '{}', 'application/json'))
+
+    def test_deflate(self):
+        self.assertEquals('abc', http_pool.decompress(
+            zlib.compress('abc'), 'deflate'))
+        self.assertEquals('abc', http_pool.decompress('abc', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,9 +11,13 @@ from oauth import OAuthRequest, OAuthSignatureMethod_HMAC_SHA1
 
 class TestOAuthClient(object):
 
-    def __init__(self, server_url, consumer_key, consumer_secret):
+    def __init__(self, server_url, consumer_key, consumer_secret, http=None):
         self.server_url = server_url
         self.consumer = OAuthConsumer(consumer_key, consumer_secret)
+        # Anything with get_response(url) and post_response(url, data,
+        # content_type) methods, such as an http_pool.HTTPConnectionPool.
+        # By default each request is made with a one-off urllib2 call.
+        self.http = http
 
     def start_fetch_request_token(self):
         oauth_request = OAuthRequest.from_consumer_and_token(
@@ -67,9 +71,10 @@ class TestOAuthClient(object):
             OAuthSignatureMethod_HMAC_SHA1(), self.consumer, access_token)
 
         if method == "GET":
-            response = get_response(oauth_request.to_url())
+            response = self._get_response(oauth_request.to_url())
         else:
-            response = post_response(full_url, oauth_request.to_postdata())
+            response = self._post_response(full_url,
+                                           oauth_request.to_postdata())
 
         return response
 
@@ -91,7 +96,18 @@ class TestOAuthClient(object):
         oauth_request.sign_request(
             OAuthSignatureMethod_HMAC_SHA1(), self.consumer, access_token)
 
-        return post_response(oauth_request.to_url(), data, content_type)
+        return self._post_response(oauth_request.to_url(), data,
+                                   content_type)
+
+    def _get_response(self, url):
+        if self.http:
+            return self.http.get_response(url)
+        return get_response(url)
+
+    def _post_response(self, url, data, content_type=None):
+        if self.http:
+            return self.http.post_response(url, data, content_type)
+        return post_response(url, data, content_type)
 
 
 def get_response(url):
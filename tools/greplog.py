@@ -16,19 +16,27 @@ file for analysis such as: greplog -i 19618 > /tmp/issue_19618.log
 
 import argparse
 import contextlib
+import cPickle
+import cStringIO
 import csv
 import datetime
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
 import re
 import subprocess
 import sys
+import tempfile
 import time
 import urllib
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__),
                                 '..', 'map_reduce', 'py'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
+import log_index
 import raw_log_to_request_log_mapper as rlm
 
 
@@ -44,6 +52,7 @@ DEFAULT_CONTEXT_TO_SEARCH = 60  # number of lines before and after matched text
                                 # that we think is sufficient for including
                                 # both the request log line and the rest of the
                                 # app logs included with it.
+_RUN_SIZE = 10000  # matches greplog sorts in memory at a time
 USAGE = """[options] ('<search query string>')
 
 Grep the request logs and return the results together with their context (ie.
@@ -126,19 +135,36 @@ def get_issue_details(issue_id):
         return ret_val
 
 
-def parse_log_file(input_file_name,
-                   target_timestamp,
-                   search_string=None,
-                   timedelta=DEFAULT_TIME_DELTA,
-                   target_status=None,
-                   target_bingo_id=None,
-                   target_url=None,
-                   target_user_agent=None,
-                   num_surrounding_lines_to_search=DEFAULT_CONTEXT_TO_SEARCH):
+def parse_log_file(input_file_name, *args, **kwargs):
     """ Searches the log file near the timestamp for a users entries
 
         Iterates over the log and finds all entries within timedelta of the
-        target_timestamp and then prints them to stdout.
+        target_timestamp and then prints them to stdout.  Takes the same
+        arguments as iter_matching_requests.
+    """
+    requests_found = 0
+    for (_, request_text) in iter_matching_requests(input_file_name,
+                                                    *args, **kwargs):
+        requests_found += 1
+        sys.stdout.write(request_text)
+    return requests_found
+
+
+def iter_matching_requests(input_file_name,
+                           target_timestamp,
+                           search_string=None,
+                           timedelta=DEFAULT_TIME_DELTA,
+                           target_status=None,
+                           target_bingo_id=None,
+                           target_url=None,
+                           target_user_agent=None,
+                           num_surrounding_lines_to_search=(
+                               DEFAULT_CONTEXT_TO_SEARCH)):
+    """ Yields the log file's requests that match, near the timestamp
+
+        Yields (timestamp, text) for all entries within timedelta of the
+        target_timestamp, in the order they're in the file, where text is
+        the request log line and its app logs as greplog prints them.
     """
 
     if not os.path.isfile(input_file_name):
@@ -157,20 +183,31 @@ def parse_log_file(input_file_name,
                         "target_user_agent, or search_string.  If you want "
                         "the entire file run 'zcat %s'" % input_file_name)
 
-    requests_found = 0
-
-    # Run standard grep on the log files first to more quickly narrow down
-    # what we have to search for. We will grab the 60 lines before and
-    # after the bingo_id to make sure that we get any tracebacks in the
-    # app logs.
-    process = subprocess.Popen(['zgrep', '-C',
-                                '%i' % num_surrounding_lines_to_search,
-                                grep_search_string, input_file_name],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT)
-
-    with contextlib.closing(process.stdout) as input_file:
+    index = log_index.LogIndex.load(input_file_name)
+    if index:
+        # fetch_logs.py wrote an index of the file, so we only need to
+        # decompress the blocks of it that can have matching requests.
+        start_timestamp = end_timestamp = None
+        if target_timestamp:
+            start_timestamp = target_timestamp - timedelta
+            end_timestamp = target_timestamp
+        process = None
+        input_file = _indexed_log_lines(index, grep_search_string,
+                                        start_timestamp, end_timestamp,
+                                        target_status, target_bingo_id)
+    else:
+        # Run standard grep on the log files first to more quickly narrow
+        # down what we have to search for. We will grab the 60 lines
+        # before and after the bingo_id to make sure that we get any
+        # tracebacks in the app logs.
+        process = subprocess.Popen(['zgrep', '-C',
+                                    '%i' % num_surrounding_lines_to_search,
+                                    grep_search_string, input_file_name],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        input_file = process.stdout
 
+    try:
         for (request_log_line, request_log_match, app_log_lines) in (
              rlm.RequestLogIterator(input_file)):
 
@@ -188,28 +225,20 @@ def parse_log_file(input_file_name,
 
                 continue
 
-            datetimestamp_string = request_log_match.group("time_stamp")
-            # Get the timezone information off the string
-            offset = int(datetimestamp_string[-5:])
-            tz_delta = datetime.timedelta(hours=offset / 100)
-
-            # Remove the timezone information from the string
-            datetimestamp_string = datetimestamp_string[:-6]
-            datetimestamp = datetime.datetime.strptime(datetimestamp_string,
-                                                       "%d/%b/%Y:%H:%M:%S")
-
-            # Subtract the timezone difference off the date
-            datetimestamp = datetimestamp - tz_delta
-            timestamp = int(datetime.datetime.strftime(datetimestamp, "%s"))
+            timestamp = log_index.request_log_time_t(
+                request_log_match.group("time_stamp"))
 
-            # TODO(james): binary search the log file to get to the target
-            # start time quickly
             if target_timestamp and timestamp < target_timestamp - timedelta:
                 continue
 
-            # TODO(james): sometimes the log file seems out of order by a
-            # couple of seconds.  Determine if we want a buffer here.
             if target_timestamp and timestamp > target_timestamp:
+                if index:
+                    # Logs can be out of order by a few seconds, and the
+                    # index has already skipped the blocks that are all
+                    # too late, so look at the rest of these requests too.
+                    continue
+                # TODO(james): sometimes the log file seems out of order by
+                # a couple of seconds.  Determine if we want a buffer here.
                 break
 
             if target_status:
@@ -263,17 +292,120 @@ def parse_log_file(input_file_name,
                     target_user_agent != stripped_user_agent):
                     continue
 
-            requests_found += 1
-
-            # The request_log_line already has a \n at the end of it
-            print request_log_line,
-
+            # The request_log_line already has a \n at the end of it.
             # Tracebacks can have the tabs and newlines escaped. We unescape
             # them here for readability
-            print "".join([l.replace('\\t', '\t').replace('\\n', '\n')
-                           for l in app_log_lines])
+            yield (timestamp, request_log_line + "".join(
+                [l.replace('\\t', '\t').replace('\\n', '\n')
+                 for l in app_log_lines]) + "\n")
+    finally:
+        if process:
+            process.stdout.close()
+            process.wait()
+
+
+def _indexed_log_lines(index, grep_search_string, start_timestamp,
+                       end_timestamp, target_status, target_bingo_id):
+    """Yields the lines of the requests of an indexed log that may match.
+
+    Only blocks with requests in [start_timestamp, end_timestamp] and with
+    the status and bingo_id (if given) are decompressed, and only the
+    requests in them with grep_search_string in their request log line or
+    app logs are searched.
+    """
+    block_numbers = index.find_blocks(start_timestamp, end_timestamp,
+                                      target_status, target_bingo_id)
+    for block in index.read_blocks(block_numbers):
+        for request in log_index.grep_requests(block, grep_search_string):
+            # (Iterating over a cStringIO splits on \n only, like a file.)
+            for line in cStringIO.StringIO(request):
+                yield line
+
+
+def _search_log_file(args):
+    """Search a file, and spool its matches to a temporary file.
+
+    Takes (file_index, input_file_name, search_args, max_results), where
+    search_args are the rest of the arguments to iter_matching_requests.
+    The matches, as (timestamp, file_index, n, text) tuples, are pickled
+    to the spool file in runs of up to _RUN_SIZE in timestamp order, so
+    that they can be merged with the other files' without all being in
+    memory.  Only the first max_results of the file (by time) are kept.
+
+    Returns (spool file name, [(offset, number of matches) of each run]).
+    """
+    (file_index, input_file_name, search_args, max_results) = args
+    matches = ((timestamp, file_index, n, text) for (n, (timestamp, text))
+               in enumerate(iter_matching_requests(input_file_name,
+                                                   *search_args)))
+    if max_results is not None:
+        # Already sorted, and no more than any other run in memory.
+        runs = iter([heapq.nsmallest(max_results, matches)])
+    else:
+        runs = iter(lambda: sorted(itertools.islice(matches, _RUN_SIZE)), [])
 
-    return requests_found
+    fd, spool_file_name = tempfile.mkstemp(prefix='greplog-')
+    run_offsets = []
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for run in runs:
+                if run:
+                    run_offsets.append((f.tell(), len(run)))
+                for match in run:
+                    cPickle.dump(match, f, cPickle.HIGHEST_PROTOCOL)
+    except:
+        os.remove(spool_file_name)
+        raise
+    return (spool_file_name, run_offsets)
+
+
+def _read_run(spool_file_name, offset, num_matches):
+    with open(spool_file_name, 'rb') as f:
+        f.seek(offset)
+        for _ in xrange(num_matches):
+            yield cPickle.load(f)
+
+
+def search_log_files(file_names, search_args, max_results=None,
+                     processes=None):
+    """Search the files concurrently and yield their matches in time order.
+
+    Each file is searched by iter_matching_requests, with
+    the arguments search_args, on a pool of processes (by default, one per
+    CPU).  Yields the text of the first max_results matching requests of
+    all the files together, ordered by the requests' timestamps.
+
+    Matches are spooled to temporary files and merged from there, so
+    memory doesn't grow with the number of matches, but since any file
+    could have the earliest match, nothing is yielded until all the files
+    have been searched.
+    """
+    processes = min(processes or multiprocessing.cpu_count(),
+                    len(file_names))
+    tasks = [(i, file_name, search_args, max_results)
+             for (i, file_name) in enumerate(file_names)]
+    spools = []
+    try:
+        if processes <= 1:
+            spools.extend(itertools.imap(_search_log_file, tasks))
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                spools.extend(pool.imap(_search_log_file, tasks))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        runs = [_read_run(spool_file_name, offset, num_matches)
+                for (spool_file_name, run_offsets) in spools
+                for (offset, num_matches) in run_offsets]
+        for (_, _, _, text) in itertools.islice(heapq.merge(*runs),
+                                               max_results):
+            yield text
+    finally:
+        for (spool_file_name, _) in spools:
+            os.remove(spool_file_name)
 
 
 def find_log_files_for(backends, timestamp, time_delta=DEFAULT_TIME_DELTA):
@@ -358,6 +490,13 @@ if __name__ == '__main__':
                               'accurate results when entries have over 60 app '
                               'log lines.'),
                       default=DEFAULT_CONTEXT_TO_SEARCH)
+    parser.add_argument('--processes', '-j', type=int,
+                        help=('The number of files to search at once.  The '
+                              'default is the number of CPUs.'))
+    parser.add_argument('--max-results', '-m', dest='max_results', type=int,
+                        help=('Only output the first this many matching '
+                              'requests (by time) of all the files searched. '
+                              'By default all of them are output.'))
     parser.add_argument('search_string', nargs='?',
                         help=('(optional) Filter the log files for records '
                               'that contain this search thing in either the '
@@ -468,17 +607,19 @@ if __name__ == '__main__':
                        "\nand ".join(conditions)))
 
     num_surrounding_lines_to_search = args.num_surrounding_lines_to_search
+    search_args = (target_timestamp,
+                   search_string,
+                   time_delta,
+                   args.status,
+                   target_bingo_id,
+                   target_url,
+                   target_user_agent,
+                   num_surrounding_lines_to_search)
     requests_found = 0
-    for file_name in file_names:
-        requests_found += parse_log_file(file_name,
-                                         target_timestamp,
-                                         search_string,
-                                         time_delta,
-                                         args.status,
-                                         target_bingo_id,
-                                         target_url,
-                                         target_user_agent,
-                                         num_surrounding_lines_to_search)
+    for request_text in search_log_files(file_names, search_args,
+                                         args.max_results, args.processes):
+        requests_found += 1
+        sys.stdout.write(request_text)
     if not args.quiet:
         end_time = time.time()
         print "Found %i requests matching your conditions in %i seconds" % (
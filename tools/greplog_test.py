@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import greplog
+import log_index
+
+
+_REQUEST_LOG = ('1.2.3.4 - - [06/Oct/2012:16:%02d:%02d -0700] "GET /a%d '
+                'HTTP/1.1" 200 1 - "Mozilla" "www.khanacademy.org" ms=19 '
+                'cpu_ms=0 cpm_usd=0.000017 pending_ms=0 instance=None '
+                'version=1108-a63aecf373cb request_id=00c6\n')
+_APP_LOG = '\t0:1349564409.94 KALOG;pageload;id.bingo:bingo%d;\n'
+
+
+class IndexedSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, '23:00:00Z.log.gz')
+        # One request a second, except that request 91 has the timestamp
+        # of request 130, so the requests after it are out of order.
+        writer = log_index.IndexedLogWriter(self.filename, block_size=2000)
+        for i in xrange(300):
+            seconds = 130 if i == 91 else i
+            writer.write(_REQUEST_LOG % (seconds // 60, seconds % 60, i) +
+                         _APP_LOG % (i % 10))
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _requests_found(self, target_seconds, timedelta):
+        target_timestamp = log_index.request_log_time_t(
+            '06/Oct/2012:16:%02d:%02d -0700' % (target_seconds // 60,
+                                               target_seconds % 60))
+        return sorted(
+            int(text.split(' /a')[1].split(' ')[0]) for (_, text) in
+            greplog.iter_matching_requests(
+                self.filename, target_timestamp, target_bingo_id='bingo1',
+                timedelta=timedelta))
+
+    def test_out_of_order_requests(self):
+        # Requests 101-125 come after request 91, which is too late for
+        # the window, in the file, but they're still found.
+        self.assertEqual([101, 111, 121], self._requests_found(125, 25))
+        self.assertEqual([91, 111, 121, 131], self._requests_found(131, 25))
+
+
+class SearchLogFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Two files with interleaved, and slightly out of order, requests:
+        # the first has the even seconds, the second the odd ones.
+        self.filenames = []
+        for first in (0, 1):
+            filename = os.path.join(self.tmpdir, '%d.log.gz' % first)
+            writer = log_index.IndexedLogWriter(filename, block_size=500)
+            for i in xrange(first, 100, 2):
+                seconds = i - 3 if i % 10 == 8 else i
+                writer.write(_REQUEST_LOG % (seconds // 60, seconds % 60, i) +
+                             _APP_LOG % 1)
+            writer.close()
+            self.filenames.append(filename)
+        self.old_run_size = greplog._RUN_SIZE
+        greplog._RUN_SIZE = 7
+
+    def tearDown(self):
+        greplog._RUN_SIZE = self.old_run_size
+        shutil.rmtree(self.tmpdir)
+
+    def _search(self, max_results, processes):
+        search_args = (None, None, None, None, 'bingo1')
+        return [int(text.split(' /a')[1].split(' ')[0]) for text in
+                greplog.search_log_files(self.filenames, search_args,
+                                         max_results, processes)]
+
+    def test_search_log_files(self):
+        # Ties are in file order.
+        in_time_order = sorted(
+            xrange(100), key=lambda i: (i - 3 if i % 10 == 8 else i, i % 2))
+        for processes in (1, 2):
+            self.assertEqual(in_time_order, self._search(None, processes))
+            self.assertEqual(in_time_order[:10], self._search(10, processes))
+        self.assertEqual([], [f for f in os.listdir(tempfile.gettempdir())
+                              if f.startswith('greplog-')])
+
+
+if __name__ == '__main__':
+    unittest.main()